@@ -8,6 +8,10 @@ DEFAULT_CFG = {
     "gql_query_claim_admins_perms": [],
     "gql_query_claim_officers_perms": [],
     "gql_query_claim_diagnosis_variance_only_on_existing": True,
+    # the diagnosisVariance filter compares to tblClaimDiagnosisBaseline (see refresh_claim_diagnosis_baselines)
+    "gql_query_claim_diagnosis_variance_baselines": False,
+    # days of claims averaged in the diagnosis baselines
+    "claim_diagnosis_baseline_days": 365,
     "gql_mutation_create_claims_perms": ["111002"],
     "gql_mutation_update_claims_perms": ["111010"],
     "gql_mutation_load_claims_perms": ["111005"],
@@ -33,7 +37,26 @@ DEFAULT_CFG = {
     "additional_diagnosis_number_allowed": 4,
     "claim_max_restore": None,
     "allowed_domains_attachments": [],
-    "native_code_for_services": True
+    "native_code_for_services": True,
+    # read the category maxima and max provision counters from tblClaimUtilization (see rebuild_claim_utilization)
+    "claim_utilization_enabled": False,
+    # read the previous deductibles and ceilings from tblClaimDedRemLedger (see rebuild_claim_dedrem_ledgers)
+    "claim_dedrem_ledger_enabled": False,
+    # ProcessClaimsMutation validates all the claims first, then valuates the valid ones with preloaded plans
+    "process_claims_batch_valuation": False,
+    # SubmitClaimsMutation submits the claims of different families in that many threads, serially if 1
+    "submit_claims_workers": 1,
+    # number of claims per transaction of the submit/process/review batches, checkpointed in the MutationLog
+    "batch_chunk_size": 500,
+    # claims queries estimate their totalCount with the PostgreSQL planner unless estimatedCount is false
+    "gql_query_claims_estimated_count": False,
+    # below that many estimated claims, the totalCount is counted exactly
+    "gql_query_claims_exact_count_threshold": 10000,
+    # seconds an exact claims totalCount is cached per query (filters and user scope), 0 to disable
+    "gql_query_claims_count_cache_ttl": 60,
+    # the items and services filters of the claims query use tblClaim.DetailCodes (PostgreSQL, see
+    # install_claim_detail_codes) instead of EXISTS subqueries
+    "claim_detail_codes_enabled": False,
 }
 
 
@@ -45,6 +68,8 @@ class ClaimConfig(AppConfig):
     gql_query_claim_admins_perms = []
     gql_query_claim_officers_perms = []
     gql_query_claim_diagnosis_variance_only_on_existing: None
+    gql_query_claim_diagnosis_variance_baselines = False
+    claim_diagnosis_baseline_days = 365
     gql_mutation_create_claims_perms = []
     gql_mutation_update_claims_perms = []
     gql_mutation_load_claims_perms = []
@@ -73,6 +98,15 @@ class ClaimConfig(AppConfig):
     autogenerate_func = None
     additional_diagnosis_number_allowed = None  # Currently code supports 4 diagnoses maximum, going above will not work
     allowed_domains_attachments = None
+    claim_utilization_enabled = False
+    claim_dedrem_ledger_enabled = False
+    process_claims_batch_valuation = False
+    submit_claims_workers = 1
+    batch_chunk_size = 500
+    gql_query_claims_estimated_count = False
+    gql_query_claims_exact_count_threshold = 10000
+    gql_query_claims_count_cache_ttl = 60
+    claim_detail_codes_enabled = False
 
     def __load_config(self, cfg):
         for field in cfg:
@@ -83,3 +117,5 @@ class ClaimConfig(AppConfig):
         from core.models import ModuleConfiguration
         cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
         self.__load_config(cfg)
+        from .utilization import bind_signals
+        bind_signals()
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+
+from core.models import MutationLog
+
+from .apps import ClaimConfig
+
+logger = logging.getLogger(__name__)
+
+
+class BatchProgress:
+    """
+    Chunked run of a batch mutation over a list of claim uuids. After each chunk, the progress (done, failed,
+    remaining and the uuids not found) is checkpointed in MutationLog.json_ext["batch_progress"], so that running
+    the mutation again for the same client_mutation_id and uuids resumes after the last checkpointed chunk.
+    Save the checkpoint in the transaction of its chunk: a chunk is then either done and checkpointed or neither.
+    """
+    KEY = "batch_progress"
+
+    def __init__(self, client_mutation_id, uuids, chunk_size=None):
+        self.uuids = list(uuids or [])
+        self.chunk_size = max(1, chunk_size or ClaimConfig.batch_chunk_size)
+        self.digest = hashlib.sha1(",".join(self.uuids).upper().encode()).hexdigest()
+        self.mutation_log = MutationLog.objects.filter(client_mutation_id=client_mutation_id).first() \
+            if client_mutation_id else None
+        self.position = 0
+        self.done = 0
+        self.failed = 0
+        self.not_found = []
+        checkpoint = self._json_ext().get(self.KEY)
+        if checkpoint and checkpoint.get("digest") == self.digest:
+            self.position = checkpoint["position"]
+            self.done = checkpoint["done"]
+            self.failed = checkpoint["failed"]
+            self.not_found = checkpoint["not_found"]
+            logger.info("Resuming batch %s at %s/%s", client_mutation_id, self.position, len(self.uuids))
+
+    def _json_ext(self):
+        if self.mutation_log is not None and isinstance(self.mutation_log.json_ext, dict):
+            return self.mutation_log.json_ext
+        return {}
+
+    @property
+    def remaining(self):
+        return len(self.uuids) - self.position
+
+    def chunks(self):
+        """
+        Yields the uuids not processed yet, chunk_size at a time. The chunks move on whether or not they are
+        checkpointed: a chunk that is not checkpointed is run again by the next run of the batch.
+        """
+        for start in range(self.position, len(self.uuids), self.chunk_size):
+            yield self.uuids[start:start + self.chunk_size]
+
+    def checkpoint(self, chunk, found_uuids, failed):
+        """
+        Marks the chunk as processed and saves the progress
+        :param found_uuids: uuids of the chunk matching a claim (in any case)
+        :param failed: number of claims of the chunk in error
+        """
+        found = {uuid.upper() for uuid in found_uuids}
+        self.position += len(chunk)
+        self.done += len(found) - failed
+        self.failed += failed
+        self.not_found += [uuid.upper() for uuid in chunk if uuid.upper() not in found]
+        if self.mutation_log is None:
+            return
+        json_ext = self._json_ext()
+        json_ext[self.KEY] = {
+            "digest": self.digest,
+            "position": self.position,
+            "done": self.done,
+            "failed": self.failed,
+            "remaining": self.remaining,
+            "not_found": self.not_found,
+        }
+        self.mutation_log.json_ext = json_ext
+        self.mutation_log.save(update_fields=["json_ext"])
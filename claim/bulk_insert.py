@@ -0,0 +1,93 @@
+import io
+import json
+import logging
+
+from django.db import connection, models, transaction
+
+from .models import Claim, ClaimItem, ClaimService
+
+logger = logging.getLogger(__name__)
+
+# rows per bulk_create statement when COPY is not available
+BULK_CREATE_BATCH_SIZE = 1000
+
+
+def _copy_value(field, obj):
+    value = getattr(obj, field.attname)
+    if isinstance(field, models.JSONField):
+        value = json.dumps(value) if value is not None else None
+    else:
+        value = field.get_db_prep_save(value, connection)
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_insert(model, objs):
+    """
+    Inserts the (unsaved) model instances with PostgreSQL COPY FROM STDIN, in text format. The auto-incremented
+    primary key is left to the database and not set on the instances: read the rows back by another unique field.
+    """
+    meta = model._meta
+    fields = [field for field in meta.concrete_fields if not (field.primary_key and isinstance(
+        field, (models.AutoField, models.BigAutoField, models.SmallAutoField)))]
+    quote = connection.ops.quote_name
+    sql = f"COPY {quote(meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) FROM STDIN"
+    with connection.cursor() as cursor:
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, "copy_expert"):
+            # psycopg2
+            buffer = io.StringIO()
+            for obj in objs:
+                buffer.write("\t".join(_copy_value(field, obj) for field in fields) + "\n")
+            buffer.seek(0)
+            raw_cursor.copy_expert(sql, buffer)
+        else:
+            # psycopg 3
+            with raw_cursor.copy(sql) as copy:
+                for obj in objs:
+                    copy.write("\t".join(_copy_value(field, obj) for field in fields) + "\n")
+
+
+def bulk_insert(model, objs, use_copy=True):
+    """
+    Inserts the (unsaved) model instances with COPY on PostgreSQL and bulk_create on the other databases.
+    Neither sets the primary keys on all the databases, so the rows have to be read back by another unique field.
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+    if use_copy and connection.vendor == "postgresql":
+        copy_insert(model, objs)
+    else:
+        model.objects.bulk_create(objs, batch_size=BULK_CREATE_BATCH_SIZE)
+    return len(objs)
+
+
+def bulk_insert_claims(claims, details, use_copy=True):
+    """
+    Inserts new claims and their items and services in one transaction: the claims are read back by uuid to set the
+    claim_id of their details.
+    :param claims: list of unsaved claims, with their uuid set
+    :param details: list, parallel to claims, of the lists of unsaved ClaimItem/ClaimService of each claim
+    """
+    with transaction.atomic():
+        bulk_insert(Claim, claims, use_copy)
+        uuids = [claim.uuid for claim in claims]
+        # one IN per batch, within the parameter limit of the database (2100 on MSSQL)
+        batch_size = max(1, connection.ops.bulk_batch_size(["uuid"], uuids))
+        claim_ids = {}
+        for start in range(0, len(uuids), batch_size):
+            claim_ids.update(Claim.objects
+                             .filter(uuid__in=uuids[start:start + batch_size])
+                             .values_list("uuid", "id"))
+        items, services = [], []
+        for claim, claim_details in zip(claims, details):
+            claim.id = claim_ids[claim.uuid]
+            for detail in claim_details:
+                detail.claim_id = claim.id
+                (items if isinstance(detail, ClaimItem) else services).append(detail)
+        bulk_insert(ClaimItem, items, use_copy)
+        bulk_insert(ClaimService, services, use_copy)
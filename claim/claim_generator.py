@@ -0,0 +1,401 @@
+import datetime
+import logging
+import math
+import multiprocessing
+import random
+import string
+import uuid
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from core.utils import filter_validity
+from django.db import connections
+from insuree.models import Insuree, InsureePolicy
+from location.models import HealthFacility
+from medical.models import Diagnosis, Item, Service
+from medical_pricelist.models import ItemsPricelist, ItemsPricelistDetail, ServicesPricelist, \
+    ServicesPricelistDetail
+from policy.models import Policy
+from product.models import Product
+
+from .bulk_insert import bulk_insert, bulk_insert_claims
+from .models import Claim, ClaimAdmin, ClaimDetail, ClaimItem, ClaimService
+
+logger = logging.getLogger(__name__)
+
+# visit type -> share of the claims
+VISIT_TYPES = {"O": 0.75, "R": 0.15, "E": 0.10}
+# share of the claims for a hospital stay, ending after they start
+HOSPITAL_STAY_SHARE = 0.08
+HOSPITAL_STAY_MEAN_DAYS = 4
+HOSPITAL_STAY_MAX_DAYS = 60
+# days between the end of the care and the claim
+CLAIM_DELAY_MAX_DAYS = 14
+# share of the claims made at the health facility of the insuree, the others going to any (popular) facility
+HOME_HEALTH_FACILITY_SHARE = 0.8
+# mean quantity of an item (services are claimed once)
+ITEM_QTY_MEAN = 3
+# exponent of the Zipf distributions of the insurees, health facilities, diagnoses, items and services:
+# a few insurees visit often and a few drugs make most of the items, while most are rarely claimed
+ZIPF_EXPONENT = 0.8
+# share of the generated price list lines that overrule the price of their item or service, by up to 20%
+PRICE_OVERRULE_SHARE = 0.1
+CODE_ALPHABET = string.digits + string.ascii_uppercase
+# longest seed, so that the claim codes of up to 99 shards of 60M claims stay within the default
+# max_claim_length of 20 characters
+MAX_SEED_LENGTH = 8
+
+
+def zipf_index(rng, size, exponent=ZIPF_EXPONENT):
+    """
+    Index in [0, size) drawn from a continuous Zipf distribution, 0 being the most frequent, in constant time and
+    memory (no cumulative weights over millions of insurees)
+    """
+    power = 1 - exponent
+    rank = ((size ** power - 1) * rng.random() + 1) ** (1 / power)
+    return min(int(rank) - 1, size - 1)
+
+
+class ClaimGenerator:
+    """
+    Generates entered claims for performance testing. Everything is drawn from random generators seeded with the
+    seed (and the shard number when sharded), so that a seed gives the same claims again on the same database:
+    use another seed to add claims to a database.
+    The insurees, health facilities, diagnoses and claimed elements follow Zipf distributions, the insurees mostly
+    visiting the health facility they are attached to. The items and services are those of the price list of the
+    health facility, at its price. Optionally, the health facilities without price list and the insurees without
+    policy over the period get generated ones first, so that the claims can be submitted and valuated.
+    """
+
+    def __init__(self, seed=0, date_from=None, date_to=None, nb_insurees=None, audit_user_id=-1, use_copy=True):
+        """
+        :param date_from: first day of care of the claims, a year before date_to by default
+        :param date_to: last day of care of the claims, today by default
+        :param nb_insurees: size of the random pool of insurees making the claims, all the insurees by default
+        """
+        if len(str(seed)) > MAX_SEED_LENGTH:
+            raise ValueError(f"The seed {seed} is longer than {MAX_SEED_LENGTH} characters")
+        self.seed = seed
+        self.rng = random.Random(f"{seed}")
+        self.date_to = date_to or datetime.date.today()
+        self.date_from = date_from or self.date_to - datetime.timedelta(days=365)
+        if self.date_from > self.date_to:
+            raise ValueError(f"The period starts ({self.date_from}) after it ends ({self.date_to})")
+        self.audit_user_id = audit_user_id
+        self.use_copy = use_copy
+        # an array of ids takes 8 bytes per insuree, where a list of ints takes 36
+        self.insurees = array("q", Insuree.objects
+                              .filter(*filter_validity())
+                              .order_by("id")
+                              .values_list("id", flat=True)
+                              .iterator(chunk_size=10000))
+        if not self.insurees:
+            raise ValueError("No insuree to generate claims for")
+        self.rng.shuffle(self.insurees)
+        if nb_insurees:
+            self.insurees = self.insurees[:nb_insurees]
+        self.health_facilities = None
+
+    @property
+    def validity_from(self):
+        """
+        validity_from of the generated price lists and policies, so that they apply to all the claims of the period
+        """
+        return datetime.datetime.combine(self.date_from, datetime.time())
+
+    def generate_price_lists(self):
+        """
+        Gives the health facilities without items (services) price list a generated one per district, with all the
+        current items (services), PRICE_OVERRULE_SHARE of them at an overruled price.
+        :return: number of price lists created
+        """
+        created = 0
+        for pricelist_model, detail_model, element_model, pricelist_field, element_field in (
+                (ItemsPricelist, ItemsPricelistDetail, Item, "items_pricelist", "item"),
+                (ServicesPricelist, ServicesPricelistDetail, Service, "services_pricelist", "service")):
+            elements = list(element_model.objects.filter(*filter_validity()).order_by("id").values_list("id", "price"))
+            districts = defaultdict(list)
+            for hf_id, location_id, location_code in HealthFacility.objects \
+                    .filter(*filter_validity(), **{f"{pricelist_field}__isnull": True}) \
+                    .order_by("id") \
+                    .values_list("id", "location_id", "location__code"):
+                districts[(location_id, location_code)].append(hf_id)
+            for (location_id, location_code), hf_ids in sorted(districts.items()):
+                pricelist = pricelist_model.objects.create(
+                    name=f"Generated {location_code}",
+                    location_id=location_id,
+                    pricelist_date=self.date_from,
+                    validity_from=self.validity_from,
+                    audit_user_id=self.audit_user_id,
+                )
+                bulk_insert(detail_model, [
+                    detail_model(**{f"{pricelist_field}_id": pricelist.id, f"{element_field}_id": element_id},
+                                 price_overrule=self._price_overrule(price),
+                                 validity_from=self.validity_from,
+                                 audit_user_id=self.audit_user_id)
+                    for element_id, price in elements], self.use_copy)
+                HealthFacility.objects.filter(id__in=hf_ids).update(**{f"{pricelist_field}_id": pricelist.id})
+                created += 1
+                logger.info("Generated %s %s for %s health facilities of %s",
+                            pricelist_model.__name__, pricelist.id, len(hf_ids), location_code)
+        return created
+
+    def _price_overrule(self, price):
+        if price is None or self.rng.random() >= PRICE_OVERRULE_SHARE:
+            return None
+        return (price * Decimal(self.rng.uniform(0.8, 1.2))).quantize(Decimal("0.01"))
+
+    def generate_policies(self, batch_size=1000):
+        """
+        Gives the families of the insurees of the pool that have no active policy over the whole period a policy
+        over it, of a random product covering it, and links all their members to it.
+        :return: number of policies created
+        """
+        products = list(Product.objects
+                        .filter(*filter_validity(), date_from__lte=self.date_from, date_to__gte=self.date_to)
+                        .order_by("id")
+                        .values_list("id", "lump_sum"))
+        if not products:
+            raise ValueError(f"No product covering {self.date_from} - {self.date_to} to generate policies of")
+        covered_families = Policy.objects \
+            .filter(*filter_validity(), status=Policy.STATUS_ACTIVE,
+                    effective_date__lte=self.date_from, expiry_date__gte=self.date_to) \
+            .values("family_id")
+        pool = sorted(self.insurees)
+        family_ids = set()
+        for start in range(0, len(pool), batch_size):
+            family_ids.update(Insuree.objects
+                              .filter(*filter_validity(), id__in=pool[start:start + batch_size],
+                                      family_id__isnull=False)
+                              .exclude(family_id__in=covered_families)
+                              .values_list("family_id", flat=True))
+        family_ids = sorted(family_ids)
+        for start in range(0, len(family_ids), batch_size):
+            policies = {}
+            for family_id in family_ids[start:start + batch_size]:
+                product_id, lump_sum = self.rng.choice(products)
+                policies[family_id] = Policy(
+                    uuid=str(uuid.UUID(int=self.rng.getrandbits(128), version=4)),
+                    family_id=family_id,
+                    product_id=product_id,
+                    status=Policy.STATUS_ACTIVE,
+                    stage=Policy.STAGE_NEW,
+                    enroll_date=self.date_from,
+                    start_date=self.date_from,
+                    effective_date=self.date_from,
+                    expiry_date=self.date_to,
+                    value=lump_sum,
+                    validity_from=self.validity_from,
+                    audit_user_id=self.audit_user_id,
+                )
+            bulk_insert(Policy, policies.values(), self.use_copy)
+            policy_ids = dict(Policy.objects
+                              .filter(uuid__in=[policy.uuid for policy in policies.values()])
+                              .values_list("uuid", "id"))
+            bulk_insert(InsureePolicy, [
+                InsureePolicy(
+                    insuree_id=insuree_id,
+                    policy_id=policy_ids[policies[family_id].uuid],
+                    enrollment_date=self.date_from,
+                    start_date=self.date_from,
+                    effective_date=self.date_from,
+                    expiry_date=self.date_to,
+                    validity_from=self.validity_from,
+                    audit_user_id=self.audit_user_id,
+                )
+                for family_id, insuree_id in Insuree.objects
+                .filter(*filter_validity(), family_id__in=policies.keys())
+                .order_by("id")
+                .values_list("family_id", "id")], self.use_copy)
+            logger.info("Generated %s/%s policies", start + len(policies), len(family_ids))
+        return len(family_ids)
+
+    def load(self):
+        """
+        Loads the reference data the claims are drawn from, after generating the price lists and policies
+        """
+        # a generator of its own, so that the claims do not depend on the generated price lists and policies
+        rng = random.Random(f"{self.seed}-load")
+        self.health_facilities = list(HealthFacility.objects
+                                      .filter(*filter_validity())
+                                      .order_by("id")
+                                      .values_list("id", "items_pricelist_id", "services_pricelist_id"))
+        if not self.health_facilities:
+            raise ValueError("No health facility to generate claims for")
+        rng.shuffle(self.health_facilities)
+        self.diagnoses = list(Diagnosis.objects.filter(*filter_validity()).order_by("id").values_list("id", flat=True))
+        if not self.diagnoses:
+            raise ValueError("No diagnosis to generate claims with")
+        rng.shuffle(self.diagnoses)
+        self.claim_admins = defaultdict(list)
+        for hf_id, admin_id in ClaimAdmin.objects \
+                .filter(*filter_validity(), health_facility_id__isnull=False) \
+                .order_by("id") \
+                .values_list("health_facility_id", "id"):
+            self.claim_admins[hf_id].append(admin_id)
+        self.items = self._pricelist_elements(rng, Item, ItemsPricelistDetail, "items_pricelist", "item")
+        self.services = self._pricelist_elements(rng, Service, ServicesPricelistDetail, "services_pricelist",
+                                                 "service")
+
+    @staticmethod
+    def _pricelist_elements(rng, element_model, detail_model, pricelist_field, element_field):
+        """
+        pricelist_id -> shuffled list of the (element id, price) of the price list, None -> all the current elements
+        """
+        prices = dict(element_model.objects.filter(*filter_validity()).order_by("id").values_list("id", "price"))
+        elements = {None: list(prices.items())}
+        for pricelist_id, element_id, price_overrule in detail_model.objects \
+                .filter(*filter_validity(), **{f"{pricelist_field}__validity_to__isnull": True,
+                                               f"{element_field}_id__in": list(prices)}) \
+                .order_by(f"{pricelist_field}_id", f"{element_field}_id") \
+                .values_list(f"{pricelist_field}_id", f"{element_field}_id", "price_overrule"):
+            elements.setdefault(pricelist_id, []).append((element_id, price_overrule or prices[element_id]))
+        for pricelist_elements in elements.values():
+            rng.shuffle(pricelist_elements)
+        return elements
+
+    def generate(self, shard, nb_claims, nb_services, nb_items, batch_size=1000):
+        """
+        Generates and inserts the claims of a shard, batch_size per transaction
+        :param nb_services: mean number of services per claim, with 10% randomness
+        :param nb_items: mean number of items per claim, with 10% randomness
+        :return: number of claims generated
+        """
+        if self.health_facilities is None:
+            self.load()
+        rng = random.Random(f"{self.seed}-{shard}")
+        claims, details = [], []
+        generated = 0
+        for sequence in range(nb_claims):
+            claim, claim_details = self.build_claim(rng, nb_services, nb_items, shard, sequence)
+            claims.append(claim)
+            details.append(claim_details)
+            if len(claims) >= batch_size:
+                generated += self._insert(shard, claims, details)
+                claims, details = [], []
+        if claims:
+            generated += self._insert(shard, claims, details)
+        return generated
+
+    def _insert(self, shard, claims, details):
+        bulk_insert_claims(claims, details, self.use_copy)
+        logger.info("Shard %s: inserted %s claims with %s details",
+                    shard, len(claims), sum(len(claim_details) for claim_details in details))
+        return len(claims)
+
+    def claim_code(self, shard, sequence):
+        """
+        Code of the sequence-th claim of the shard, unique for the seed: G<seed>-<shard>-<sequence in base 36>
+        """
+        digits = ""
+        while True:
+            sequence, digit = divmod(sequence, len(CODE_ALPHABET))
+            digits = CODE_ALPHABET[digit] + digits
+            if not sequence:
+                break
+        return f"G{self.seed}-{shard}-{digits}"
+
+    def build_claim(self, rng, nb_services, nb_items, shard=0, sequence=0):
+        """
+        :return: (unsaved claim, list of its unsaved items and services)
+        """
+        insuree_index = zipf_index(rng, len(self.insurees))
+        if rng.random() < HOME_HEALTH_FACILITY_SHARE:
+            # the pool is shuffled, so a multiplicative hash of the index attaches the insuree to a facility
+            health_facility = self.health_facilities[insuree_index * 2654435761 % len(self.health_facilities)]
+        else:
+            health_facility = self.health_facilities[zipf_index(rng, len(self.health_facilities))]
+        hf_id, items_pricelist_id, services_pricelist_id = health_facility
+        date_from = self.date_from + datetime.timedelta(days=rng.randrange((self.date_to - self.date_from).days + 1))
+        date_to = date_from
+        if rng.random() < HOSPITAL_STAY_SHARE:
+            date_to += datetime.timedelta(
+                days=min(1 + int(rng.expovariate(1 / HOSPITAL_STAY_MEAN_DAYS)), HOSPITAL_STAY_MAX_DAYS))
+        claim_admins = self.claim_admins.get(hf_id)
+        claim = Claim(
+            uuid=str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            code=self.claim_code(shard, sequence),
+            insuree_id=self.insurees[insuree_index],
+            health_facility_id=hf_id,
+            icd_id=self.diagnoses[zipf_index(rng, len(self.diagnoses))],
+            admin_id=rng.choice(claim_admins) if claim_admins else None,
+            date_from=date_from,
+            date_to=date_to,
+            date_claimed=date_to + datetime.timedelta(days=rng.randint(0, CLAIM_DELAY_MAX_DAYS)),
+            visit_type=rng.choices(list(VISIT_TYPES.keys()), weights=list(VISIT_TYPES.values()))[0],
+            status=Claim.STATUS_ENTERED,
+            audit_user_id=self.audit_user_id,
+        )
+        claim_details = [
+            ClaimItem(item_id=item_id,
+                      qty_provided=Decimal(1 + int(rng.expovariate(1 / (ITEM_QTY_MEAN - 1)))),
+                      price_asked=price,
+                      availability=True,
+                      status=ClaimDetail.STATUS_PASSED,
+                      audit_user_id=self.audit_user_id)
+            for item_id, price in self._pick(rng, self.items.get(items_pricelist_id) or self.items[None], nb_items)
+        ] + [
+            ClaimService(service_id=service_id,
+                         qty_provided=Decimal(1),
+                         price_asked=price,
+                         status=ClaimDetail.STATUS_PASSED,
+                         audit_user_id=self.audit_user_id)
+            for service_id, price in self._pick(rng, self.services.get(services_pricelist_id) or self.services[None],
+                                                nb_services)
+        ]
+        claim.claimed = sum(detail.qty_provided * detail.price_asked for detail in claim_details)
+        return claim, claim_details
+
+    @staticmethod
+    def _pick(rng, elements, mean_count):
+        """
+        About mean_count (+/- 10%) distinct elements, Zipf distributed
+        """
+        if not mean_count or not elements:
+            return []
+        count = min(rng.randint(math.floor(mean_count * 0.9), math.ceil(mean_count * 1.1)), len(elements))
+        picked = {}
+        for _ in range(count * 10):
+            if len(picked) >= count:
+                break
+            index = zipf_index(rng, len(elements))
+            picked[index] = elements[index]
+        if len(picked) < count:
+            # the tail of the distribution is slow to reach: complete uniformly
+            missing = [index for index in range(len(elements)) if index not in picked]
+            picked.update((index, elements[index]) for index in rng.sample(missing, count - len(picked)))
+        return list(picked.values())
+
+
+# generator of the parent process, inherited by the forked shard processes without being pickled
+_shard_generator = None
+
+
+def _generate_shard(shard, nb_claims, nb_services, nb_items, batch_size):
+    return _shard_generator.generate(shard, nb_claims, nb_services, nb_items, batch_size)
+
+
+def generate_claims_sharded(generator, nb_claims, nb_services, nb_items, workers=1, batch_size=1000):
+    """
+    Generates the claims in workers forked processes, each inserting its shard of the claims with its own connection
+    and random generator: the same seed and number of workers give the same claims.
+    :return: number of claims generated
+    """
+    global _shard_generator
+    workers = max(1, workers)
+    sizes = [nb_claims // workers + (1 if shard < nb_claims % workers else 0) for shard in range(workers)]
+    if workers == 1:
+        return generator.generate(0, nb_claims, nb_services, nb_items, batch_size)
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise ValueError("Generating claims in several processes needs the fork start method")
+    if generator.health_facilities is None:
+        generator.load()
+    _shard_generator = generator
+    # the forked processes must not share the connection of the parent
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(_generate_shard, shard, size, nb_services, nb_items, batch_size)
+                   for shard, size in enumerate(sizes) if size]
+        return sum(future.result() for future in futures)
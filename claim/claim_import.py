@@ -0,0 +1,213 @@
+import csv
+import datetime
+import json
+import logging
+import uuid
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+
+from core.utils import filter_validity
+from insuree.models import Insuree
+from location.models import HealthFacility
+from medical.models import Diagnosis, Item, Service
+
+from .bulk_insert import bulk_insert_claims
+from .models import Claim, ClaimAdmin, ClaimDetail, ClaimItem, ClaimService
+
+logger = logging.getLogger(__name__)
+
+# columns of the CSV files: one row per item or service, the rows of a claim following each other
+CSV_CLAIM_COLUMNS = ["code", "insuree_chf_id", "health_facility_code", "icd_code", "date_from", "date_to",
+                     "date_claimed", "visit_type", "claim_admin_code", "explanation"]
+CSV_LINE_COLUMNS = ["line_type", "line_code", "qty", "price"]
+# text fields of the record copied as they are into the claim, checked against the length of their column
+CLAIM_TEXT_FIELDS = ["code", "visit_type", "explanation"]
+
+
+def read_jsonl_claims(stream):
+    """
+    Claims of a JSON-lines file, one claim per line with its "items" and "services" lists of {code, qty, price}
+    :return: iterator of (line number, claim record or None, error or None)
+    """
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield line_number, None, f"Invalid JSON: {exc}"
+            continue
+        if isinstance(record, dict):
+            yield line_number, record, None
+        else:
+            yield line_number, record, "The line is not a JSON object"
+
+
+def read_csv_claims(stream):
+    """
+    Claims of a CSV file with the CSV_CLAIM_COLUMNS and CSV_LINE_COLUMNS, grouped by consecutive claim code
+    :return: iterator of (line number of the first row, claim record, None)
+    """
+    reader = csv.DictReader(stream)
+    for code, rows in groupby(enumerate(reader, 2), key=lambda numbered_row: numbered_row[1].get("code")):
+        rows = list(rows)
+        first_line, first_row = rows[0]
+        record = {column: first_row.get(column) or None for column in CSV_CLAIM_COLUMNS}
+        record["items"] = []
+        record["services"] = []
+        for _, row in rows:
+            if not row.get("line_code"):
+                continue
+            key = "services" if (row.get("line_type") or "").lower().startswith("s") else "items"
+            record[key].append({"code": row["line_code"], "qty": row.get("qty"), "price": row.get("price")})
+        yield first_line, record, None
+
+
+class ClaimImporter:
+    """
+    Imports entered claims in batches: the codes of a batch are resolved with in-memory lookup tables (health
+    facilities, diagnoses, claim admins, items and services loaded once, insurees per batch) and the claims then their
+    details are inserted with bulk_insert (COPY on PostgreSQL). The records that cannot be imported are returned with
+    their errors instead.
+    """
+
+    def __init__(self, audit_user_id=-1, use_copy=True):
+        self.audit_user_id = audit_user_id
+        self.use_copy = use_copy
+        self.health_facilities = self._codes(HealthFacility)
+        self.diagnoses = self._codes(Diagnosis)
+        self.claim_admins = self._codes(ClaimAdmin)
+        self.items = self._codes(Item, "price")
+        self.services = self._codes(Service, "price")
+
+    @staticmethod
+    def _codes(model, *fields):
+        """
+        code -> id (or (id, *fields)) of the current records
+        """
+        lookup = {}
+        for row in model.objects.filter(*filter_validity()).order_by("id").values_list("code", "id", *fields):
+            lookup.setdefault(row[0], row[1] if not fields else row[1:])
+        return lookup
+
+    def import_batch(self, records):
+        """
+        :param records: list of (line number, claim record)
+        :return: (list of imported claim uuids, list of (line number, record, errors))
+        """
+        insurees = dict(Insuree.objects
+                        .filter(*filter_validity(),
+                                chf_id__in={record.get("insuree_chf_id") for _, record in records})
+                        .values_list("chf_id", "id"))
+        existing_codes = set(Claim.objects
+                             .filter(*filter_validity(), code__in={record.get("code") for _, record in records})
+                             .values_list("code", flat=True))
+        rejected = []
+        claims, details = [], []
+        for line_number, record in records:
+            errors = []
+            claim = self._build_claim(record, insurees, existing_codes, errors)
+            claim_details = [self._build_detail(ClaimItem, self.items, "item_id", line, errors)
+                             for line in self._lines(record, "items", errors)] + \
+                            [self._build_detail(ClaimService, self.services, "service_id", line, errors)
+                             for line in self._lines(record, "services", errors)]
+            if not claim_details:
+                errors.append("The claim has no item or service")
+            if errors:
+                rejected.append((line_number, record, errors))
+                continue
+            existing_codes.add(claim.code)
+            claim.claimed = sum(detail.qty_provided * detail.price_asked for detail in claim_details)
+            claims.append(claim)
+            details.append(claim_details)
+
+        bulk_insert_claims(claims, details, self.use_copy)
+        return [claim.uuid for claim in claims], rejected
+
+    def _build_claim(self, record, insurees, existing_codes, errors):
+        code = record.get("code")
+        if not code:
+            errors.append("Missing claim code")
+        elif code in existing_codes:
+            errors.append(f"Claim code {code} already exists")
+        references = {}
+        for key, lookup, field, required in (
+                ("insuree_chf_id", insurees, "insuree_id", True),
+                ("health_facility_code", self.health_facilities, "health_facility_id", True),
+                ("icd_code", self.diagnoses, "icd_id", True),
+                ("claim_admin_code", self.claim_admins, "admin_id", False)):
+            value = record.get(key)
+            if value in lookup:
+                references[field] = lookup[value]
+            elif value or required:
+                errors.append(f"Unknown {key} {value}")
+        for field in CLAIM_TEXT_FIELDS:
+            max_length = Claim._meta.get_field(field).max_length
+            value = record.get(field)
+            if max_length and value and len(str(value)) > max_length:
+                errors.append(f"{field} longer than {max_length} characters")
+        date_from = self._parse_date(record, "date_from", errors, required=True)
+        date_to = self._parse_date(record, "date_to", errors)
+        date_claimed = self._parse_date(record, "date_claimed", errors)
+        return Claim(
+            uuid=str(uuid.uuid4()),
+            code=code,
+            date_from=date_from,
+            date_to=date_to,
+            date_claimed=date_claimed or date_from,
+            visit_type=record.get("visit_type") or None,
+            explanation=record.get("explanation") or None,
+            status=Claim.STATUS_ENTERED,
+            audit_user_id=self.audit_user_id,
+            **references,
+        )
+
+    @staticmethod
+    def _parse_date(record, key, errors, required=False):
+        """
+        ISO date of the record, None (with an error if required) when missing or invalid
+        """
+        value = record.get(key)
+        if not value:
+            if required:
+                errors.append(f"Missing {key}")
+            return None
+        try:
+            return datetime.date.fromisoformat(str(value))
+        except ValueError:
+            errors.append(f"Invalid {key} {value}")
+            return None
+
+    @staticmethod
+    def _lines(record, key, errors):
+        """
+        Items or services of the record, the lines that are not objects being left out with an error
+        """
+        lines = record.get(key) or []
+        if not isinstance(lines, list):
+            errors.append(f"{key} is not a list")
+            return []
+        for index, line in enumerate(lines):
+            if not isinstance(line, dict):
+                errors.append(f"{key}[{index}] is not an object")
+        return [line for line in lines if isinstance(line, dict)]
+
+    def _build_detail(self, model, lookup, elt_field, line, errors):
+        element = lookup.get(line.get("code"))
+        if element is None:
+            errors.append(f"Unknown {elt_field[:-3]} code {line.get('code')}")
+            return None
+        try:
+            qty = Decimal(str(line["qty"])) if line.get("qty") not in (None, "") else Decimal(1)
+            price = Decimal(str(line["price"])) if line.get("price") not in (None, "") else element[1]
+        except InvalidOperation:
+            qty = price = None
+        if qty is None or not qty.is_finite() or qty <= 0 \
+                or price is None or not Decimal(price).is_finite() or price < 0:
+            errors.append(f"Invalid quantity or price for {elt_field[:-3]} {line.get('code')}")
+            return None
+        detail = model(**{elt_field: element[0]}, qty_provided=qty, price_asked=price,
+                       status=ClaimDetail.STATUS_PASSED, audit_user_id=self.audit_user_id)
+        if model == ClaimItem:
+            detail.availability = True
+        return detail
@@ -0,0 +1,87 @@
+from collections import defaultdict
+
+from django.db.models import Count
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from .models import ClaimAttachment, ClaimItem, ClaimMutation, ClaimService
+
+
+class ClaimItemsLoader(DataLoader):
+    """
+    claim id -> current items of the claim, in one query per page of claims
+    """
+
+    def batch_load_fn(self, claim_ids):
+        items = defaultdict(list)
+        for item in ClaimItem.objects \
+                .filter(claim_id__in=claim_ids, legacy_id__isnull=True, validity_to__isnull=True) \
+                .order_by("id"):
+            items[item.claim_id].append(item)
+        return Promise.resolve([items[claim_id] for claim_id in claim_ids])
+
+
+class ClaimServicesLoader(DataLoader):
+    """
+    claim id -> current services of the claim, in one query per page of claims
+    """
+
+    def batch_load_fn(self, claim_ids):
+        services = defaultdict(list)
+        for service in ClaimService.objects \
+                .filter(claim_id__in=claim_ids, legacy_id__isnull=True, validity_to__isnull=True) \
+                .order_by("id"):
+            services[service.claim_id].append(service)
+        return Promise.resolve([services[claim_id] for claim_id in claim_ids])
+
+
+class ClaimAttachmentsCountLoader(DataLoader):
+    """
+    claim id -> number of current attachments of the claim, in one grouped query per page of claims
+    """
+
+    def batch_load_fn(self, claim_ids):
+        counts = dict(ClaimAttachment.objects
+                      .filter(claim_id__in=claim_ids, legacy_id__isnull=True, validity_to__isnull=True)
+                      .order_by()
+                      .values("claim_id")
+                      .annotate(count=Count("id"))
+                      .values_list("claim_id", "count"))
+        return Promise.resolve([counts.get(claim_id, 0) for claim_id in claim_ids])
+
+
+class ClaimClientMutationIdLoader(DataLoader):
+    """
+    claim id -> client_mutation_id of the first pending (status 0) mutation of the claim, None if there is none
+    """
+
+    def batch_load_fn(self, claim_ids):
+        client_mutation_ids = {}
+        for claim_id, client_mutation_id in ClaimMutation.objects \
+                .filter(claim_id__in=claim_ids, mutation__status=0) \
+                .order_by("id") \
+                .values_list("claim_id", "mutation__client_mutation_id"):
+            client_mutation_ids.setdefault(claim_id, client_mutation_id)
+        return Promise.resolve([client_mutation_ids.get(claim_id) for claim_id in claim_ids])
+
+
+# name in the request context dataloaders -> loader class
+CLAIM_DATALOADERS = {
+    "claim_items_loader": ClaimItemsLoader,
+    "claim_services_loader": ClaimServicesLoader,
+    "claim_attachments_count_loader": ClaimAttachmentsCountLoader,
+    "claim_client_mutation_id_loader": ClaimClientMutationIdLoader,
+}
+
+
+def get_claim_dataloader(info, name):
+    """
+    Loader of the request, created on first use in info.context.dataloaders so that it batches the claims of the
+    whole request (and caches nothing beyond it). None when the context has no dataloaders.
+    """
+    dataloaders = getattr(info.context, "dataloaders", None)
+    if dataloaders is None:
+        return None
+    if name not in dataloaders:
+        dataloaders[name] = CLAIM_DATALOADERS[name]()
+    return dataloaders[name]
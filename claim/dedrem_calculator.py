@@ -0,0 +1,179 @@
+from collections import namedtuple
+
+from medical.models import Service
+from product.models import Product, ProductItemOrService
+
+# Deductible and ceiling arithmetic of process_dedrem. Nothing here reads or writes the database: the functions
+# work on products (or any object with the same limit attributes), plain detail records and previous totals.
+
+Deductible = namedtuple('Deductible', ['amount', 'type', 'prev'])
+
+ValuationDetail = namedtuple('ValuationDetail', [
+    'quantity', 'price_adjusted', 'limitation', 'limitation_value', 'ceiling_exclusion_adult',
+    'ceiling_exclusion_child'])
+
+DetailValuation = namedtuple('DetailValuation', [
+    'price_adjusted', 'price_deducted', 'price_valuated', 'price_remunerated', 'exceed_ceiling_amount',
+    'exceed_ceiling_amount_category'])
+
+# claim category -> (product maximum amount, ClaimDedRem remunerated field)
+CATEGORY_LIMITS = {
+    Service.CATEGORY_SURGERY: ("max_amount_surgery", "rem_surgery"),
+    Service.CATEGORY_DELIVERY: ("max_amount_delivery", "rem_delivery"),
+    Service.CATEGORY_ANTENATAL: ("max_amount_antenatal", "rem_antenatal"),
+    Service.CATEGORY_HOSPITALIZATION: ("max_amount_hospitalization", "rem_hospitalization"),
+    Service.CATEGORY_CONSULTATION: ("max_amount_consultation", "rem_consult"),
+}
+
+
+def is_in_patient(ceiling_interpretation, hospitalization, hf_level):
+    """
+    Whether the in-patient (rather than out-patient) deductibles and ceilings apply
+    """
+    return (ceiling_interpretation == Product.CEILING_INTERPRETATION_IN_PATIENT and hospitalization) \
+        or (ceiling_interpretation == Product.CEILING_INTERPRETATION_HOSPITAL and hf_level == "H")
+
+
+def get_dedrem_limit(prefix, dedrem_type, field, product, previous_insuree, previous_policy):
+    """
+    Deductible or ceiling of the product by treatment, insuree or policy, in that order of precedence
+    :param prefix: ded, max, ded_ip, ded_op, max_ip or max_op
+    :param field: ClaimDedRem field holding the previous amounts
+    :param previous_insuree: ClaimDedRem field -> total of the insuree in the policy, without the current claim
+    :param previous_policy: ClaimDedRem field -> total of the policy, without the current claim
+    """
+    if getattr(product, prefix + "_treatment", None):
+        return Deductible(getattr(product, prefix + "_treatment"), dedrem_type, 0)
+    if getattr(product, prefix + "_insuree", None):
+        return Deductible(getattr(product, prefix + "_insuree"), dedrem_type, previous_insuree.get(field) or 0)
+    if getattr(product, prefix + "_policy", None):
+        return Deductible(getattr(product, prefix + "_policy"), dedrem_type, previous_policy.get(field) or 0)
+    return None
+
+
+def _policy_ceiling(ceiling, max_policy, threshold, policy_members, extra_member, max_ceiling):
+    if threshold is not None and policy_members > threshold:
+        if extra_member:
+            ceiling = Deductible(max_policy + (policy_members - threshold) * extra_member, ceiling.type, ceiling.prev)
+        if max_ceiling and ceiling.amount > max_ceiling:
+            ceiling = Deductible(max_ceiling, ceiling.type, ceiling.prev)
+        return ceiling
+    return Deductible(max_policy, ceiling.type, ceiling.prev)
+
+
+def get_deductible_and_ceiling(product, policy_members, hospitalization, hf_level, previous_insuree,
+                               previous_policy):
+    """
+    General deductible and ceiling of the product, falling back on the in-patient or out-patient ones
+    :return: (deductible, ceiling), each a Deductible or None
+    """
+    in_patient = is_in_patient(product.ceiling_interpretation, hospitalization, hf_level)
+    deductible = get_dedrem_limit("ded", "G", "ded_g", product, previous_insuree, previous_policy)
+    ceiling = get_dedrem_limit("max", "G", "rem_g", product, previous_insuree, previous_policy)
+    if product.max_policy:
+        # Threshold is NOT NULL
+        ceiling = _policy_ceiling(ceiling, product.max_policy, product.threshold, policy_members,
+                                  product.max_policy_extra_member, product.max_ceiling_policy)
+
+    if not deductible:
+        if in_patient:
+            deductible = get_dedrem_limit("ded_ip", "I", "ded_ip", product, previous_insuree, previous_policy)
+        else:
+            deductible = get_dedrem_limit("ded_op", "O", "ded_op", product, previous_insuree, previous_policy)
+
+    if not ceiling:
+        if in_patient:
+            ceiling = get_dedrem_limit("max_ip", "I", "rem_ip", product, previous_insuree, previous_policy)
+            if product.max_ip_policy:
+                ceiling = _policy_ceiling(ceiling, product.max_ip_policy, product.threshold, policy_members,
+                                          product.max_policy_extra_member_ip, product.max_ceiling_policy_ip)
+        else:
+            ceiling = get_dedrem_limit("max_op", "O", "rem_op", product, previous_insuree, previous_policy)
+            if product.max_op_policy:
+                # unlike the general and in-patient ones, the out-patient threshold may be empty or 0
+                ceiling = _policy_ceiling(ceiling, product.max_op_policy, product.threshold or None,
+                                          policy_members, product.max_policy_extra_member_op,
+                                          product.max_ceiling_policy_op)
+    return deductible, ceiling
+
+
+def valuate_details(details, product, deductible, ceiling, category, hospitalization, hf_level, adult):
+    """
+    Applies the limitations, deductible, category maximum and ceiling of the product to the claim details, in order
+    :param details: list of ValuationDetail
+    :return: (list of DetailValuation, dict of the ClaimDedRem totals of the claim: ded_g, rem_g and rem_<category>)
+    """
+    deducted = 0
+    remunerated = 0
+    # The legacy procedure does not carry the category remunerations of the previous claims, they start at 0
+    category_remunerated = {field: 0 for _, field in CATEGORY_LIMITS.values()}
+    in_patient = is_in_patient(product.ceiling_interpretation, hospitalization, hf_level)
+    category_limit = CATEGORY_LIMITS.get(category) if category != Service.CATEGORY_VISIT else None
+    valuations = []
+    for detail in details:
+        price_deducted = 0
+        exceed_ceiling_amount = 0
+        exceed_ceiling_amount_category = 0
+        work_value = int(detail.quantity * detail.price_adjusted)
+
+        if detail.limitation == ProductItemOrService.LIMIT_FIXED_AMOUNT \
+                and detail.limitation_value \
+                and (detail.quantity * detail.limitation_value) < work_value:
+            work_value = detail.quantity * detail.limitation_value
+
+        if deductible and deductible.amount - deductible.prev - deducted > 0:
+            if deductible.amount - deductible.prev - deducted >= work_value:
+                # the legacy procedure deducts the whole value but still valuates it below
+                price_deducted = work_value
+                deducted += work_value
+            else:
+                # partial coverage
+                price_deducted = deductible.amount - deductible.prev - deducted
+                work_value -= price_deducted
+                deducted += price_deducted
+
+        if detail.limitation == ProductItemOrService.LIMIT_CO_INSURANCE and detail.limitation_value:
+            work_value = detail.limitation_value / 100 * work_value
+
+        if category_limit and getattr(product, category_limit[0]):
+            max_amount = getattr(product, category_limit[0])
+            category_total = category_remunerated[category_limit[1]]
+            if work_value + category_total <= max_amount:
+                category_remunerated[category_limit[1]] += work_value
+            elif category_total >= max_amount:
+                exceed_ceiling_amount_category = work_value
+                work_value = 0
+            else:
+                exceed_ceiling_amount_category = work_value + category_total - max_amount
+                work_value -= exceed_ceiling_amount_category
+                category_remunerated[category_limit[1]] += work_value
+
+        ceiling_exclusion = detail.ceiling_exclusion_adult if adult else detail.ceiling_exclusion_child
+        if ceiling_exclusion in (("B", "H") if in_patient else ("B", "N")):
+            # NO CEILING WILL BE AFFECTED, the value is not added to the remunerated amount of the ClaimDedRem
+            price_valuated = work_value
+        elif ceiling and ceiling.amount > 0:
+            available = ceiling.amount - ceiling.prev - remunerated
+            if available <= 0:
+                exceed_ceiling_amount = work_value
+                price_valuated = 0
+            elif available >= work_value:
+                price_valuated = work_value
+                remunerated += work_value
+            else:
+                exceed_ceiling_amount = work_value - available
+                price_valuated = available
+                remunerated += available
+        else:
+            remunerated += work_value
+            price_valuated = work_value
+
+        valuations.append(DetailValuation(
+            price_adjusted=detail.price_adjusted,
+            price_deducted=price_deducted,
+            price_valuated=price_valuated,
+            price_remunerated=price_valuated,
+            exceed_ceiling_amount=exceed_ceiling_amount,
+            exceed_ceiling_amount_category=exceed_ceiling_amount_category,
+        ))
+    return valuations, {"ded_g": deducted, "rem_g": remunerated, **category_remunerated}
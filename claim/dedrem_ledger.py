@@ -0,0 +1,144 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Sum
+from policy.models import Policy
+
+from .apps import ClaimConfig
+from .models import ClaimDedRem, ClaimDedRemLedger
+
+logger = logging.getLogger(__name__)
+
+DEDREM_FIELDS = ["ded_g", "ded_op", "ded_ip", "rem_g", "rem_op", "rem_ip", "rem_consult", "rem_surgery",
+                 "rem_delivery", "rem_hospitalization", "rem_antenatal"]
+
+
+def _lock_policies(policy_ids):
+    """
+    Serializes the ledger initializations and updates of the policies, in the order of their ids to avoid deadlocks.
+    To be called in a transaction.
+    """
+    list(Policy.objects.select_for_update().filter(id__in=policy_ids).order_by("id").values_list("id", flat=True))
+
+
+def _aggregate_dedrems(dedrems):
+    return {field: total or 0
+            for field, total in dedrems.aggregate(**{field: Sum(field) for field in DEDREM_FIELDS}).items()}
+
+
+def get_ledger(policy_id, insuree_id=None):
+    """
+    Running ClaimDedRem totals of the insuree in the policy (of the whole policy if insuree_id is None).
+    Ledgers are initialized from ClaimDedRem the first time they are needed, with the policy locked so that no
+    ClaimDedRem of the policy is created or deleted between the aggregation and the creation of the ledger.
+    """
+    ledger = ClaimDedRemLedger.objects.filter(policy_id=policy_id, insuree_id=insuree_id).first()
+    if ledger is not None:
+        return ledger
+    with transaction.atomic():
+        _lock_policies([policy_id])
+        ledger = ClaimDedRemLedger.objects.filter(policy_id=policy_id, insuree_id=insuree_id).first()
+        if ledger is None:
+            dedrems = ClaimDedRem.objects.filter(policy_id=policy_id)
+            if insuree_id is not None:
+                dedrems = dedrems.filter(insuree_id=insuree_id)
+            ledger = ClaimDedRemLedger.objects.create(policy_id=policy_id, insuree_id=insuree_id,
+                                                      **_aggregate_dedrems(dedrems))
+    return ledger
+
+
+def build_ledgers(policy_ids):
+    """
+    Computes the ledgers of the given policies (one per insuree with ClaimDedRem and one for the whole policy) from
+    ClaimDedRem
+    :return: list of unsaved ClaimDedRemLedger
+    """
+    totals = {field: Sum(field) for field in DEDREM_FIELDS}
+    dedrems = ClaimDedRem.objects.filter(policy_id__in=policy_ids).order_by()
+    ledgers = []
+    for group_by, rows in ((("policy_id", "insuree_id"), dedrems.filter(insuree_id__isnull=False)),
+                           (("policy_id",), dedrems)):
+        for row in rows.values(*group_by).annotate(**totals):
+            ledgers.append(ClaimDedRemLedger(policy_id=row["policy_id"], insuree_id=row.get("insuree_id"),
+                                             **{field: row[field] or 0 for field in DEDREM_FIELDS}))
+    return ledgers
+
+
+def _add_to_ledgers(deltas, dedrem, sign):
+    if dedrem.policy_id is None:
+        return
+    keys = [(dedrem.policy_id, None)]
+    if dedrem.insuree_id is not None:
+        keys.append((dedrem.policy_id, dedrem.insuree_id))
+    for key in keys:
+        for field in DEDREM_FIELDS:
+            deltas[key][field] += sign * (getattr(dedrem, field) or 0)
+
+
+@transaction.atomic
+def replace_claim_dedrems(claim, claim_ded_rem_to_create=None):
+    """
+    Deletes the ClaimDedRem of the claim and creates the new one (if any), updating the ledgers in the same
+    transaction when ClaimConfig.claim_dedrem_ledger_enabled. Ledgers that are not initialized yet are left alone:
+    they will be built from ClaimDedRem.
+    :param claim_ded_rem_to_create: kwargs of the new ClaimDedRem
+    :return: number of deleted ClaimDedRem
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    old_dedrems = list(ClaimDedRem.objects.filter(claim=claim))
+    if ClaimConfig.claim_dedrem_ledger_enabled:
+        policy_ids = {dedrem.policy_id for dedrem in old_dedrems}
+        if claim_ded_rem_to_create:
+            policy = claim_ded_rem_to_create.get("policy")
+            policy_ids.add(policy.id if policy is not None else claim_ded_rem_to_create.get("policy_id"))
+        _lock_policies([policy_id for policy_id in policy_ids if policy_id is not None])
+    for dedrem in old_dedrems:
+        _add_to_ledgers(deltas, dedrem, -1)
+    if old_dedrems:
+        ClaimDedRem.objects.filter(id__in=[dedrem.id for dedrem in old_dedrems]).delete()
+    if claim_ded_rem_to_create:
+        _add_to_ledgers(deltas, ClaimDedRem.objects.create(**claim_ded_rem_to_create), 1)
+    if not ClaimConfig.claim_dedrem_ledger_enabled:
+        return len(old_dedrems)
+    for (policy_id, insuree_id), delta in deltas.items():
+        changes = {field: F(field) + value for field, value in delta.items() if value}
+        if changes:
+            ClaimDedRemLedger.objects.filter(policy_id=policy_id, insuree_id=insuree_id).update(**changes)
+    return len(old_dedrems)
+
+
+class PreviousDedRems:
+    """
+    ClaimDedRem totals of the policies of a claim, without the claim itself, read from the ledgers when
+    ClaimConfig.claim_dedrem_ledger_enabled, aggregated from ClaimDedRem otherwise
+    """
+
+    def __init__(self, claim):
+        self.claim = claim
+        self.claim_dedrems = list(ClaimDedRem.objects.filter(claim_id=claim.id))
+        self.ledgers = {}
+
+    def get(self, field, policy_id, insuree_id=None):
+        """
+        :param insuree_id: None for the totals of all the insurees of the policy
+        """
+        if not ClaimConfig.claim_dedrem_ledger_enabled:
+            return self.totals(policy_id, insuree_id)[field]
+        key = (policy_id, insuree_id)
+        if key not in self.ledgers:
+            self.ledgers[key] = get_ledger(policy_id, insuree_id)
+        own = sum(getattr(dedrem, field) or 0 for dedrem in self.claim_dedrems
+                  if dedrem.policy_id == policy_id and (insuree_id is None or dedrem.insuree_id == insuree_id))
+        return getattr(self.ledgers[key], field) - own
+
+    def totals(self, policy_id, insuree_id=None):
+        """
+        :return: dict ClaimDedRem field -> previous total, as expected by the dedrem calculator
+        """
+        if policy_id is None or not ClaimConfig.claim_dedrem_ledger_enabled:
+            dedrems = ClaimDedRem.objects.filter(policy_id=policy_id).exclude(claim_id=self.claim.id)
+            if insuree_id is not None:
+                dedrems = dedrems.filter(insuree_id=insuree_id)
+            return _aggregate_dedrems(dedrems)
+        return {field: self.get(field, policy_id, insuree_id) for field in DEDREM_FIELDS}
@@ -0,0 +1,180 @@
+import logging
+
+from django.db import connection, transaction
+from django.db.models import BooleanField, Exists, OuterRef, Q
+from django.db.models.expressions import RawSQL
+from medical.models import Item, Service
+
+from .apps import ClaimConfig
+from .models import Claim, ClaimAttachment, ClaimItem, ClaimService
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL text[] column of tblClaim with the codes of the current items ("I:<code>") and services ("S:<code>") of
+# the claim, maintained by triggers on the claim item and service tables once installed
+DETAIL_CODES_COLUMN = "DetailCodes"
+DETAIL_CODES_INDEX = "claim_detail_codes_gin"
+ITEM_CODE_PREFIX = "I:"
+SERVICE_CODE_PREFIX = "S:"
+REFRESH_FUNCTION = "claim_refresh_detail_codes"
+
+
+def detail_codes_enabled():
+    return ClaimConfig.claim_detail_codes_enabled and connection.vendor == "postgresql"
+
+
+def _detail_codes_filter(prefix, codes):
+    return Q(RawSQL(f"{connection.ops.quote_name(Claim._meta.db_table)}."
+                    f"{connection.ops.quote_name(DETAIL_CODES_COLUMN)} && %s::text[]",
+                    ([f"{prefix}{code}" for code in codes],), output_field=BooleanField()))
+
+
+def claim_items_filter(codes):
+    """
+    Claims with a current item of one of the codes: a lookup in the GIN index of DetailCodes when
+    claim_detail_codes_enabled on PostgreSQL, an EXISTS semi-join otherwise (no duplicated claims, no DISTINCT)
+    """
+    if detail_codes_enabled():
+        return _detail_codes_filter(ITEM_CODE_PREFIX, codes)
+    return Q(Exists(ClaimItem.objects.filter(claim_id=OuterRef("id"), validity_to__isnull=True,
+                                             item__code__in=codes)))
+
+
+def claim_services_filter(codes):
+    """
+    Claims with a current service of one of the codes, see claim_items_filter
+    """
+    if detail_codes_enabled():
+        return _detail_codes_filter(SERVICE_CODE_PREFIX, codes)
+    return Q(Exists(ClaimService.objects.filter(claim_id=OuterRef("id"), validity_to__isnull=True,
+                                                service__code__in=codes)))
+
+
+def claim_attachments_filter(with_attachments=True):
+    """
+    Claims with (without) current attachments, as an EXISTS (NOT EXISTS) semi-join
+    """
+    attachments = Exists(ClaimAttachment.objects.filter(claim_id=OuterRef("id"), validity_to__isnull=True))
+    return Q(attachments) if with_attachments else Q(~attachments)
+
+
+def _names():
+    quote = connection.ops.quote_name
+
+    def column(model, field):
+        return quote(model._meta.get_field(field).column)
+
+    return {
+        "claim_table": quote(Claim._meta.db_table),
+        "claim_id": column(Claim, "id"),
+        "codes": quote(DETAIL_CODES_COLUMN),
+        "item_table": quote(ClaimItem._meta.db_table),
+        "item_claim_id": column(ClaimItem, "claim"),
+        "item_item_id": column(ClaimItem, "item"),
+        "item_validity_to": column(ClaimItem, "validity_to"),
+        "items_table": quote(Item._meta.db_table),
+        "items_id": column(Item, "id"),
+        "items_code": column(Item, "code"),
+        "service_table": quote(ClaimService._meta.db_table),
+        "service_claim_id": column(ClaimService, "claim"),
+        "service_service_id": column(ClaimService, "service"),
+        "service_validity_to": column(ClaimService, "validity_to"),
+        "services_table": quote(Service._meta.db_table),
+        "services_id": column(Service, "id"),
+        "services_code": column(Service, "code"),
+    }
+
+
+def install_detail_codes(chunk_size=10000):
+    """
+    Adds the DetailCodes column and its GIN index to tblClaim, the statement triggers maintaining it from the claim
+    items and services (with transition tables, so a COPY or bulk update refreshes each claim once) and fills it,
+    chunk_size claims per transaction. PostgreSQL 10 or more only. Changing the code of an item or service does not
+    refresh the claims: run it again then.
+    """
+    if connection.vendor != "postgresql":
+        raise ValueError("The claim detail codes need PostgreSQL")
+    names = _names()
+    # the transition tables have the columns of the item or service table, whose claim column has the same name
+    claim_id = names["item_claim_id"]
+    trigger_functions = {
+        "claim_detail_codes_from_new": f"SELECT {claim_id} FROM new_rows",
+        "claim_detail_codes_from_old": f"SELECT {claim_id} FROM old_rows",
+        "claim_detail_codes_from_both": f"SELECT {claim_id} FROM new_rows UNION SELECT {claim_id} FROM old_rows",
+    }
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {names['claim_table']} ADD COLUMN IF NOT EXISTS {names['codes']} text[]")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {DETAIL_CODES_INDEX} "
+                       f"ON {names['claim_table']} USING GIN ({names['codes']})")
+        cursor.execute(f"""
+            CREATE OR REPLACE FUNCTION {REFRESH_FUNCTION}(claim_ids integer[]) RETURNS void AS $$
+                UPDATE {names['claim_table']} AS claim SET {names['codes']} = ARRAY(
+                    SELECT '{ITEM_CODE_PREFIX}' || items.{names['items_code']}
+                    FROM {names['item_table']} AS claim_item
+                    INNER JOIN {names['items_table']} AS items
+                        ON items.{names['items_id']} = claim_item.{names['item_item_id']}
+                    WHERE claim_item.{names['item_claim_id']} = claim.{names['claim_id']}
+                        AND claim_item.{names['item_validity_to']} IS NULL
+                    UNION
+                    SELECT '{SERVICE_CODE_PREFIX}' || services.{names['services_code']}
+                    FROM {names['service_table']} AS claim_service
+                    INNER JOIN {names['services_table']} AS services
+                        ON services.{names['services_id']} = claim_service.{names['service_service_id']}
+                    WHERE claim_service.{names['service_claim_id']} = claim.{names['claim_id']}
+                        AND claim_service.{names['service_validity_to']} IS NULL)
+                WHERE claim.{names['claim_id']} = ANY(claim_ids)
+            $$ LANGUAGE sql
+        """)
+        for function, claim_ids in trigger_functions.items():
+            cursor.execute(f"""
+                CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM {REFRESH_FUNCTION}(ARRAY({claim_ids}));
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            """)
+        for prefix, table in (("claim_items", names["item_table"]), ("claim_services", names["service_table"])):
+            for event, referencing, function in (
+                    ("INSERT", "NEW TABLE AS new_rows", "claim_detail_codes_from_new"),
+                    ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows", "claim_detail_codes_from_both"),
+                    ("DELETE", "OLD TABLE AS old_rows", "claim_detail_codes_from_old")):
+                trigger = f"{prefix}_codes_{event.lower()}"
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+                cursor.execute(f"CREATE TRIGGER {trigger} AFTER {event} ON {table} REFERENCING {referencing} "
+                               f"FOR EACH STATEMENT EXECUTE PROCEDURE {function}()")
+    return refresh_detail_codes(chunk_size=chunk_size)
+
+
+def refresh_detail_codes(claim_ids=None, chunk_size=10000):
+    """
+    Recomputes the DetailCodes of the claims (all of them by default), chunk_size claims per transaction
+    :return: number of claims refreshed
+    """
+    if claim_ids is None:
+        claim_ids = Claim.objects.order_by("id").values_list("id", flat=True)
+    claim_ids = list(claim_ids)
+    for start in range(0, len(claim_ids), chunk_size):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"SELECT {REFRESH_FUNCTION}(%s)", [claim_ids[start:start + chunk_size]])
+        logger.info("Refreshed the detail codes of %s/%s claims", min(start + chunk_size, len(claim_ids)),
+                    len(claim_ids))
+    return len(claim_ids)
+
+
+def uninstall_detail_codes():
+    """
+    Drops the triggers, functions, index and column installed by install_detail_codes
+    """
+    if connection.vendor != "postgresql":
+        raise ValueError("The claim detail codes need PostgreSQL")
+    names = _names()
+    with transaction.atomic(), connection.cursor() as cursor:
+        for prefix, table in (("claim_items", names["item_table"]), ("claim_services", names["service_table"])):
+            for event in ("insert", "update", "delete"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {prefix}_codes_{event} ON {table}")
+        for function in ("claim_detail_codes_from_new", "claim_detail_codes_from_old", "claim_detail_codes_from_both"):
+            cursor.execute(f"DROP FUNCTION IF EXISTS {function}()")
+        cursor.execute(f"DROP FUNCTION IF EXISTS {REFRESH_FUNCTION}(integer[])")
+        cursor.execute(f"DROP INDEX IF EXISTS {DETAIL_CODES_INDEX}")
+        cursor.execute(f"ALTER TABLE {names['claim_table']} DROP COLUMN IF EXISTS {names['codes']}")
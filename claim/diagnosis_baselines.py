@@ -0,0 +1,112 @@
+import datetime
+import logging
+
+from core import TimeUtils
+from core.utils import filter_validity
+from django.db import connection, transaction
+from django.db.models import Avg, Count, Exists, F, OuterRef, Q, Subquery
+
+from .apps import ClaimConfig
+from .models import Claim, ClaimDiagnosisBaseline
+
+logger = logging.getLogger(__name__)
+
+
+def _baseline_claims(date_from, icd_codes=None):
+    claims = Claim.objects.filter(*filter_validity(), date_claimed__gt=date_from, icd__isnull=False)
+    if icd_codes is not None:
+        claims = claims.filter(icd__code__in=icd_codes)
+    return claims
+
+
+def _approved_percentiles(claims):
+    """
+    icd code -> (median, 90th percentile) of the approved amounts of the claims, with percentile_cont on PostgreSQL,
+    empty on the other databases
+    """
+    if connection.vendor != "postgresql":
+        return {}
+    sql, params = claims \
+        .filter(approved__isnull=False) \
+        .annotate(baseline_code=F("icd__code"), baseline_approved=F("approved")) \
+        .values("baseline_code", "baseline_approved") \
+        .query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT baseline_code,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY baseline_approved),
+                   percentile_cont(0.9) WITHIN GROUP (ORDER BY baseline_approved)
+            FROM ({sql}) AS baseline_claims
+            GROUP BY baseline_code
+        """, params)
+        return {code: (median, p90) for code, median, p90 in cursor.fetchall()}
+
+
+def refresh_diagnosis_baselines(icd_codes=None, days=None):
+    """
+    Recomputes the ClaimDiagnosisBaseline of the ICD codes (all of them by default) from the claims of the last days
+    (claim_diagnosis_baseline_days by default), in one grouped query. The rolling window moves every day, so schedule
+    a full refresh daily, e.g. in SCHEDULER_JOBS with the method claim.diagnosis_baselines.refresh_diagnosis_baselines,
+    and refresh_changed_diagnosis_baselines in between.
+    :return: number of baselines written
+    """
+    date_from = datetime.date.today() - datetime.timedelta(days=days or ClaimConfig.claim_diagnosis_baseline_days)
+    claims = _baseline_claims(date_from, icd_codes)
+    percentiles = _approved_percentiles(claims)
+    refreshed_at = TimeUtils.now()
+    baselines = [
+        ClaimDiagnosisBaseline(
+            icd_code=stats["icd__code"],
+            avg_approved=stats["avg_approved"],
+            median_approved=percentiles.get(stats["icd__code"], (None, None))[0],
+            p90_approved=percentiles.get(stats["icd__code"], (None, None))[1],
+            claims_count=stats["claims_count"],
+            date_from=date_from,
+            refreshed_at=refreshed_at,
+        )
+        for stats in claims
+        .order_by()
+        .values("icd__code")
+        .annotate(avg_approved=Avg("approved"), claims_count=Count("id"))
+    ]
+    with transaction.atomic():
+        stale = ClaimDiagnosisBaseline.objects.all()
+        if icd_codes is not None:
+            stale = stale.filter(icd_code__in=icd_codes)
+        stale.delete()
+        ClaimDiagnosisBaseline.objects.bulk_create(baselines, batch_size=1000)
+    logger.info("Refreshed %s diagnosis baselines from %s", len(baselines), date_from)
+    return len(baselines)
+
+
+def refresh_changed_diagnosis_baselines():
+    """
+    Refreshes the baselines of the ICD codes of the claims created or modified since the oldest baseline refresh,
+    all of them if there is no baseline yet
+    :return: number of baselines written
+    """
+    last_refresh = ClaimDiagnosisBaseline.objects.order_by("refreshed_at").values_list("refreshed_at", flat=True) \
+        .first()
+    if last_refresh is None:
+        return refresh_diagnosis_baselines()
+    icd_codes = set(Claim.objects
+                    .filter(Q(validity_from__gte=last_refresh) | Q(validity_to__gte=last_refresh),
+                            icd__isnull=False)
+                    .order_by()
+                    .values_list("icd__code", flat=True)
+                    .distinct())
+    if not icd_codes:
+        return 0
+    return refresh_diagnosis_baselines(icd_codes)
+
+
+def diagnosis_variance_filter(variance, only_on_existing=True):
+    """
+    Claims claiming more than variance % above the average approved amount of their ICD code, looked up in
+    ClaimDiagnosisBaseline by primary key. Unless only_on_existing, also the claims of ICD codes without baseline.
+    """
+    baselines = ClaimDiagnosisBaseline.objects.filter(icd_code=OuterRef("icd__code"))
+    variance_filter = Q(claimed__gt=(1 + variance / 100) * Subquery(baselines.values("avg_approved")[:1]))
+    if not only_on_existing:
+        variance_filter = variance_filter | Q(~Exists(baselines))
+    return variance_filter
@@ -33,12 +33,16 @@ from product.models import ProductItemOrService
 from medical.models import Item, Service
 
 from claim.utils import process_items_relations, process_services_relations
+from claim.batch_progress import BatchProgress
+from claim.sampling import sample_claims_for_status
 from claim.services import validate_claim_data as service_validate_claim_data, \
-        update_or_create_claim as service_update_or_create_claim, check_unique_claim_code, submit_claim,\
+        update_or_create_claim as service_update_or_create_claim, check_unique_claim_code, submit_claims,\
             validate_and_process_dedrem_claim as service_validate_and_process_dedrem_claim,\
+            validate_and_process_dedrem_claims as service_validate_and_process_dedrem_claims,\
+            submit_claims_in_parallel,\
             create_feedback_prompt as service_create_feedback_prompt, update_claims_dedrems,\
                 set_feedback_prompt_validity_to_to_current_date, set_claims_status
-from django.db import transaction
+from django.db import connection, transaction
 import requests
 
 logger = logging.getLogger(__name__)
@@ -142,6 +146,22 @@ class ClaimServiceInputType(InputObjectType):
     service_service_set = graphene.List(ClaimSubServiceInputType, required=False)
 
 
+class ClaimSampleInputType(InputObjectType):
+    """
+    Claims to select by sampling on the server, rather than by uuid
+    """
+    health_facility_uuid = graphene.String(required=False)
+    district_uuid = graphene.String(required=False)
+    date_from = graphene.Date(required=False)
+    date_to = graphene.Date(required=False)
+    claimed_min = graphene.Decimal(required=False)
+    claimed_max = graphene.Decimal(required=False)
+    status = graphene.List(graphene.Int, required=False)
+    percentage = graphene.Float(required=False)
+    count = graphene.Int(required=False)
+    seed = graphene.String(required=False)
+
+
 class FeedbackInputType(InputObjectType):
     id = graphene.Int(required=False, read_only=True)
     care_rendered = graphene.Boolean(required=False)
@@ -588,6 +608,23 @@ class SubmitClaimsMutation(OpenIMISMutation, ClaimSubmissionStatsMixin):
             # failed
         }
 
+    @staticmethod
+    def _load_claims_to_submit(uuids):
+        return list(Claim.objects
+                    .filter(uuid__in=uuids,
+                            validity_to__isnull=True)
+                    .prefetch_related(Prefetch('items', queryset=ClaimItem.objects.filter(
+                        *filter_validity(),
+                        Q(Q(rejection_reason=0) | Q(rejection_reason__isnull=True)))))
+                    .prefetch_related(Prefetch('services', queryset=ClaimService.objects.filter(
+                        *filter_validity(),
+                        Q(Q(rejection_reason=0) | Q(rejection_reason__isnull=True)))))
+                    .select_related("insuree"))
+
+    @staticmethod
+    def _chunk_errors(results):
+        return [{'title': claim.code, 'list': claim_errors} for claim, claim_errors in results if claim_errors]
+
     @classmethod
     @mutation_on_uuids_from_filter(Claim, ClaimGQLType, 'additional_filters', __filter_handlers)
     def async_mutate(cls, user, **data):
@@ -596,28 +633,33 @@ class SubmitClaimsMutation(OpenIMISMutation, ClaimSubmissionStatsMixin):
         errors = []
         uuids = data.get("uuids", [])
         client_mutation_id = data.get("client_mutation_id", None)
-        c_errors = []
-        claims = Claim.objects \
-                .filter(uuid__in=uuids,
-                        validity_to__isnull=True) \
-            .prefetch_related(Prefetch('items', queryset=ClaimItem.objects.filter(
-                *filter_validity(), 
-                Q(Q(rejection_reason=0) | Q(rejection_reason__isnull=True))))) \
-            .prefetch_related(Prefetch('services', queryset=ClaimService.objects.filter(
-                *filter_validity(),
-                Q(Q(rejection_reason=0) | Q(rejection_reason__isnull=True))))) 
-        remaining_uuid = list(map(str.upper,uuids))
-        for claim in claims:
-            remaining_uuid.remove(claim.uuid.upper())
-            c_errors += submit_claim(claim, user)
-            if c_errors:
-                errors.append({
-                    'title': claim.code,
-                    'list': c_errors
-                })
+        progress = BatchProgress(client_mutation_id, uuids)
+        # the workers commit on their own connections, which an enclosing transaction could not roll back
+        parallel = ClaimConfig.submit_claims_workers > 1 and not connection.in_atomic_block
+        if ClaimConfig.submit_claims_workers > 1 and not parallel:
+            logger.warning("SubmitClaimsMutation: called in a transaction, submitting the claims serially")
+        for chunk in progress.chunks():
+            if parallel:
+                claims = cls._load_claims_to_submit(chunk)
+                results = submit_claims_in_parallel(claims, user, ClaimConfig.submit_claims_workers)
+                chunk_errors = cls._chunk_errors(results)
+                # the partitions are already committed: a claim submitted before a failed checkpoint is
+                # reported as no longer entered by the next run
+                with transaction.atomic():
+                    progress.checkpoint(chunk, [claim.uuid for claim in claims], len(chunk_errors))
+            else:
+                with transaction.atomic():
+                    claims = cls._load_claims_to_submit(chunk)
+                    chunk_errors = cls._chunk_errors(submit_claims(claims, user))
+                    progress.checkpoint(chunk, [claim.uuid for claim in claims], len(chunk_errors))
+            errors += chunk_errors
+        remaining_uuid = progress.not_found
         if len(remaining_uuid):
-            c_errors.append( {'code': REJECTION_REASON_INVALID_CLAIM,
-                            'message': _("claim.validation.claim_uuid_not_found") + ','.join(remaining_uuid) })
+            errors.append({
+                'title': ','.join(remaining_uuid),
+                'list': [{'code': REJECTION_REASON_INVALID_CLAIM,
+                          'message': _("claim.validation.claim_uuid_not_found") + ','.join(remaining_uuid)}]
+            })
         if len(errors) == 1:
             errors = errors[0]['list']
         cls.add_submission_stats_to_mutation_log(client_mutation_id, uuids)
@@ -641,12 +683,17 @@ class SelectClaimsForFeedbackMutation(OpenIMISMutation):
 
     class Input(OpenIMISMutation.Input):
         uuids = graphene.List(graphene.String)
+        sample = graphene.Field(ClaimSampleInputType, required=False)
 
     @classmethod
     def async_mutate(cls, user, **data):
         if not user.has_perms(ClaimConfig.gql_mutation_select_claim_feedback_perms):
             raise PermissionDenied(_("unauthorized"))
-        return set_claims_status(data['uuids'], 'feedback_status', Claim.FEEDBACK_SELECTED, user=user)
+        uuids = data.get('uuids')
+        if not uuids and data.get('sample'):
+            uuids = sample_claims_for_status(user, data['sample'], 'feedback_status',
+                                             [Claim.FEEDBACK_IDLE, Claim.FEEDBACK_NOT_SELECTED])
+        return set_claims_status(uuids or [], 'feedback_status', Claim.FEEDBACK_SELECTED, user=user)
 
 
 class BypassClaimsFeedbackMutation(OpenIMISMutation):
@@ -739,12 +786,17 @@ class SelectClaimsForReviewMutation(OpenIMISMutation):
 
     class Input(OpenIMISMutation.Input):
         uuids = graphene.List(graphene.String)
+        sample = graphene.Field(ClaimSampleInputType, required=False)
 
     @classmethod
     def async_mutate(cls, user, **data):
         if not user.has_perms(ClaimConfig.gql_mutation_select_claim_review_perms):
             raise PermissionDenied(_("unauthorized"))
-        return set_claims_status(data['uuids'], 'review_status', Claim.REVIEW_SELECTED)
+        uuids = data.get('uuids')
+        if not uuids and data.get('sample'):
+            uuids = sample_claims_for_status(user, data['sample'], 'review_status',
+                                             [Claim.REVIEW_IDLE, Claim.REVIEW_NOT_SELECTED])
+        return set_claims_status(uuids or [], 'review_status', Claim.REVIEW_SELECTED)
 
 
 class BypassClaimsReviewMutation(OpenIMISMutation):
@@ -783,7 +835,7 @@ class DeliverClaimsReviewMutation(OpenIMISMutation):
         errors = set_claims_status(data['uuids'], 'review_status', Claim.REVIEW_DELIVERED,
                                    {'audit_user_id_review': user.id_for_audit})
         # OMT-208 update the dedrem for the reviewed claims
-        errors += update_claims_dedrems(data["uuids"], user)
+        errors += update_claims_dedrems(data["uuids"], user, data.get("client_mutation_id"))
 
         return errors
 
@@ -921,6 +973,37 @@ class ProcessClaimsMutation(OpenIMISMutation, ClaimSubmissionStatsMixin):
             # failed
         }
 
+    @classmethod
+    def _process_claims(cls, user, claims):
+        errors = []
+        if ClaimConfig.process_claims_batch_valuation:
+            for claim in claims:
+                claim.save_history()
+                claim.audit_user_id_process = user.id_for_audit
+            for claim, c_errors in service_validate_and_process_dedrem_claims(claims, user):
+                if c_errors:
+                    errors.append({
+                        'title': claim.code,
+                        'list': c_errors
+                    })
+        else:
+            for claim in claims:
+                logger.debug("ProcessClaimsMutation: processing %s", claim.uuid)
+                c_errors = []
+
+                claim.save_history()
+                claim.audit_user_id_process = user.id_for_audit
+                logger.debug("ProcessClaimsMutation: validating claim %s", claim.uuid)
+                c_errors += validate_and_process_dedrem_claim(claim, user, True)
+
+                logger.debug("ProcessClaimsMutation: claim %s set processed or valuated", claim.uuid)
+                if c_errors:
+                    errors.append({
+                        'title': claim.code,
+                        'list': c_errors
+                    })
+        return errors
+
     @classmethod
     def async_mutate(cls, user, **data):
         if not user.has_perms(ClaimConfig.gql_mutation_process_claims_perms):
@@ -928,30 +1011,20 @@ class ProcessClaimsMutation(OpenIMISMutation, ClaimSubmissionStatsMixin):
         errors = []
         uuids = data.get("uuids", None)
         client_mutation_id = data.get("client_mutation_id", None)
-        claims = Claim.objects \
-                .filter(uuid__in=uuids) \
-                .prefetch_related(Prefetch('items', queryset=ClaimItem.objects.filter(*filter_validity())))\
-                .prefetch_related(Prefetch('services', queryset=ClaimService.objects.filter(*filter_validity())))
-        remaining_uuid = list(map(str.upper,uuids))
-        for claim in claims:
-            remaining_uuid.remove(claim.uuid.upper())
-            
-
-            logger.debug("ProcessClaimsMutation: processing %s", claim.uuid)
-            c_errors = []
-     
-            claim.save_history()
-            claim.audit_user_id_process = user.id_for_audit
-            logger.debug("ProcessClaimsMutation: validating claim %s", claim.uuid)
-            c_errors += validate_and_process_dedrem_claim(claim, user, True)
-
-            logger.debug("ProcessClaimsMutation: claim %s set processed or valuated", claim.uuid)
-            if c_errors:
-                errors.append({
-                    'title': claim.code,
-                    'list': c_errors
-                })
-                
+        progress = BatchProgress(client_mutation_id, uuids)
+        for chunk in progress.chunks():
+            with transaction.atomic():
+                claims = list(Claim.objects
+                              .filter(uuid__in=chunk)
+                              .prefetch_related(Prefetch('items',
+                                                         queryset=ClaimItem.objects.filter(*filter_validity())))
+                              .prefetch_related(Prefetch('services',
+                                                         queryset=ClaimService.objects.filter(*filter_validity())))
+                              .select_related("health_facility"))
+                chunk_errors = cls._process_claims(user, claims)
+                progress.checkpoint(chunk, [claim.uuid for claim in claims], len(chunk_errors))
+            errors += chunk_errors
+        remaining_uuid = progress.not_found
         if len(remaining_uuid):
                 errors += {
                     'title': _('error'),
@@ -8,6 +8,7 @@ from location.schema import HealthFacilityGQLType
 from medical.schema import DiagnosisGQLType
 from claim_batch.schema import BatchRunGQLType
 from .apps import ClaimConfig
+from .dataloaders import get_claim_dataloader
 from claim.models import (ClaimDedRem, Claim, ClaimAdmin, Feedback, ClaimItem, ClaimService, ClaimAttachment,
                           ClaimAttachmentType, ClaimServiceService, ClaimServiceItem)
 from django.utils.translation import gettext as _
@@ -109,21 +110,33 @@ class ClaimGQLType(DjangoObjectType):
     def resolve_attachments_count(self, info):
         if not info.context.user.has_perms(ClaimConfig.gql_query_claims_perms):
             raise PermissionDenied(_("unauthorized"))
+        loader = get_claim_dataloader(info, "claim_attachments_count_loader")
+        if loader:
+            return loader.load(self.id)
         return self.attachments.filter(legacy_id__isnull=True).filter(validity_to__isnull=True).count()
 
     def resolve_items(self, info):
         if not info.context.user.has_perms(ClaimConfig.gql_query_claims_perms):
             raise PermissionDenied(_("unauthorized"))
+        loader = get_claim_dataloader(info, "claim_items_loader")
+        if loader:
+            return loader.load(self.id)
         return self.items.filter(legacy_id__isnull=True).filter(validity_to__isnull=True)
 
     def resolve_services(self, info):
         if not info.context.user.has_perms(ClaimConfig.gql_query_claims_perms):
             raise PermissionDenied(_("unauthorized"))
+        loader = get_claim_dataloader(info, "claim_services_loader")
+        if loader:
+            return loader.load(self.id)
         return self.services.filter(legacy_id__isnull=True).filter(validity_to__isnull=True)
 
     def resolve_client_mutation_id(self, info):
         if not info.context.user.has_perms(ClaimConfig.gql_query_claims_perms):
             raise PermissionDenied(_("unauthorized"))
+        loader = get_claim_dataloader(info, "claim_client_mutation_id_loader")
+        if loader:
+            return loader.load(self.id)
         claim_mutation = self.mutations.select_related(
             'mutation').filter(mutation__status=0).first()
         return claim_mutation.mutation.client_mutation_id if claim_mutation else None
@@ -1,26 +1,54 @@
-import random
-import string
+import datetime
+import logging
 
-from claim.models import ClaimAdmin
-from claim.test_helpers import create_test_claim, create_test_claimservice, create_test_claimitem
-from django.core.management.base import BaseCommand
-from insuree.models import Insuree
-from medical.models import Service, Item
+from claim.claim_generator import ClaimGenerator, generate_claims_sharded
+from django.core.management.base import BaseCommand, CommandError
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    help = "This command will generate test Claims with some optional parameters. It is intended to simulate larger" \
-           "databases for performance testing"
-    insurees = None
-    services = None
-    items = None
-    claim_admins = None
-    hfs = None
+    help = "This command will generate test Claims with some optional parameters. It is intended to simulate larger " \
+           "databases for performance testing. The claims are drawn from a seed, with realistic distributions of " \
+           "the insurees, health facilities, diagnoses, visit types, hospital stays, items and services at the " \
+           "prices of the health facility price lists, and inserted in batches (COPY on PostgreSQL), optionally " \
+           "in several processes. Price lists and policies can be generated first so that the claims can be " \
+           "submitted and valuated."
 
     def add_arguments(self, parser):
         parser.add_argument("nb_claims", nargs=1, type=int)
         parser.add_argument("nb_services", nargs=1, type=int, help="number of services per claim, with 10% randomness")
         parser.add_argument("nb_items", nargs=1, type=int, help="number of items per claim, with 10% randomness")
+        parser.add_argument("--seed", dest="seed", type=int, default=0,
+                            help="seed of the random generators: the same seed gives the same claims")
+        parser.add_argument("--workers", dest="workers", type=int, default=1,
+                            help="number of processes generating the claims, each with its shard of the claims")
+        parser.add_argument("--batch-size", dest="batch_size", type=int, default=1000,
+                            help="number of claims inserted per transaction")
+        parser.add_argument("--date-from", dest="date_from", type=datetime.date.fromisoformat,
+                            help="first day of care of the claims (YYYY-MM-DD), a year before --date-to by default")
+        parser.add_argument("--date-to", dest="date_to", type=datetime.date.fromisoformat,
+                            help="last day of care of the claims (YYYY-MM-DD), today by default")
+        parser.add_argument("--insurees", dest="nb_insurees", type=int,
+                            help="number of insurees, picked randomly, making the claims, all of them by default")
+        parser.add_argument(
+            '--with-price-lists',
+            action='store_true',
+            dest='with_price_lists',
+            help='Give the health facilities without price list a generated one per district',
+        )
+        parser.add_argument(
+            '--with-policies',
+            action='store_true',
+            dest='with_policies',
+            help='Give the families of the insurees without policy over the period a generated one',
+        )
+        parser.add_argument(
+            '--no-copy',
+            action='store_false',
+            dest='use_copy',
+            help='Insert with bulk_create even on PostgreSQL',
+        )
         parser.add_argument(
             '--verbose',
             action='store_true',
@@ -33,58 +61,19 @@ class Command(BaseCommand):
         nb_services = options["nb_services"][0]
         nb_items = options["nb_items"][0]
         verbose = options["verbose"]
-        for claim_num in range(1, nb_claims + 1):
-            insuree = self.get_random_insuree()
-            claim_admin = self.get_random_claim_admin()
-            hf = self.get_random_hf()
-            claim = create_test_claim({"insuree_id": insuree,
-                                       "code": ''.join(random.choices(string.ascii_uppercase + string.digits, k=8)),
-                                       "admin_id": claim_admin,
-                                       "health_facility_id": hf})
-            if verbose:
-                logger.debug(f"{claim_num} created claim {claim} for insuree {insuree} with code {claim.code}")
-            for svc_num in range(1, nb_services + 1):
-                service = self.get_random_service()
-                claim_service = create_test_claimservice(claim, custom_props={
-                    "service_id": service,
-                    "qty_provided": random.randint(1, 10),
-                    "price_asked": random.randint(1, 1000),
-                })
+        try:
+            generator = ClaimGenerator(options["seed"], options["date_from"], options["date_to"],
+                                       options["nb_insurees"], use_copy=options["use_copy"])
+            if options["with_price_lists"]:
+                created = generator.generate_price_lists()
                 if verbose:
-                    logger.debug(f"{claim_num} {svc_num} Created claim service {claim_service} for service {service}")
-            for item_num in range(1, nb_items + 1):
-                item = self.get_random_item()
-                claim_item = create_test_claimitem(claim, "D", custom_props=
-                {
-                    "item_id": item,
-                    "qty_provided": random.randint(1, 10),
-                    "price_asked": random.randint(1, 1000),
-                })
+                    self.stdout.write(f"{created} price list(s) generated")
+            if options["with_policies"]:
+                created = generator.generate_policies(options["batch_size"])
                 if verbose:
-                    logger.debug(f"{claim_num} {item_num} Created claim item {claim_item} for item {item}")
-
-    def get_random_insuree(self):
-        if not self.insurees:
-            self.insurees = Insuree.objects.filter(validity_to__isnull=True).values_list("pk", flat=True)
-        return random.choice(self.insurees)
-
-    def get_random_service(self):
-        if not self.services:
-            self.services = Service.objects.filter(validity_to__isnull=True).values_list("pk", flat=True)
-        return random.choice(self.services)
-
-    def get_random_item(self):
-        if not self.items:
-            self.items = Item.objects.filter(validity_to__isnull=True).values_list("pk", flat=True)
-        return random.choice(self.items)
-
-    def get_random_claim_admin(self):
-        if not self.claim_admins:
-            self.claim_admins = ClaimAdmin.objects.filter(validity_to__isnull=True).values_list("pk", flat=True)
-        return random.choice(self.claim_admins)
-
-    def get_random_hf(self):
-        if not self.hfs:
-            from location.models import HealthFacility
-            self.hfs = HealthFacility.objects.filter(validity_to__isnull=True).values_list("pk", flat=True)
-        return random.choice(self.hfs)
+                    self.stdout.write(f"{created} policies generated")
+            generated = generate_claims_sharded(generator, nb_claims, nb_services, nb_items,
+                                                options["workers"], options["batch_size"])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(f"{generated} claim(s) generated")
@@ -0,0 +1,105 @@
+import json
+import logging
+import uuid
+
+from claim.claim_import import ClaimImporter, read_csv_claims, read_jsonl_claims
+from core.models import MutationLog, User
+from django.core.management.base import BaseCommand, CommandError
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "This command imports entered claims from a JSON-lines or CSV file, streaming it in batches. The codes are " \
+           "resolved in memory and the claims and their details inserted with COPY on PostgreSQL (bulk_create " \
+           "elsewhere). Rejected claims are written to an error file and the imported ones can be queued for " \
+           "submission."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", nargs=1, type=str, help="claims file, .jsonl or .csv")
+        parser.add_argument("--format", dest="format", choices=["jsonl", "csv"],
+                            help="format of the file, from its extension by default")
+        parser.add_argument("--batch-size", dest="batch_size", type=int, default=1000,
+                            help="number of claims inserted per transaction")
+        parser.add_argument("--errors-file", dest="errors_file", type=str,
+                            help="JSON-lines file of the rejected claims, <file>.errors.jsonl by default")
+        parser.add_argument("--username", dest="username", type=str,
+                            help="user recorded as the author of the claims and of their submission")
+        parser.add_argument(
+            '--no-copy',
+            action='store_false',
+            dest='use_copy',
+            help='Insert with bulk_create even on PostgreSQL',
+        )
+        parser.add_argument(
+            '--submit',
+            action='store_true',
+            dest='submit',
+            help='Queue a SubmitClaimsMutation per batch of imported claims',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Be verbose about what it is doing',
+        )
+
+    def handle(self, *args, **options):
+        file_name = options["file"][0]
+        file_format = options["format"] or ("csv" if file_name.lower().endswith(".csv") else "jsonl")
+        batch_size = options["batch_size"]
+        user = None
+        if options["username"]:
+            user = User.objects.filter(username=options["username"]).first()
+            if not user:
+                raise CommandError(f"Unknown user {options['username']}")
+        if options["submit"] and not user:
+            raise CommandError("--submit needs a --username")
+
+        importer = ClaimImporter(user.id_for_audit if user else -1, options["use_copy"])
+        reader = read_csv_claims if file_format == "csv" else read_jsonl_claims
+        imported = rejected = 0
+        with open(file_name, newline="" if file_format == "csv" else None) as stream, \
+                open(options["errors_file"] or f"{file_name}.errors.jsonl", "w") as errors_file:
+            batch = []
+            for line_number, record, error in reader(stream):
+                if error:
+                    rejected += self.write_rejected(errors_file, line_number, record, [error])
+                    continue
+                batch.append((line_number, record))
+                if len(batch) >= batch_size:
+                    imported, rejected = self.import_batch(importer, batch, errors_file, user, options, imported,
+                                                           rejected)
+                    batch = []
+            if batch:
+                imported, rejected = self.import_batch(importer, batch, errors_file, user, options, imported,
+                                                       rejected)
+        self.stdout.write(f"{imported} claim(s) imported, {rejected} rejected")
+
+    def import_batch(self, importer, batch, errors_file, user, options, imported, rejected):
+        uuids, batch_rejected = importer.import_batch(batch)
+        for line_number, record, errors in batch_rejected:
+            rejected += self.write_rejected(errors_file, line_number, record, errors)
+        imported += len(uuids)
+        if options["submit"] and uuids:
+            self.queue_submission(uuids, user)
+        if options["verbose"]:
+            self.stdout.write(f"{imported} claim(s) imported, {rejected} rejected")
+        return imported, rejected
+
+    @staticmethod
+    def write_rejected(errors_file, line_number, record, errors):
+        errors_file.write(json.dumps({"line": line_number, "errors": errors, "record": record}, default=str) + "\n")
+        return 1
+
+    @staticmethod
+    def queue_submission(uuids, user):
+        from core.tasks import openimis_mutation_async
+        client_mutation_id = str(uuid.uuid4())
+        mutation_log = MutationLog.objects.create(
+            json_content=json.dumps({"uuids": uuids, "client_mutation_id": client_mutation_id}),
+            user_id=user.id,
+            client_mutation_id=client_mutation_id,
+            client_mutation_label="Submit imported claims",
+        )
+        openimis_mutation_async.delay(mutation_log.id, "claim", "SubmitClaimsMutation")
@@ -0,0 +1,48 @@
+import logging
+
+from claim.detail_codes import install_detail_codes, refresh_detail_codes, uninstall_detail_codes
+from django.core.management.base import BaseCommand, CommandError
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "This command adds the DetailCodes array column to tblClaim on PostgreSQL, with its GIN index and the " \
+           "triggers maintaining it from the claim items and services, and fills it. It has to be run before " \
+           "enabling claim_detail_codes_enabled, and again with --refresh after changing item or service codes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=10000,
+                            help="number of claims filled per transaction")
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            dest='refresh',
+            help='Only recompute the codes of all the claims',
+        )
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            dest='drop',
+            help='Remove the column, index and triggers (disable claim_detail_codes_enabled first)',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Be verbose about what it is doing',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options["drop"]:
+                uninstall_detail_codes()
+                refreshed = 0
+            elif options["refresh"]:
+                refreshed = refresh_detail_codes(chunk_size=options["chunk_size"])
+            else:
+                refreshed = install_detail_codes(options["chunk_size"])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        if options["verbose"]:
+            self.stdout.write(f"Detail codes of {refreshed} claim(s) refreshed")
@@ -0,0 +1,75 @@
+import logging
+
+from claim.dedrem_ledger import DEDREM_FIELDS, build_ledgers
+from claim.models import ClaimDedRem, ClaimDedRemLedger
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "This command rebuilds the deductible and ceiling ledgers (tblClaimDedRemLedger) from tblClaimDedRem. " \
+           "It has to be run before enabling claim_dedrem_ledger_enabled. With --verify, it only reports the " \
+           "ledgers that differ from tblClaimDedRem."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=1000,
+                            help="number of policies processed per transaction")
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            help='Only compare the ledgers with tblClaimDedRem, without writing',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Be verbose about what it is doing',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        verify = options["verify"]
+        verbose = options["verbose"]
+        policy_ids = list(ClaimDedRem.objects
+                          .filter(policy_id__isnull=False)
+                          .order_by("policy_id")
+                          .values_list("policy_id", flat=True)
+                          .distinct())
+        if not verify:
+            deleted, _ = ClaimDedRemLedger.objects.all().delete()
+            if verbose:
+                self.stdout.write(f"Deleted {deleted} ledgers")
+        mismatches = 0
+        for start in range(0, len(policy_ids), chunk_size):
+            chunk = policy_ids[start:start + chunk_size]
+            ledgers = build_ledgers(chunk)
+            if verify:
+                mismatches += self.verify_chunk(chunk, ledgers, verbose)
+            else:
+                with transaction.atomic():
+                    ClaimDedRemLedger.objects.bulk_create(ledgers)
+            if verbose:
+                self.stdout.write(f"{min(start + chunk_size, len(policy_ids))}/{len(policy_ids)} policies done")
+        if verify:
+            self.stdout.write(f"{mismatches} ledger(s) differing from the ClaimDedRem")
+        else:
+            self.stdout.write(f"Ledgers rebuilt for {len(policy_ids)} policies")
+
+    def verify_chunk(self, policy_ids, expected_ledgers, verbose):
+        def totals(ledger):
+            return [getattr(ledger, field) for field in DEDREM_FIELDS]
+
+        expected = {(ledger.policy_id, ledger.insuree_id): totals(ledger) for ledger in expected_ledgers}
+        # a ledger not initialized yet is fine, it is built from ClaimDedRem when needed
+        actual = {(ledger.policy_id, ledger.insuree_id): totals(ledger)
+                  for ledger in ClaimDedRemLedger.objects.filter(policy_id__in=policy_ids)}
+        mismatches = [key for key, ledger_totals in actual.items()
+                      if ledger_totals != expected.get(key, [0] * len(DEDREM_FIELDS))]
+        if verbose:
+            for policy_id, insuree_id in mismatches:
+                self.stdout.write(f"Policy {policy_id}, insuree {insuree_id}: expected "
+                                  f"{expected.get((policy_id, insuree_id))}, found {actual[(policy_id, insuree_id)]}")
+        return len(mismatches)
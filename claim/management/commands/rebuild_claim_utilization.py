@@ -0,0 +1,75 @@
+import logging
+
+from claim.models import Claim, ClaimUtilization
+from claim.utilization import build_claims_utilization, utilization_key
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "This command rebuilds the claim utilization table (tblClaimUtilization) from the claims, items and " \
+           "services. It has to be run before enabling claim_utilization_enabled. With --verify, it only reports " \
+           "the claims whose utilization differs from the claim tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=1000,
+                            help="number of claims processed per transaction")
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            help='Only compare the table with the claim tables, without writing',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Be verbose about what it is doing',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        verify = options["verify"]
+        verbose = options["verbose"]
+        claim_ids = list(Claim.objects
+                         .filter(validity_to__isnull=True, status__gt=Claim.STATUS_ENTERED)
+                         .order_by("id")
+                         .values_list("id", flat=True))
+        if not verify:
+            deleted, _ = ClaimUtilization.objects.all().delete()
+            if verbose:
+                self.stdout.write(f"Deleted {deleted} utilization rows")
+        mismatches = 0
+        for start in range(0, len(claim_ids), chunk_size):
+            chunk = claim_ids[start:start + chunk_size]
+            utilizations = build_claims_utilization(chunk)
+            if verify:
+                mismatches += self.verify_chunk(chunk, utilizations, verbose)
+            else:
+                with transaction.atomic():
+                    ClaimUtilization.objects.bulk_create(utilizations)
+            if verbose:
+                self.stdout.write(f"{min(start + chunk_size, len(claim_ids))}/{len(claim_ids)} claims done")
+        if verify:
+            stale = ClaimUtilization.objects \
+                .exclude(claim__validity_to__isnull=True, claim__status__gt=Claim.STATUS_ENTERED) \
+                .values("claim_id").distinct().count()
+            self.stdout.write(f"{mismatches} claim(s) with a wrong utilization, "
+                              f"{stale} claim(s) with a utilization that should have been removed")
+        else:
+            self.stdout.write(f"Utilization rebuilt for {len(claim_ids)} claim(s)")
+
+    def verify_chunk(self, claim_ids, expected_utilizations, verbose):
+        expected, actual = {}, {}
+        for utilization in expected_utilizations:
+            expected.setdefault(utilization.claim_id, []).append(utilization_key(utilization))
+        for utilization in ClaimUtilization.objects.filter(claim_id__in=claim_ids):
+            actual.setdefault(utilization.claim_id, []).append(utilization_key(utilization))
+        mismatches = [claim_id for claim_id in claim_ids
+                      if sorted(expected.get(claim_id, []), key=str) != sorted(actual.get(claim_id, []), key=str)]
+        if verbose:
+            for claim_id in mismatches:
+                self.stdout.write(f"Claim {claim_id}: expected {expected.get(claim_id)}, found {actual.get(claim_id)}")
+        return len(mismatches)
@@ -0,0 +1,38 @@
+import logging
+
+from claim.diagnosis_baselines import refresh_changed_diagnosis_baselines, refresh_diagnosis_baselines
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "This command refreshes the per ICD code approved amount baselines (tblClaimDiagnosisBaseline) of the " \
+           "diagnosisVariance claims filter. It has to be run before enabling " \
+           "gql_query_claim_diagnosis_variance_baselines, then daily since the window of the baselines moves."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--icd", dest="icd_codes", nargs="+", type=str,
+                            help="only refresh the baselines of these ICD codes")
+        parser.add_argument("--days", dest="days", type=int,
+                            help="window of the baselines, claim_diagnosis_baseline_days by default")
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            help='Only refresh the ICD codes of the claims changed since the last refresh',
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            dest='verbose',
+            help='Be verbose about what it is doing',
+        )
+
+    def handle(self, *args, **options):
+        if options["incremental"]:
+            refreshed = refresh_changed_diagnosis_baselines()
+        else:
+            refreshed = refresh_diagnosis_baselines(options["icd_codes"], options["days"])
+        if options["verbose"]:
+            self.stdout.write(f"{refreshed} diagnosis baseline(s) refreshed")
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0030_merge_20240318_1324'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['insuree', 'status'], name='claim_insuree_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimitem',
+            index=models.Index(fields=['claim', 'item'], name='claimitem_claim_item_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimservice',
+            index=models.Index(fields=['claim', 'service'], name='claimservice_claim_svc_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+import core.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0031_claim_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClaimUtilization',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('target_date', core.fields.DateField(db_column='TargetDate')),
+                ('category', models.CharField(blank=True, db_column='ClaimCategory', max_length=1, null=True)),
+                ('qty', models.DecimalField(blank=True, db_column='Qty', decimal_places=2, max_digits=18, null=True)),
+                ('claim', models.ForeignKey(db_column='ClaimID', db_constraint=False,
+                                            on_delete=django.db.models.deletion.DO_NOTHING,
+                                            related_name='utilizations', to='claim.claim')),
+                ('insuree', models.ForeignKey(db_column='InsureeID', db_constraint=False,
+                                              on_delete=django.db.models.deletion.DO_NOTHING,
+                                              related_name='claim_utilizations', to='insuree.insuree')),
+                ('item', models.ForeignKey(blank=True, db_column='ItemID', db_constraint=False, null=True,
+                                           on_delete=django.db.models.deletion.DO_NOTHING,
+                                           related_name='claim_utilizations', to='medical.item')),
+                ('service', models.ForeignKey(blank=True, db_column='ServiceID', db_constraint=False, null=True,
+                                              on_delete=django.db.models.deletion.DO_NOTHING,
+                                              related_name='claim_utilizations', to='medical.service')),
+            ],
+            options={
+                'db_table': 'tblClaimUtilization',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='claimutilization',
+            index=models.Index(fields=['insuree', 'category', 'target_date'], name='claimutil_insuree_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimutilization',
+            index=models.Index(fields=['insuree', 'item', 'target_date'], name='claimutil_insuree_item_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimutilization',
+            index=models.Index(fields=['insuree', 'service', 'target_date'], name='claimutil_insuree_svc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claimutilization',
+            index=models.Index(fields=['claim'], name='claimutil_claim_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0032_claimutilization'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClaimDedRemLedger',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('ded_g', models.DecimalField(db_column='DedG', decimal_places=2, default=0, max_digits=18)),
+                ('ded_op', models.DecimalField(db_column='DedOP', decimal_places=2, default=0, max_digits=18)),
+                ('ded_ip', models.DecimalField(db_column='DedIP', decimal_places=2, default=0, max_digits=18)),
+                ('rem_g', models.DecimalField(db_column='RemG', decimal_places=2, default=0, max_digits=18)),
+                ('rem_op', models.DecimalField(db_column='RemOP', decimal_places=2, default=0, max_digits=18)),
+                ('rem_ip', models.DecimalField(db_column='RemIP', decimal_places=2, default=0, max_digits=18)),
+                ('rem_consult', models.DecimalField(db_column='RemConsult', decimal_places=2, default=0,
+                                                    max_digits=18)),
+                ('rem_surgery', models.DecimalField(db_column='RemSurgery', decimal_places=2, default=0,
+                                                    max_digits=18)),
+                ('rem_delivery', models.DecimalField(db_column='RemDelivery', decimal_places=2, default=0,
+                                                     max_digits=18)),
+                ('rem_hospitalization', models.DecimalField(db_column='RemHospitalization', decimal_places=2,
+                                                            default=0, max_digits=18)),
+                ('rem_antenatal', models.DecimalField(db_column='RemAntenatal', decimal_places=2, default=0,
+                                                      max_digits=18)),
+                ('insuree', models.ForeignKey(blank=True, db_column='InsureeID', db_constraint=False, null=True,
+                                              on_delete=django.db.models.deletion.DO_NOTHING,
+                                              related_name='claim_ded_rem_ledgers', to='insuree.insuree')),
+                ('policy', models.ForeignKey(db_column='PolicyID', db_constraint=False,
+                                             on_delete=django.db.models.deletion.DO_NOTHING,
+                                             related_name='claim_ded_rem_ledgers', to='policy.policy')),
+            ],
+            options={
+                'db_table': 'tblClaimDedRemLedger',
+                'managed': True,
+                'unique_together': {('policy', 'insuree')},
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='claimdedremledger',
+            constraint=models.UniqueConstraint(condition=models.Q(insuree__isnull=True), fields=('policy',),
+                                               name='claimdedremledger_policy_uniq'),
+        ),
+    ]
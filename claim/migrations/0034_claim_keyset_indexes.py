@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0033_claimdedremledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['date_claimed', 'id'], name='claim_date_claimed_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['health_facility', 'date_claimed', 'id'], name='claim_hf_date_claimed_idx'),
+        ),
+    ]
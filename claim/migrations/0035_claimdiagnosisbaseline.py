@@ -0,0 +1,31 @@
+import core.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('claim', '0034_claim_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClaimDiagnosisBaseline',
+            fields=[
+                ('icd_code', models.CharField(db_column='ICDCode', max_length=50, primary_key=True, serialize=False)),
+                ('avg_approved', models.DecimalField(blank=True, db_column='AvgApproved', decimal_places=2,
+                                                     max_digits=18, null=True)),
+                ('median_approved', models.DecimalField(blank=True, db_column='MedianApproved', decimal_places=2,
+                                                        max_digits=18, null=True)),
+                ('p90_approved', models.DecimalField(blank=True, db_column='P90Approved', decimal_places=2,
+                                                     max_digits=18, null=True)),
+                ('claims_count', models.IntegerField(db_column='ClaimsCount')),
+                ('date_from', core.fields.DateField(db_column='DateFrom')),
+                ('refreshed_at', models.DateTimeField(db_column='RefreshedAt')),
+            ],
+            options={
+                'db_table': 'tblClaimDiagnosisBaseline',
+                'managed': True,
+            },
+        ),
+    ]
@@ -1,11 +1,13 @@
 import uuid
+from copy import copy
+from datetime import datetime as py_datetime
 
 from claim_batch import models as claim_batch_models
 from core import fields, TimeUtils
 from core import models as core_models
 from django import dispatch
 from django.conf import settings
-from django.db import models
+from django.db import connection, models
 from graphql import ResolveInfo
 from insuree import models as insuree_models
 from location import models as location_models
@@ -250,6 +252,13 @@ class Claim(core_models.VersionedModel, core_models.ExtendableModel):
     class Meta:
         managed = True
         db_table = 'tblClaim'
+        indexes = [
+            # insuree claim history (frequency, max provision, category checks)
+            models.Index(fields=['insuree', 'status'], name='claim_insuree_status_idx'),
+            # keyset pagination of the claims, also per health facility
+            models.Index(fields=['date_claimed', 'id'], name='claim_date_claimed_id_idx'),
+            models.Index(fields=['health_facility', 'date_claimed', 'id'], name='claim_hf_date_claimed_idx'),
+        ]
 
     STATUS_REJECTED = 1
     STATUS_ENTERED = 2
@@ -278,20 +287,47 @@ class Claim(core_models.VersionedModel, core_models.ExtendableModel):
         return updated_items + updated_services
 
     def save_history(self, **kwargs):
+        """
+        Copies the claim and its items and services (the prefetched ones if prefetched) to history rows attached
+        to the history claim: one INSERT for the claim and one INSERT ... SELECT per detail table.
+        """
         prev_id = super(Claim, self).save_history()
         if prev_id:
-            prev_items = []
-            for item in self.items.all():
-                prev_items.append(item.save_history())
-            ClaimItem.objects.filter(
-                id__in=prev_items).update(claim_id=prev_id)
-            prev_services = []
-            for service in self.services.all():
-                prev_services.append(service.save_history())
-            ClaimService.objects.filter(
-                id__in=prev_services).update(claim_id=prev_id)
+            validity_to = py_datetime.now()
+            for related_name, detail_model in (("items", ClaimItem), ("services", ClaimService)):
+                prefetched = getattr(self, "_prefetched_objects_cache", {}).get(related_name)
+                _copy_details_to_history(
+                    detail_model, {self.id: prev_id}, validity_to,
+                    [detail.id for detail in prefetched] if prefetched is not None else None)
         return prev_id
 
+    @classmethod
+    def save_histories(cls, claims):
+        """
+        save_history of several claims (and all their details) with a fixed number of statements: one bulk INSERT
+        of the history claims, one query for their ids and one INSERT ... SELECT per detail table.
+        :return: dict of claim id -> history claim id
+        """
+        claims = [claim for claim in claims if claim.id]
+        if not claims:
+            return {}
+        validity_to = py_datetime.now()
+        histories = []
+        for claim in claims:
+            histo = copy(claim)
+            histo.id = None
+            histo.uuid = str(uuid.uuid4())
+            histo.validity_to = validity_to
+            histo.legacy_id = claim.id
+            histories.append(histo)
+        cls.objects.bulk_create(histories)
+        prev_ids = dict(cls.objects
+                        .filter(uuid__in=[histo.uuid for histo in histories])
+                        .values_list("legacy_id", "id"))
+        for detail_model in (ClaimItem, ClaimService):
+            _copy_details_to_history(detail_model, prev_ids, validity_to)
+        return prev_ids
+
     @classmethod
     def get_queryset(cls, queryset, user):
         queryset = Claim.filter_queryset(queryset)
@@ -367,6 +403,65 @@ class ClaimMutation(core_models.UUIDModel):
         db_table = "claim_ClaimMutation"
 
 
+def _copy_details_to_history(detail_model, prev_claim_ids, validity_to, detail_ids=None):
+    """
+    INSERT ... SELECT copy of the details of claims into history rows (legacy_id = id, closed at validity_to)
+    attached to the history claims, the set-based equivalent of detail.save_history() then update(claim_id=...).
+    The claims (or details) are copied in batches that fit the parameters limit of the database (2100 on SQL Server).
+    :param prev_claim_ids: dict of claim id -> history claim id
+    :param detail_ids: the details to copy, all the details of the claims if None
+    :return: number of history rows inserted
+    """
+    if not prev_claim_ids or (detail_ids is not None and not detail_ids):
+        return 0
+    claim_column = detail_model._meta.get_field("claim").column
+    copied = 0
+    if detail_ids is None:
+        # each claim binds 3 parameters (the claim and history ids of its WHEN and the claim id of the IN), plus
+        # validity_to once per batch
+        claim_ids = list(prev_claim_ids)
+        batch_size = max(1, connection.ops.bulk_batch_size(["claim", "history", "where"], claim_ids + [None]) - 1)
+        for start in range(0, len(claim_ids), batch_size):
+            batch = claim_ids[start:start + batch_size]
+            copied += _insert_details_history(detail_model, {claim_id: prev_claim_ids[claim_id] for claim_id in batch},
+                                              validity_to, claim_column, batch)
+        return copied
+    # the details all belong to the claims of the CASE, bound once per batch of details
+    detail_ids = list(detail_ids)
+    case_params = 2 * len(prev_claim_ids) + 1
+    batch_size = max(1, connection.ops.bulk_batch_size(["where"], detail_ids + [None] * case_params) - case_params)
+    for start in range(0, len(detail_ids), batch_size):
+        copied += _insert_details_history(detail_model, prev_claim_ids, validity_to, detail_model._meta.pk.column,
+                                          detail_ids[start:start + batch_size])
+    return copied
+
+
+def _insert_details_history(detail_model, prev_claim_ids, validity_to, where_column, where_ids):
+    meta = detail_model._meta
+    quote = connection.ops.quote_name
+    pk_column = meta.pk.column
+    claim_column = meta.get_field("claim").column
+    values = {
+        claim_column: (f"CASE {quote(claim_column)} {' '.join(['WHEN %s THEN %s'] * len(prev_claim_ids))} END",
+                       [claim_id for claim_ids in prev_claim_ids.items() for claim_id in claim_ids]),
+        meta.get_field("validity_to").column: ("%s", [validity_to]),
+        meta.get_field("legacy_id").column: (quote(pk_column), []),
+    }
+    columns = [field.column for field in meta.concrete_fields if field.column != pk_column]
+    select, params = [], []
+    for column in columns:
+        sql, column_params = values.get(column, (quote(column), []))
+        select.append(sql)
+        params += column_params
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {quote(meta.db_table)} ({', '.join(quote(column) for column in columns)}) "
+            f"SELECT {', '.join(select)} FROM {quote(meta.db_table)} "
+            f"WHERE {quote(where_column)} IN ({', '.join(['%s'] * len(where_ids))})",
+            params + list(where_ids))
+        return cursor.rowcount
+
+
 class ClaimDetailManager(models.Manager):
 
     def filter(self, *args, **kwargs):
@@ -455,6 +550,9 @@ class ClaimItem(core_models.VersionedModel, ClaimDetail, core_models.ExtendableM
     class Meta:
         managed = True
         db_table = 'tblClaimItems'
+        indexes = [
+            models.Index(fields=['claim', 'item'], name='claimitem_claim_item_idx'),
+        ]
 
 
 class GeneralClaimAttachmentType(models.TextChoices):
@@ -557,6 +655,9 @@ class ClaimService(core_models.VersionedModel, ClaimDetail, core_models.Extendab
     class Meta:
         managed = True
         db_table = 'tblClaimServices'
+        indexes = [
+            models.Index(fields=['claim', 'service'], name='claimservice_claim_svc_idx'),
+        ]
 
 class ClaimServiceItem(models.Model):
     id = models.AutoField(primary_key=True, db_column='idCsi')
@@ -623,3 +724,93 @@ class ClaimDedRem(core_models.VersionedModel):
     class Meta:
         managed = True
         db_table = 'tblClaimDedRem'
+
+
+class ClaimUtilization(models.Model):
+    """
+    Utilization of the insurees counted by the category maxima and the max provision rules: one row per claim
+    (item and service empty) for the category counts and one row per claimed item or service with its quantity,
+    for the current claims that are checked, processed or valuated.
+    Maintained from claim.utilization when ClaimConfig.claim_utilization_enabled, see rebuild_claim_utilization.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # derived data, no database constraint so that it never blocks the deletion of a claim, insuree, item or service
+    claim = models.ForeignKey(Claim, models.DO_NOTHING, db_column='ClaimID', db_constraint=False,
+                              related_name='utilizations')
+    insuree = models.ForeignKey(insuree_models.Insuree, models.DO_NOTHING, db_column='InsureeID', db_constraint=False,
+                                related_name='claim_utilizations')
+    target_date = fields.DateField(db_column='TargetDate')
+    category = models.CharField(db_column='ClaimCategory', max_length=1, blank=True, null=True)
+    item = models.ForeignKey(medical_models.Item, models.DO_NOTHING, db_column='ItemID', blank=True, null=True,
+                             db_constraint=False, related_name='claim_utilizations')
+    service = models.ForeignKey(medical_models.Service, models.DO_NOTHING, db_column='ServiceID', blank=True,
+                                null=True, db_constraint=False, related_name='claim_utilizations')
+    qty = models.DecimalField(db_column='Qty', max_digits=18, decimal_places=2, blank=True, null=True)
+
+    class Meta:
+        managed = True
+        db_table = 'tblClaimUtilization'
+        indexes = [
+            models.Index(fields=['insuree', 'category', 'target_date'], name='claimutil_insuree_cat_idx'),
+            models.Index(fields=['insuree', 'item', 'target_date'], name='claimutil_insuree_item_idx'),
+            models.Index(fields=['insuree', 'service', 'target_date'], name='claimutil_insuree_svc_idx'),
+            models.Index(fields=['claim'], name='claimutil_claim_idx'),
+        ]
+
+
+class ClaimDedRemLedger(models.Model):
+    """
+    Running totals of the ClaimDedRem of a policy and insuree (or of the whole policy when insuree is empty), so that
+    process_dedrem does not have to aggregate the policy history. Maintained by claim.dedrem_ledger when
+    ClaimConfig.claim_dedrem_ledger_enabled, see rebuild_claim_dedrem_ledgers.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # derived data, no database constraint so that it never blocks the deletion of a policy or insuree
+    policy = models.ForeignKey(policy_models.Policy, models.DO_NOTHING, db_column='PolicyID', db_constraint=False,
+                               related_name='claim_ded_rem_ledgers')
+    insuree = models.ForeignKey(insuree_models.Insuree, models.DO_NOTHING, db_column='InsureeID', blank=True,
+                                null=True, db_constraint=False, related_name='claim_ded_rem_ledgers')
+    ded_g = models.DecimalField(db_column='DedG', max_digits=18, decimal_places=2, default=0)
+    ded_op = models.DecimalField(db_column='DedOP', max_digits=18, decimal_places=2, default=0)
+    ded_ip = models.DecimalField(db_column='DedIP', max_digits=18, decimal_places=2, default=0)
+    rem_g = models.DecimalField(db_column='RemG', max_digits=18, decimal_places=2, default=0)
+    rem_op = models.DecimalField(db_column='RemOP', max_digits=18, decimal_places=2, default=0)
+    rem_ip = models.DecimalField(db_column='RemIP', max_digits=18, decimal_places=2, default=0)
+    rem_consult = models.DecimalField(db_column='RemConsult', max_digits=18, decimal_places=2, default=0)
+    rem_surgery = models.DecimalField(db_column='RemSurgery', max_digits=18, decimal_places=2, default=0)
+    rem_delivery = models.DecimalField(db_column='RemDelivery', max_digits=18, decimal_places=2, default=0)
+    rem_hospitalization = models.DecimalField(db_column='RemHospitalization', max_digits=18, decimal_places=2,
+                                              default=0)
+    rem_antenatal = models.DecimalField(db_column='RemAntenatal', max_digits=18, decimal_places=2, default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'tblClaimDedRemLedger'
+        unique_together = (('policy', 'insuree'),)
+        # the unique_together does not cover the policy ledgers, their insuree being NULL
+        constraints = [
+            models.UniqueConstraint(fields=['policy'], condition=models.Q(insuree__isnull=True),
+                                    name='claimdedremledger_policy_uniq'),
+        ]
+
+
+class ClaimDiagnosisBaseline(models.Model):
+    """
+    Approved amounts of the current claims of an ICD code claimed over the last claim_diagnosis_baseline_days: their
+    average (and percentiles on PostgreSQL), the baseline of the diagnosisVariance filter of the claims query.
+    Maintained by claim.diagnosis_baselines, see refresh_claim_diagnosis_baselines.
+    """
+    icd_code = models.CharField(db_column='ICDCode', max_length=50, primary_key=True)
+    avg_approved = models.DecimalField(db_column='AvgApproved', max_digits=18, decimal_places=2, blank=True,
+                                       null=True)
+    median_approved = models.DecimalField(db_column='MedianApproved', max_digits=18, decimal_places=2, blank=True,
+                                          null=True)
+    p90_approved = models.DecimalField(db_column='P90Approved', max_digits=18, decimal_places=2, blank=True,
+                                       null=True)
+    claims_count = models.IntegerField(db_column='ClaimsCount')
+    date_from = fields.DateField(db_column='DateFrom')
+    refreshed_at = models.DateTimeField(db_column='RefreshedAt')
+
+    class Meta:
+        managed = True
+        db_table = 'tblClaimDiagnosisBaseline'
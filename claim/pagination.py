@@ -0,0 +1,243 @@
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+
+from core.data_masking import anonymize_gql
+from core.schema import OrderedDjangoFilterConnectionField
+from django.core.cache import cache
+from django.db import connection as db_connection
+from django.db.models import Q
+from graphene.relay import PageInfo
+from graphql_relay.connection.arrayconnection import get_offset_with_default, offset_to_cursor
+
+from .apps import ClaimConfig
+
+KEYSET_CURSOR_PREFIX = "keyset"
+# orderBy values of the keyset mode, which only pages in the (date_claimed, id) order
+KEYSET_ORDER_BY = ("dateClaimed", "-dateClaimed")
+# page size when neither first nor last is given and the field has no max_limit
+DEFAULT_PAGE_SIZE = 100
+
+
+def _count_queryset(queryset):
+    # the selected columns (gql_optimizer only()) and the ordering do not change the count
+    return queryset.order_by().values("pk")
+
+
+def _count_cache_key(queryset):
+    """
+    Signature of the filters of the queryset, row security included since it is part of the SQL
+    """
+    sql, params = _count_queryset(queryset).query.sql_with_params()
+    return "claim_count_" + hashlib.sha1(f"{sql}{params!r}".encode()).hexdigest()
+
+
+def exact_count(queryset):
+    """
+    COUNT of the queryset, cached gql_query_claims_count_cache_ttl seconds per signature
+    """
+    ttl = ClaimConfig.gql_query_claims_count_cache_ttl
+    if not ttl:
+        return queryset.count()
+    key = _count_cache_key(queryset)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, ttl)
+    return count
+
+
+def estimated_count(queryset):
+    """
+    Row estimate of the PostgreSQL planner for the queryset, without running it. The count is exact (and cached)
+    below gql_query_claims_exact_count_threshold estimated rows, on the other databases or when already cached.
+    """
+    if db_connection.vendor != "postgresql":
+        return exact_count(queryset)
+    if ClaimConfig.gql_query_claims_count_cache_ttl:
+        count = cache.get(_count_cache_key(queryset))
+        if count is not None:
+            return count
+    sql, params = _count_queryset(queryset).query.sql_with_params()
+    with db_connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]["Plan"]["Plan Rows"])
+    if estimate < ClaimConfig.gql_query_claims_exact_count_threshold:
+        return exact_count(queryset)
+    return estimate
+
+
+def encode_keyset_cursor(claim):
+    return base64.b64encode(
+        f"{KEYSET_CURSOR_PREFIX}:{claim.date_claimed.isoformat()}:{claim.id}".encode()).decode()
+
+
+def decode_keyset_cursor(cursor):
+    """
+    :return: (date_claimed, id) of the claim of the cursor
+    """
+    try:
+        prefix, date_claimed, claim_id = base64.b64decode(cursor).decode().split(":")
+        if prefix != KEYSET_CURSOR_PREFIX:
+            raise ValueError(prefix)
+        return datetime.date.fromisoformat(date_claimed), int(claim_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Invalid keyset cursor {cursor}")
+
+
+def keyset_after(queryset, key, descending):
+    """
+    Claims after the (date_claimed, id) key in the (date_claimed, id) order. The redundant bound on date_claimed
+    makes the predicate an index range scan rather than a filter over the whole (date_claimed, id) index.
+    """
+    date_claimed, claim_id = key
+    if descending:
+        return queryset.filter(Q(date_claimed__lt=date_claimed) | Q(date_claimed=date_claimed, id__lt=claim_id),
+                               date_claimed__lte=date_claimed)
+    return queryset.filter(Q(date_claimed__gt=date_claimed) | Q(date_claimed=date_claimed, id__gt=claim_id),
+                           date_claimed__gte=date_claimed)
+
+
+def _selects_field(selections, name, fragments):
+    """
+    Whether the selections (or the fragments they spread) select the field, True when a selection cannot be inspected
+    """
+    for selection in selections:
+        kind = type(selection).__name__
+        if kind in ("Field", "FieldNode"):
+            if selection.name.value == name:
+                return True
+            continue
+        if kind in ("FragmentSpread", "FragmentSpreadNode"):
+            fragment = (fragments or {}).get(selection.name.value)
+            selection_set = fragment.selection_set if fragment is not None else None
+        elif kind in ("InlineFragment", "InlineFragmentNode"):
+            selection_set = selection.selection_set
+        else:
+            return True
+        if selection_set is None or _selects_field(selection_set.selections, name, fragments):
+            return True
+    return False
+
+
+def _selects_total_count(info):
+    return any(field_ast.selection_set is not None
+               and _selects_field(field_ast.selection_set.selections, "totalCount", getattr(info, "fragments", None))
+               for field_ast in getattr(info, "field_asts", None) or getattr(info, "field_nodes", []))
+
+
+def _page_size(size, max_limit):
+    """
+    first or last clamped to the max_limit of the field, max_limit (or DEFAULT_PAGE_SIZE) when not given
+    """
+    if max_limit:
+        return min(size, max_limit) if size else max_limit
+    return size or DEFAULT_PAGE_SIZE
+
+
+class ClaimsConnectionField(OrderedDjangoFilterConnectionField):
+    """
+    OrderedDjangoFilterConnectionField of claims with two modes that do not count all the claims of the query:
+    - keyset, when the keyset argument is true: the claims are ordered by (date_claimed, id), descending unless
+      orderBy is dateClaimed (other orderBy values than KEYSET_ORDER_BY are rejected), and the opaque cursors hold
+      the date_claimed and id of their claim, so that a page after (before) a cursor is a range on the
+      (date_claimed, id) index instead of an OFFSET over all the previous claims. offset is not supported in this
+      mode.
+    - estimated count, when estimatedCount is true (gql_query_claims_estimated_count by default): the offset
+      pages fetch one claim more than asked to know if there is a next page and the totalCount is estimated (see
+      estimated_count). Pages with last or before need the exact count and are paginated as usual.
+    In both modes, the totalCount is only computed when it is selected, and first and last are clamped to max_limit.
+    """
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class):
+        qs = super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+        args["total_count_selected"] = _selects_total_count(info)
+        return qs
+
+    @classmethod
+    def _estimates_count(cls, args):
+        estimated = args.get("estimated_count")
+        return ClaimConfig.gql_query_claims_estimated_count if estimated is None else estimated
+
+    @classmethod
+    def _total_count(cls, args, queryset):
+        if not args.get("total_count_selected"):
+            return None
+        return estimated_count(queryset) if cls._estimates_count(args) else exact_count(queryset)
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None, user=None):
+        if args.get("keyset"):
+            return cls.resolve_keyset_connection(connection, args, iterable, max_limit=max_limit, user=user)
+        if cls._estimates_count(args) and not args.get("last") and not args.get("before"):
+            return cls.resolve_estimated_connection(connection, args, iterable, max_limit=max_limit, user=user)
+        return super().resolve_connection(connection, args, iterable, max_limit=max_limit, user=user)
+
+    @classmethod
+    def _connection(cls, connection, queryset, edges, has_previous_page, has_next_page, length):
+        result = connection(
+            edges=edges,
+            page_info=PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=has_previous_page,
+                has_next_page=has_next_page,
+            ),
+        )
+        result.iterable = queryset
+        result.length = length
+        return result
+
+    @classmethod
+    @anonymize_gql()
+    def resolve_estimated_connection(cls, connection, args, queryset, max_limit=None, user=None):
+        # same offset and after semantics as DjangoConnectionField.resolve_connection
+        start = get_offset_with_default(args.get("after"), -1) + 1 + (args.get("offset") or 0)
+        size = _page_size(args.get("first"), max_limit)
+        claims = list(queryset[start:start + size + 1])
+        edges = [connection.Edge(node=claim, cursor=offset_to_cursor(start + index))
+                 for index, claim in enumerate(claims[:size])]
+        return cls._connection(connection, queryset, edges, start > 0, len(claims) > size,
+                               cls._total_count(args, queryset))
+
+    @classmethod
+    @anonymize_gql()
+    def resolve_keyset_connection(cls, connection, args, queryset, max_limit=None, user=None):
+        if args.get("offset"):
+            raise ValueError("The keyset pagination does not support offset, use after or before cursors")
+        first, last = args.get("first"), args.get("last")
+        if last:
+            last = _page_size(last, max_limit)
+        after, before = args.get("after"), args.get("before")
+        order_by = args.get("orderBy") or []
+        if any(value not in KEYSET_ORDER_BY for value in order_by) or len(order_by) > 1:
+            raise ValueError(f"The keyset pagination can only be ordered by {' or '.join(KEYSET_ORDER_BY)}")
+        descending = "dateClaimed" not in order_by
+        order = ["-date_claimed", "-id"] if descending else ["date_claimed", "id"]
+        reverse_order = ["date_claimed", "id"] if descending else ["-date_claimed", "-id"]
+
+        page = queryset
+        if after:
+            page = keyset_after(page, decode_keyset_cursor(after), descending)
+        if before:
+            page = keyset_after(page, decode_keyset_cursor(before), not descending)
+        if last and not first:
+            # the last claims before the cursor are the first ones in the reverse order
+            claims = list(page.order_by(*reverse_order)[:last + 1])
+            has_previous_page, has_next_page = len(claims) > last, bool(before)
+            claims = claims[:last][::-1]
+        else:
+            size = _page_size(first, max_limit)
+            claims = list(page.order_by(*order)[:size + 1])
+            has_previous_page, has_next_page = bool(after), len(claims) > size
+            claims = claims[:size]
+
+        edges = [connection.Edge(node=claim, cursor=encode_keyset_cursor(claim)) for claim in claims]
+        return cls._connection(connection, queryset, edges, has_previous_page, has_next_page,
+                               cls._total_count(args, queryset))
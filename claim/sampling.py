@@ -0,0 +1,67 @@
+import logging
+import math
+import secrets
+
+from django.db import connection
+from django.db.models import Value
+from django.db.models.functions import MD5, Concat
+
+from .models import Claim
+
+logger = logging.getLogger(__name__)
+
+# sample filter -> Claim lookup
+SAMPLE_FILTERS = {
+    "health_facility_uuid": "health_facility__uuid",
+    "district_uuid": "health_facility__location__uuid",
+    "date_from": "date_from__gte",
+    "date_to": "date_from__lte",
+    "claimed_min": "claimed__gte",
+    "claimed_max": "claimed__lte",
+    "status": "status__in",
+}
+
+
+def sample_claims(queryset, percentage=None, count=None, seed=None):
+    """
+    Random sample of the claims, picked by the database: only the uuids of the sample are returned.
+    On PostgreSQL, the claims are ordered by a hash of their uuid and the seed, so that a seed gives the same
+    sample again, and a fresh random seed is drawn when none is given. Other databases order them randomly
+    (ORDER BY NEWID() on MSSQL) and ignore the seed.
+    :param percentage: share of the claims to sample, rounded up
+    :param count: number of claims to sample, the smaller of both if both are given
+    :return: list of claim uuids
+    """
+    sizes = []
+    if count is not None:
+        sizes.append(max(0, count))
+    if percentage is not None:
+        sizes.append(math.ceil(queryset.count() * max(0, min(percentage, 100)) / 100))
+    if not sizes:
+        raise ValueError("A sample needs a percentage or a count")
+    size = min(sizes)
+    if not size:
+        return []
+    if connection.vendor == "postgresql":
+        if seed is None:
+            seed = secrets.token_hex(8)
+        queryset = queryset \
+            .annotate(sample_hash=MD5(Concat("uuid", Value(str(seed))))) \
+            .order_by("sample_hash", "id")
+    else:
+        queryset = queryset.order_by("?")
+    return list(queryset.values_list("uuid", flat=True)[:size])
+
+
+def sample_claims_for_status(user, sample, field, candidate_statuses):
+    """
+    Samples the claims matching the filters of a ClaimSampleInputType that can take a feedback/review status
+    :param field: feedback_status or review_status
+    :param candidate_statuses: values of the field from which the claims can be selected
+    """
+    filters = {lookup: sample[key] for key, lookup in SAMPLE_FILTERS.items() if sample.get(key) is not None}
+    queryset = Claim.get_queryset(None, user) \
+        .filter(**filters, **{f"{field}__in": candidate_statuses})
+    uuids = sample_claims(queryset, sample.get("percentage"), sample.get("count"), sample.get("seed"))
+    logger.debug("Sampled %s claims for %s with %s", len(uuids), field, sample)
+    return uuids
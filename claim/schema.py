@@ -14,6 +14,9 @@ from core import filter_validity
 from django.db.models.functions import Cast
 
 from .models import ClaimMutation
+from .pagination import ClaimsConnectionField
+from .diagnosis_baselines import diagnosis_variance_filter
+from .detail_codes import claim_items_filter, claim_services_filter, claim_attachments_filter
 from django.utils.translation import gettext as _
 from graphene_django.filter import DjangoFilterConnectionField
 import ast
@@ -24,8 +27,10 @@ from .gql_mutations import *  # lgtm [py/polluting-import]
 
 
 class Query(graphene.ObjectType):
-    claims = OrderedDjangoFilterConnectionField(
+    claims = ClaimsConnectionField(
         ClaimGQLType,
+        keyset=graphene.Boolean(required=False),
+        estimated_count=graphene.Boolean(required=False),
         diagnosisVariance=graphene.Int(),
         code_is_not=graphene.String(),
         orderBy=graphene.List(of_type=graphene.String),
@@ -137,16 +142,16 @@ class Query(graphene.ObjectType):
         services = kwargs.get("services", None)
 
         if items:
-            filters.append(Q(items__item__code__in=items))
+            filters.append(claim_items_filter(items))
 
         if services:
-            filters.append(Q(services__service__code__in=services))
+            filters.append(claim_services_filter(services))
 
         attachment_status = kwargs.get("attachment_status", 0)
         if attachment_status == AttachmentStatusEnum.WITH.value:
-            filters.append(Q(attachments__isnull=False))
+            filters.append(claim_attachments_filter(True))
         elif attachment_status == AttachmentStatusEnum.WITHOUT.value:
-            filters.append(Q(attachments__isnull=True))
+            filters.append(claim_attachments_filter(False))
 
         care_type = kwargs.get("care_type", None)
 
@@ -158,7 +163,10 @@ class Query(graphene.ObjectType):
         if json_ext:
             filters.append(Q(json_ext__jsoncontains=json_ext))
         variance = kwargs.get("diagnosisVariance", None)
-        if variance:
+        if variance and ClaimConfig.gql_query_claim_diagnosis_variance_baselines:
+            filters.append(diagnosis_variance_filter(
+                variance, ClaimConfig.gql_query_claim_diagnosis_variance_only_on_existing))
+        elif variance:
             from core import datetime, datetimedelta
 
             last_year = datetime.date.today() + datetimedelta(years=-1)
@@ -1,6 +1,8 @@
 import importlib
 import xml.etree.ElementTree as ET
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Dict
 
 from medical.models import Item, Service
@@ -15,12 +17,16 @@ from core.signals import register_service_signal
 from .apps import ClaimConfig
 from django.conf import settings
 
-from claim.models import Claim, ClaimItem, ClaimService, ClaimDetail, ClaimDedRem, FeedbackPrompt
+from claim.models import Claim, ClaimItem, ClaimService, ClaimDetail, FeedbackPrompt
 from product.models import ProductItemOrService
 
 from claim.utils import process_items_relations, process_services_relations
+from claim.dedrem_ledger import replace_claim_dedrems
+from claim.valuation import ValuationBatch
+from claim.batch_progress import BatchProgress
+from claim.utilization import refresh_claims_utilization
 from .validations import validate_claim, validate_assign_prod_to_claimitems_and_services, process_dedrem, \
-    approved_amount, get_claim_category
+    approved_amount, get_claim_category, REJECTION_REASON_INVALID_CLAIM
 from django.db.models import Subquery, F, OuterRef, Sum, FloatField
 from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AnonymousUser
@@ -558,6 +564,71 @@ def submit_claim(claim, user):
     return c_errors
 
 
+def partition_claims_by_family(claims, partitions):
+    """
+    Splits the claims in at most `partitions` lists that can be submitted independently. The claims of a family
+    (or of an insuree without family) stay together and in order: the validation counts the previous claims of the
+    insuree and the deductibles and ceilings count the previous claims of the policy, which covers the family.
+    :return: list of lists of claims, the largest families being spread first
+    """
+    families = defaultdict(list)
+    for claim in claims:
+        family_id = claim.insuree.family_id
+        families[("family", family_id) if family_id else ("insuree", claim.insuree_id)].append(claim)
+    buckets = [[] for _ in range(max(1, min(partitions, len(families))))]
+    for family_claims in sorted(families.values(), key=len, reverse=True):
+        min(buckets, key=len).extend(family_claims)
+    return [bucket for bucket in buckets if bucket]
+
+
+def submit_claims(claims, user):
+    """
+    Submits the claims in order, in the current transaction. The claims no longer entered (e.g. submitted by an
+    interrupted run of the same batch) are locked and reported instead of being submitted again.
+    :return: list of (claim, errors), in the order of the claims
+    """
+    entered = set(Claim.objects
+                  .select_for_update()
+                  .filter(id__in=[claim.id for claim in claims], status=Claim.STATUS_ENTERED)
+                  .values_list("id", flat=True))
+    return [(claim, submit_claim(claim, user) if claim.id in entered else [{
+        'code': REJECTION_REASON_INVALID_CLAIM,
+        'message': _("claim.validation.claim_not_entered") % {'code': claim.code}}])
+            for claim in claims]
+
+
+def _submit_claims_partition(claims, user):
+    try:
+        with transaction.atomic():
+            return submit_claims(claims, user)
+    except Exception as exc:
+        # the partition is rolled back as a whole, the other partitions are not affected
+        logger.exception("SubmitClaimsMutation: submitting a partition of %s claims failed", len(claims))
+        return [(claim, _status_change_errors(claim, exc)) for claim in claims]
+    finally:
+        # each worker thread has its own database connection
+        connection.close()
+
+
+def submit_claims_in_parallel(claims, user, workers):
+    """
+    Submits the claims of different families concurrently, each partition (see partition_claims_by_family) in its
+    own thread, database connection and transaction. The claims of a partition are submitted in order and see the
+    effects of the previous ones like in the serial submission (see submit_claims). A partition that fails is
+    rolled back and its claims reported in error, without stopping the other ones.
+    The workers commit on their own connections, so that no enclosing transaction could roll them back: this must
+    not be called in a transaction.
+    :return: list of (claim, errors), in the order of the claims
+    """
+    assert not connection.in_atomic_block, "The parallel submission cannot run in a transaction"
+    claims = list(claims)
+    partitions = partition_claims_by_family(claims, workers)
+    with ThreadPoolExecutor(max_workers=len(partitions) or 1) as executor:
+        results = list(executor.map(lambda partition: _submit_claims_partition(partition, user), partitions))
+    errors = {claim.id: c_errors for result in results for claim, c_errors in result}
+    return [(claim, errors[claim.id]) for claim in claims]
+
+
 def set_claim_submitted(claim, errors, user):
     try:
         claim.audit_user_id_submit = user.id_for_audit
@@ -591,14 +662,53 @@ def validate_and_process_dedrem_claim(claim, user, is_process):
                      len(errors))
     else:
         # OMT-208 the claim is invalid. If there is a dedrem, we need to clear it (caused by a review)
-        deleted_dedrems = ClaimDedRem.objects.filter(claim=claim).delete()
+        deleted_dedrems = replace_claim_dedrems(claim)
         if deleted_dedrems:
             logger.debug(f"Claim {claim.uuid} is invalid, we deleted its dedrem ({deleted_dedrems})")
     if is_process:
         errors += set_claim_processed_or_valuated(claim, errors, user)
+    else:
+        # the details were validated and valuated again without saving the claim (no post_save)
+        refresh_claims_utilization([claim.id])
     return errors
 
 
+def validate_and_process_dedrem_claims(claims, user):
+    """
+    Batch version of validate_and_process_dedrem_claim(claim, user, True): the claims are validated in order, the
+    invalid ones being rejected right away, then the valid ones are valuated in order with a ValuationBatch.
+    The validation only counts the details of the other claims by their status, and the valuation reads the
+    ClaimDedRem of the previous claims when it runs, so both give the same results as the per-claim path.
+    :return: list of (claim, errors), in the order of the claims
+    """
+    claims = list(claims)
+    errors = {}
+    to_valuate = []
+    for claim in claims:
+        c_errors = validate_claim(claim, False)
+        logger.debug("ProcessClaimsMutation: claim %s validated, nb of errors: %s", claim.uuid, len(c_errors))
+        if len(c_errors) == 0:
+            c_errors = validate_assign_prod_to_claimitems_and_services(claim)
+            logger.debug("ProcessClaimsMutation: claim %s assigned, nb of errors: %s", claim.uuid, len(c_errors))
+            if len(c_errors) == 0:
+                to_valuate.append(claim)
+                continue
+            c_errors += process_dedrem(claim, user.id_for_audit, True)
+        else:
+            deleted_dedrems = replace_claim_dedrems(claim)
+            if deleted_dedrems:
+                logger.debug(f"Claim {claim.uuid} is invalid, we deleted its dedrem ({deleted_dedrems})")
+        errors[claim.id] = c_errors + set_claim_processed_or_valuated(claim, c_errors, user)
+
+    plans = ValuationBatch(to_valuate).plans()
+    for claim in to_valuate:
+        c_errors = process_dedrem(claim, user.id_for_audit, True, plan=plans[claim.id])
+        logger.debug("ProcessClaimsMutation: claim %s processed for dedrem, nb of errors: %s", claim.uuid,
+                     len(c_errors))
+        errors[claim.id] = c_errors + set_claim_processed_or_valuated(claim, c_errors, user)
+    return [(claim, errors[claim.id]) for claim in claims]
+
+
 def set_claim_processed_or_valuated(claim, errors, user):
     try:
         if errors:
@@ -633,82 +743,179 @@ def with_relative_prices(claim):
     return details_with_relative_prices(claim.items) or details_with_relative_prices(claim.services)
 
 
+def _status_change_errors(claim, exc=None):
+    errors = [
+        {'message': _("claim.mutation.failed_to_change_status_of_claim") %
+                    {'code': claim.code}}
+    ]
+    if hasattr(exc, 'messages') and len(exc.messages):
+        for m in exc.messages:
+            errors.append({'message': m})
+    elif hasattr(exc, 'args') and len(exc.args):
+        for m in exc.args:
+            errors.append({'message': m})
+    return errors
+
+
+def _set_status_in_bulk(claims, field, status, audit_data, feedback_prompts):
+    claim_ids = [claim.id for claim in claims]
+    Claim.save_histories(claims)
+    # the UPDATE sends no post_save: the only receiver of the claims, on_claim_saved, refreshes their
+    # tblClaimUtilization rows from the status, category, dates and details, none of which is changed here
+    Claim.objects.filter(id__in=claim_ids).update(**{field: status, **(audit_data or {})})
+    if feedback_prompts:
+        FeedbackPrompt.objects.bulk_create(feedback_prompts.values())
+    elif field == 'feedback_status' and status in [Claim.FEEDBACK_NOT_SELECTED, Claim.FEEDBACK_BYPASSED]:
+        retire_feedback_prompts(claim_ids)
+
+
+def _set_status(claim, field, status, audit_data, feedback_prompt):
+    claim.save_history()
+    setattr(claim, field, status)
+    if feedback_prompt is not None:
+        # the prompt may keep the id of a rolled back bulk insert
+        feedback_prompt.id = None
+        feedback_prompt.save()
+    elif field == 'feedback_status' and status in [Claim.FEEDBACK_NOT_SELECTED, Claim.FEEDBACK_BYPASSED]:
+        retire_feedback_prompts([claim.id])
+    for key, value in (audit_data or {}).items():
+        setattr(claim, key, value)
+    claim.save()
+
+
 def set_claims_status(uuids, field, status, audit_data=None, user=None):
+    """
+    Sets the feedback or review status of the claims, ClaimConfig.batch_chunk_size claims at a time: the claims
+    that cannot take the status (or get a feedback prompt) are reported, the history of the others is saved in bulk
+    (see Claim.save_histories), the status and audit fields are set with one UPDATE and the feedback prompts are
+    created or retired in bulk. When the bulk write of a chunk fails, it is rolled back and its claims are set one
+    by one, so that only the claims in error are reported.
+    """
     errors = []
-    claims = Claim.objects \
-            .filter(uuid__in=uuids,
-                    *filter_validity()) 
-    remaining_uuid = list(map(str.upper,uuids))
-    for claim in claims:
-        remaining_uuid.remove(claim.uuid.upper())        
-        try:
-            claim.save_history()
-            setattr(claim, field, status)
-            # creating/cancelling feedback prompts
-            if field == 'feedback_status':
-                if status == Claim.FEEDBACK_SELECTED:
-                    create_feedback_prompt(claim, user)
-                elif status in [Claim.FEEDBACK_NOT_SELECTED, Claim.FEEDBACK_BYPASSED]:
-                    set_feedback_prompt_validity_to_to_current_date(claim.uuid)
-            if audit_data:
-                for k, v in audit_data.items():
-                    setattr(claim, k, v)
-            claim.save()
-        except Exception as exc:
-            errors += [
-                {'message': _("claim.mutation.failed_to_change_status_of_claim") %
-                            {'code': claim.code} }
-            ]
-            if hasattr(exc, 'messages') and len(exc.messages):
-                for m in exc.messages:
-                    errors.append({'message': m })
-            elif hasattr(exc, 'args') and len(exc.args):
-                for m in exc.args:
-                    errors.append({'message': m })
-        if len(remaining_uuid):
-            errors.append(_(
-                "claim.validation.id_does_not_exist") % {'id': ','.join(remaining_uuid)})                  
-                        
+    progress = BatchProgress(None, uuids)
+    for chunk in progress.chunks():
+        with transaction.atomic():
+            claims = Claim.objects.filter(*filter_validity(), uuid__in=chunk)
+            if field == 'feedback_status' and status == Claim.FEEDBACK_SELECTED:
+                claims = claims.select_related("insuree__current_village", "insuree__family__location")
+            claims = list(claims)
+            officer_index = FeedbackOfficerIndex.for_claims(claims) \
+                if field == 'feedback_status' and status == Claim.FEEDBACK_SELECTED else None
+            updated = []
+            feedback_prompts = {}
+            failed = 0
+            for claim in claims:
+                if field == 'feedback_status' and status == Claim.FEEDBACK_SELECTED:
+                    try:
+                        feedback_prompts[claim.id] = build_feedback_prompt(claim, user, officer_index)
+                    except Exception as exc:
+                        errors += _status_change_errors(claim, exc)
+                        failed += 1
+                        continue
+                updated.append(claim)
+            if updated:
+                try:
+                    with transaction.atomic():
+                        _set_status_in_bulk(updated, field, status, audit_data, feedback_prompts)
+                    for claim in updated:
+                        setattr(claim, field, status)
+                except Exception as exc:
+                    logger.warning("Setting %s of %s claims in bulk failed, setting them one by one: %s",
+                                   field, len(updated), exc)
+                    for claim in updated:
+                        try:
+                            with transaction.atomic():
+                                _set_status(claim, field, status, audit_data, feedback_prompts.get(claim.id))
+                        except Exception as claim_exc:
+                            errors += _status_change_errors(claim, claim_exc)
+                            failed += 1
+            progress.checkpoint(chunk, [claim.uuid for claim in claims], failed)
+    if len(progress.not_found):
+        errors.append(_(
+            "claim.validation.id_does_not_exist") % {'id': ','.join(progress.not_found)})
     return errors
 
 
 def create_feedback_prompt(current_claim, user):
-    
+    build_feedback_prompt(current_claim, user).save()
+
+
+def _insuree_villages(insuree):
+    villages = []
+    if insuree.current_village:
+        villages.append(insuree.current_village)
+    if insuree.family.location:
+        villages.append(insuree.family.location)
+    return villages
+
+
+class FeedbackOfficerIndex:
+    """
+    Village -> current officers (id, code, phone), loaded with one query for all the villages of a batch of claims
+    so that their feedback prompt officers are found in memory
+    """
+
+    def __init__(self, villages):
+        self.officers = defaultdict(list)
+        village_ids = {village.id for village in villages if village}
+        if not village_ids:
+            return
+        for village_id, officer_id, code, phone in Officer.objects \
+                .filter(*filter_validity(), officer_villages__location_id__in=village_ids) \
+                .order_by("id") \
+                .values_list("officer_villages__location_id", "id", "code", "phone"):
+            self.officers[village_id].append((officer_id, code, phone))
+
+    @classmethod
+    def for_claims(cls, claims):
+        return cls([village for claim in claims for village in _insuree_villages(claim.insuree)])
+
+    def get_officers(self, villages):
+        """
+        :return: (first officer of the villages with a phone number or None, first officer of the villages or None)
+        """
+        officers = sorted({officer for village in villages for officer in self.officers.get(village.id, [])})
+        with_phone = [officer for officer in officers if officer[2]]
+        return with_phone[0] if with_phone else None, officers[0] if officers else None
+
+
+def build_feedback_prompt(current_claim, user, officer_index=None):
+    """
+    Unsaved FeedbackPrompt of the claim, sent to an officer of the insuree's village with a phone number
+    :param officer_index: FeedbackOfficerIndex of the batch, loaded for the claim alone by default
+    """
     feedback_prompt = {}
     from core.utils import TimeUtils
     feedback_prompt['feedback_prompt_date'] = TimeUtils.date()
     feedback_prompt['validity_from'] = TimeUtils.now()
     feedback_prompt['claim'] = current_claim
-    villages = []
-    if current_claim.insuree.current_village:
-        villages.append(current_claim.insuree.current_village)
-    if current_claim.insuree.family.location:
-        villages.append(current_claim.insuree.family.location)
-    officer = Officer.objects.filter(
-        *filter_validity(),
-        officer_villages__location__in=villages,
-        phone__isnull = False
-    ).exclude(phone__exact= '').first()
+    villages = _insuree_villages(current_claim.insuree)
+    if officer_index is None:
+        officer_index = FeedbackOfficerIndex(villages)
+    officer, any_officer = officer_index.get_officers(villages)
     if not officer:
-        bad_officer = Officer.objects.filter(
-        *filter_validity(),
-        officer_villages__location__in=villages,
-        ).first()
-        if bad_officer:
-            msg = [' officer '+bad_officer.code+ 'has not phone setup']
+        if any_officer:
+            msg = [' officer '+any_officer[1]+ 'has not phone setup']
         else:
             msg = []
         raise RuntimeError(f"No officer with a phone number found for the insuree village code, \
             {', '.join([str(v.code) for v in villages ])}", *msg)
-            
-    feedback_prompt['officer_id'] = officer.id
-    feedback_prompt['phone_number'] = officer.phone
+
+    feedback_prompt['officer_id'] = officer[0]
+    feedback_prompt['phone_number'] = officer[2]
     feedback_prompt['audit_user_id'] = user.id_for_audit
-    FeedbackPrompt.objects.create(
+    return FeedbackPrompt(
         **feedback_prompt
     )
 
 
+def retire_feedback_prompts(claim_ids):
+    from core.utils import TimeUtils
+    return FeedbackPrompt.objects \
+        .filter(claim_id__in=claim_ids, validity_to__isnull=True) \
+        .update(validity_to=TimeUtils.now())
+
+
 def set_feedback_prompt_validity_to_to_current_date(claim_uuid):
     try:
         claim = Claim.objects.get(uuid=claim_uuid).id
@@ -721,15 +928,27 @@ def set_feedback_prompt_validity_to_to_current_date(claim_uuid):
         return "No such feedback prompt exist."
 
 
-def update_claims_dedrems(uuids, user):
+def update_claims_dedrems(uuids, user, client_mutation_id=None):
+    """
+    Reprocesses the dedrem of the claims, batch_chunk_size claims per transaction
+    :param client_mutation_id: MutationLog in which the progress is checkpointed (see BatchProgress)
+    """
     # We could do it in one query with filter(claim__uuid__in=uuids) but we'd loose the logging
     errors = []
-    claims = Claim.objects.filter(uuid__in=uuids)
-    remaining_uuid = list(map(str.upper,uuids))
-    for claim in claims:
-        remaining_uuid.remove(claim.uuid.upper())       
-        logger.debug(f"delivering review on {claim.uuid}, reprocessing dedrem ({user})")
-        errors += validate_and_process_dedrem_claim(claim, user, False)
+    progress = BatchProgress(client_mutation_id, uuids)
+    for chunk in progress.chunks():
+        with transaction.atomic():
+            claims = list(Claim.objects.filter(uuid__in=chunk))
+            chunk_errors = []
+            failed = 0
+            for claim in claims:
+                logger.debug(f"delivering review on {claim.uuid}, reprocessing dedrem ({user})")
+                c_errors = validate_and_process_dedrem_claim(claim, user, False)
+                failed += 1 if c_errors else 0
+                chunk_errors += c_errors
+            progress.checkpoint(chunk, [claim.uuid for claim in claims], failed)
+        errors += chunk_errors
+    remaining_uuid = progress.not_found
     if len(remaining_uuid):
         errors.append(_(
             "claim.validation.id_does_not_exist") % {'id': ','.join(remaining_uuid)})
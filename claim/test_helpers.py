@@ -1,6 +1,7 @@
-from claim.models import Claim, ClaimService, ClaimItem, ClaimDedRem, ClaimAdmin
+from claim.models import Claim, ClaimService, ClaimItem, ClaimAdmin
 from claim.validations import get_claim_category, approved_amount
 from claim.services import claim_create, update_sum_claims
+from claim.dedrem_ledger import replace_claim_dedrems
 from medical.test_helpers import get_item_of_type, get_service_of_category
 from uuid import uuid4
 
@@ -79,7 +80,7 @@ def mark_test_claim_as_processed(claim, status=Claim.STATUS_CHECKED, audit_user_
 
 def delete_claim_with_itemsvc_dedrem_and_history(claim):
     # first delete old versions of the claim
-    ClaimDedRem.objects.filter(claim=claim).delete()
+    replace_claim_dedrems(claim)
     old_claims = Claim.objects.filter(legacy_id=claim.id)
     ClaimItem.objects.filter(claim__in=old_claims).delete()
     ClaimService.objects.filter(claim__in=old_claims).delete()
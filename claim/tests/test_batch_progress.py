@@ -0,0 +1,31 @@
+from claim.batch_progress import BatchProgress
+from core.models import MutationLog
+from django.test import TestCase
+
+
+class BatchProgressTest(TestCase):
+    def test_batch_progress_resume(self):
+        # Given
+        mutation_log = MutationLog.objects.create(json_content="{}", client_mutation_id="test_batch_progress")
+        uuids = ["a1", "b2", "c3", "d4", "e5"]
+
+        # When the run stops after its first chunk
+        progress = BatchProgress("test_batch_progress", uuids, chunk_size=2)
+        chunk = next(progress.chunks())
+        progress.checkpoint(chunk, ["A1"], 1)
+
+        # Then the next run of the same batch resumes after it
+        resumed = BatchProgress("test_batch_progress", uuids, chunk_size=2)
+        self.assertEqual(next(resumed.chunks()), ["c3", "d4"])
+        self.assertEqual((resumed.done, resumed.failed, resumed.remaining), (0, 1, 3))
+        self.assertEqual(resumed.not_found, ["B2"])
+        mutation_log.refresh_from_db()
+        self.assertEqual(mutation_log.json_ext["batch_progress"]["remaining"], 3)
+        # the chunks move on even when they are not checkpointed
+        self.assertEqual(list(resumed.chunks()), [["c3", "d4"], ["e5"]])
+        # ... but another batch starts from the beginning
+        self.assertEqual(BatchProgress("test_batch_progress", uuids[1:], chunk_size=2).position, 0)
+
+        # tearDown
+        mutation_log.delete()
+
@@ -0,0 +1,43 @@
+import datetime
+import random
+
+from claim.claim_generator import ClaimGenerator
+from claim.models import Claim, ClaimItem, ClaimService
+from django.test import TestCase
+
+
+class ClaimGeneratorTest(TestCase):
+    def test_generate_claims(self):
+        # Given
+        generator = ClaimGenerator(seed=7, date_from=datetime.date(2019, 1, 1), date_to=datetime.date(2019, 12, 31),
+                                   nb_insurees=20, audit_user_id=-77)
+        generator.load()
+        same_seed = ClaimGenerator(seed=7, date_from=datetime.date(2019, 1, 1),
+                                   date_to=datetime.date(2019, 12, 31), nb_insurees=20, audit_user_id=-77)
+        same_seed.load()
+
+        # When
+        claim, details = generator.build_claim(random.Random("7-0"), 2, 3)
+        same_claim, same_details = same_seed.build_claim(random.Random("7-0"), 2, 3)
+        generated = generator.generate(0, 5, 2, 3, batch_size=2)
+
+        # Then
+        self.assertEqual((claim.uuid, claim.insuree_id, claim.health_facility_id, claim.date_from, claim.claimed),
+                         (same_claim.uuid, same_claim.insuree_id, same_claim.health_facility_id,
+                          same_claim.date_from, same_claim.claimed))
+        self.assertEqual(len(details), len(same_details))
+        self.assertEqual(generated, 5)
+        claims = Claim.objects.filter(audit_user_id=-77)
+        self.assertEqual(claims.count(), 5)
+        self.assertEqual(sorted(claims.values_list("code", flat=True)), [f"G7-0-{number}" for number in range(5)])
+        self.assertEqual(generator.claim_code(3, 36 ** 2 + 35), "G7-3-10Z")
+        for generated_claim in claims:
+            self.assertTrue(datetime.date(2019, 1, 1) <= generated_claim.date_from <= datetime.date(2019, 12, 31))
+            self.assertEqual(generated_claim.claimed, sum(
+                detail.qty_provided * detail.price_asked
+                for detail in list(generated_claim.items.all()) + list(generated_claim.services.all())))
+
+        # tearDown
+        ClaimItem.objects.filter(claim__in=claims).delete()
+        ClaimService.objects.filter(claim__in=claims).delete()
+        claims.delete()
@@ -0,0 +1,61 @@
+import io
+
+from claim.claim_import import ClaimImporter, read_csv_claims, read_jsonl_claims
+from claim.models import Claim, ClaimItem
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from location.models import HealthFacility
+from medical.models import Diagnosis
+from medical.test_helpers import create_test_item
+
+
+class ClaimImportTest(TestCase):
+    def test_import_claims(self):
+        # Given
+        insuree = create_test_insuree()
+        item = create_test_item("D")
+        hf = HealthFacility.objects.get(id=18)
+        icd = Diagnosis.objects.get(id=116)
+        csv_file = io.StringIO(
+            "code,insuree_chf_id,health_facility_code,icd_code,date_from,line_type,line_code,qty,price\n"
+            f"IMP1,{insuree.chf_id},{hf.code},{icd.code},2019-06-01,item,{item.code},2,10\n"
+            f"IMP1,{insuree.chf_id},{hf.code},{icd.code},2019-06-01,item,{item.code},1,\n"
+            f"IMP2,UNKNOWN,{hf.code},{icd.code},2019-06-01,item,{item.code},1,5\n"
+            f"IMP3,{insuree.chf_id},{hf.code},{icd.code},2019-13-01,item,{item.code},1,5\n")
+        records = [(line, record) for line, record, _ in read_csv_claims(csv_file)]
+        records += [(6, {"code": "IMP5", "insuree_chf_id": insuree.chf_id, "health_facility_code": hf.code,
+                         "icd_code": icd.code, "date_from": "2019-06-01", "items": ["X"]}),
+                    (7, {"code": "IMP6", "insuree_chf_id": insuree.chf_id, "health_facility_code": hf.code,
+                         "icd_code": icd.code, "date_from": "2019-06-01", "items": "abc"}),
+                    (8, {"code": "I" * 51, "insuree_chf_id": insuree.chf_id, "health_facility_code": hf.code,
+                         "icd_code": icd.code, "date_from": "2019-06-01",
+                         "items": [{"code": item.code, "qty": 1}]}),
+                    (9, {"code": "IMP7", "insuree_chf_id": insuree.chf_id, "health_facility_code": hf.code,
+                         "icd_code": icd.code, "date_from": "2019-06-01",
+                         "items": [{"code": item.code, "qty": "NaN"}, {"code": item.code, "qty": 0},
+                                   {"code": item.code, "qty": 1, "price": "Infinity"},
+                                   {"code": item.code, "qty": 1, "price": -5}]})]
+        jsonl_file = io.StringIO('{"code": "IMP4"}\n[1, 2]\n{"code"\n')
+
+        # When
+        uuids, rejected = ClaimImporter().import_batch(records)
+        jsonl_errors = [(line, error is not None) for line, _, error in read_jsonl_claims(jsonl_file)]
+
+        # Then the invalid date, lines and code only reject their own claims
+        self.assertEqual(len(uuids), 1)
+        self.assertEqual([line for line, _, _ in rejected], [4, 5, 6, 7, 8, 9])
+        self.assertEqual(rejected[1][2], ["Invalid date_from 2019-13-01"])
+        self.assertEqual(rejected[2][2], ["items[0] is not an object", "The claim has no item or service"])
+        self.assertEqual(rejected[3][2], ["items is not a list", "The claim has no item or service"])
+        self.assertEqual(rejected[4][2], ["code longer than 50 characters"])
+        self.assertEqual(rejected[5][2], [f"Invalid quantity or price for item {item.code}"] * 4)
+        self.assertEqual(jsonl_errors, [(1, False), (2, True), (3, True)])
+        claim = Claim.objects.get(uuid=uuids[0])
+        self.assertEqual(claim.status, Claim.STATUS_ENTERED)
+        self.assertEqual(claim.insuree_id, insuree.id)
+        self.assertEqual(claim.claimed, 20 + item.price)
+        self.assertEqual(ClaimItem.objects.filter(claim=claim).count(), 2)
+
+        # tearDown
+        ClaimItem.objects.filter(claim=claim).delete()
+        claim.delete()
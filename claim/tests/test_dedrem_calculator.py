@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+from claim.dedrem_calculator import ValuationDetail, get_deductible_and_ceiling, valuate_details
+from django.test import TestCase
+
+
+class DedRemCalculatorTest(TestCase):
+    def test_dedrem_calculator_ceiling(self):
+        # Given a product with a ceiling of 1000 per insuree, of which 900 were already remunerated
+        product = SimpleNamespace(ceiling_interpretation="I", max_insuree=1000, max_policy=None, threshold=None)
+        detail = ValuationDetail(quantity=3, price_adjusted=100, limitation=None, limitation_value=None,
+                                 ceiling_exclusion_adult=None, ceiling_exclusion_child=None)
+
+        # When
+        deductible, ceiling = get_deductible_and_ceiling(product, 1, False, "D", {"rem_g": 900}, {})
+        valuations, totals = valuate_details([detail, detail], product, deductible, ceiling, "V", False, "D", True)
+
+        # Then
+        self.assertIsNone(deductible)
+        self.assertEqual(ceiling.amount, 1000)
+        self.assertEqual([(v.price_valuated, v.exceed_ceiling_amount) for v in valuations], [(100, 200), (0, 300)])
+        self.assertEqual(totals["rem_g"], 100)
@@ -0,0 +1,74 @@
+from unittest.mock import patch
+
+from claim.apps import ClaimConfig
+from claim.dedrem_ledger import PreviousDedRems, build_ledgers, get_ledger, replace_claim_dedrems
+from claim.models import ClaimDedRemLedger
+from claim.test_helpers import create_test_claim
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from policy.test_helpers import create_test_policy
+from product.test_helpers import create_test_product
+
+
+class DedRemLedgerTest(TestCase):
+    def test_dedrem_ledger(self):
+        # Given
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT")
+        policy = create_test_policy(product, insuree, link=True)
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        claim2 = create_test_claim({"insuree_id": insuree.id})
+        dedrem = {"policy": policy, "insuree": insuree, "audit_user_id": -1, "rem_g": 100}
+        with patch.object(ClaimConfig, "claim_dedrem_ledger_enabled", True):
+            replace_claim_dedrems(claim1, {**dedrem, "claim": claim1})
+
+            # When the ledger is initialized from the existing dedrems, then updated with a new one
+            self.assertEqual(PreviousDedRems(claim2).get("rem_g", policy.id, insuree.id), 100)
+            replace_claim_dedrems(claim2, {**dedrem, "claim": claim2, "rem_g": 50})
+
+            # Then
+            self.assertEqual(PreviousDedRems(claim2).get("rem_g", policy.id, insuree.id), 100)
+            self.assertEqual(PreviousDedRems(claim1).get("rem_g", policy.id), 50)
+            self.assertEqual(ClaimDedRemLedger.objects.filter(policy=policy, insuree__isnull=True).count(), 1)
+            self.assertEqual(
+                sorted((ledger.insuree_id, ledger.rem_g) for ledger in build_ledgers([policy.id])),
+                sorted((ledger.insuree_id, ledger.rem_g)
+                       for ledger in ClaimDedRemLedger.objects.filter(policy=policy)))
+            replace_claim_dedrems(claim1)
+            self.assertEqual(PreviousDedRems(claim2).get("rem_g", policy.id), 0)
+
+        # tearDown
+        replace_claim_dedrems(claim2)
+        ClaimDedRemLedger.objects.filter(policy=policy).delete()
+        claim2.delete()
+        claim1.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product.delete()
+
+    def test_dedrem_without_insuree(self):
+        # Given
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT")
+        policy = create_test_policy(product, insuree, link=True)
+        claim = create_test_claim({"insuree_id": insuree.id})
+        with patch.object(ClaimConfig, "claim_dedrem_ledger_enabled", True):
+            self.assertEqual(get_ledger(policy.id).rem_g, 0)
+
+            # When a ClaimDedRem has no insuree
+            replace_claim_dedrems(claim, {"policy": policy, "claim": claim, "audit_user_id": -1, "rem_g": 100})
+
+            # Then it is counted once in the ledger of the policy
+            self.assertEqual(get_ledger(policy.id).rem_g, 100)
+            self.assertEqual([(ledger.insuree_id, ledger.rem_g) for ledger in build_ledgers([policy.id])],
+                             [(None, 100)])
+
+            replace_claim_dedrems(claim)
+
+        # tearDown
+        ClaimDedRemLedger.objects.filter(policy=policy).delete()
+        claim.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product.delete()
+
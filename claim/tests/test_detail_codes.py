@@ -0,0 +1,30 @@
+from claim.detail_codes import claim_items_filter, claim_attachments_filter
+from claim.models import Claim
+from claim.test_helpers import create_test_claim, create_test_claimitem, delete_claim_with_itemsvc_dedrem_and_history
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from medical.test_helpers import create_test_item
+
+
+class DetailCodesTest(TestCase):
+    def test_claim_detail_filters(self):
+        # Given
+        insuree = create_test_insuree()
+        claim = create_test_claim({"insuree_id": insuree.id})
+        item = create_test_item("D")
+        create_test_claimitem(claim, "D", custom_props={"item_id": item.id})
+        create_test_claimitem(claim, "D", custom_props={"item_id": item.id})
+        claims = Claim.objects.filter(id=claim.id)
+
+        # When
+        with_item = claims.filter(claim_items_filter([item.code, "UNKNOWN"]))
+        with_other_item = claims.filter(claim_items_filter(["UNKNOWN"]))
+        without_attachments = claims.filter(claim_attachments_filter(False))
+
+        # Then
+        self.assertEqual(list(with_item), [claim])
+        self.assertEqual(list(with_other_item), [])
+        self.assertEqual(list(without_attachments), [claim])
+
+        # tearDown
+        delete_claim_with_itemsvc_dedrem_and_history(claim)
@@ -0,0 +1,38 @@
+import datetime
+
+from claim.diagnosis_baselines import refresh_diagnosis_baselines, diagnosis_variance_filter
+from claim.models import Claim, ClaimDiagnosisBaseline
+from claim.test_helpers import create_test_claim, delete_claim_with_itemsvc_dedrem_and_history
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from medical.models import Diagnosis
+
+
+class DiagnosisBaselinesTest(TestCase):
+    def test_diagnosis_baselines(self):
+        # Given
+        insuree = create_test_insuree()
+        today = datetime.date.today()
+        icd = Diagnosis.objects.get(id=116)
+        claims = [create_test_claim({"insuree_id": insuree.id, "date_claimed": today, "claimed": claimed,
+                                     "approved": approved})
+                  for claimed, approved in ((100, 100), (300, 300), (10000, None))]
+
+        # When
+        refreshed = refresh_diagnosis_baselines([icd.code])
+        outliers = Claim.objects.filter(id__in=[claim.id for claim in claims]) \
+            .filter(diagnosis_variance_filter(50))
+
+        # Then
+        self.assertEqual(refreshed, 1)
+        baseline = ClaimDiagnosisBaseline.objects.get(icd_code=icd.code)
+        expected = Claim.objects.filter(validity_to__isnull=True, icd__code=icd.code,
+                                        date_claimed__gt=today - datetime.timedelta(days=365))
+        self.assertEqual(baseline.claims_count, expected.count())
+        self.assertIsNotNone(baseline.avg_approved)
+        self.assertIn(claims[2], outliers)
+
+        # tearDown
+        ClaimDiagnosisBaseline.objects.all().delete()
+        for claim in claims:
+            delete_claim_with_itemsvc_dedrem_and_history(claim)
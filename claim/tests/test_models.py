@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+from claim.models import Claim, ClaimItem, ClaimService
+from claim.test_helpers import create_test_claim, create_test_claimservice, create_test_claimitem
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from medical.test_helpers import create_test_item
+
+
+class ClaimHistoryTest(TestCase):
+    def test_claim_save_history_statements(self):
+        # Given claims of 1, 20 and 200 lines
+        item = create_test_item("D")
+        statements = {}
+        for lines in (1, 20, 200):
+            claim = create_test_claim()
+            ClaimItem.objects.bulk_create([ClaimItem(
+                claim=claim, item=item, qty_provided=1, price_asked=11, status=ClaimItem.STATUS_PASSED,
+                availability=True, validity_from="2019-06-01", audit_user_id=-1) for _ in range(lines)])
+            claim_service = create_test_claimservice(claim)
+
+            # When
+            with CaptureQueriesContext(connection) as queries:
+                prev_id = claim.save_history()
+            statements[lines] = len(queries)
+
+            # Then
+            self.assertEqual(ClaimItem.objects.filter(claim_id=prev_id, validity_to__isnull=False).count(), lines)
+            self.assertEqual(ClaimItem.objects.filter(claim_id=claim.id, validity_to__isnull=True).count(), lines)
+            history_service = ClaimService.objects.get(claim_id=prev_id)
+            self.assertEqual(history_service.legacy_id, claim_service.id)
+            self.assertIsNotNone(history_service.validity_to)
+
+            # tearDown
+            ClaimService.objects.filter(claim_id__in=[claim.id, prev_id]).delete()
+            ClaimItem.objects.filter(claim_id__in=[claim.id, prev_id]).delete()
+            Claim.objects.filter(id__in=[claim.id, prev_id]).delete()
+        # one INSERT for the claim, one per detail table, whatever the number of lines (was 2N+3)
+        self.assertEqual(statements[1], statements[20])
+        self.assertEqual(statements[1], statements[200])
+        item.delete()
+
+
+    def test_save_histories_in_batches(self):
+        # Given
+        claims = [create_test_claim(custom_props={'status': Claim.STATUS_CHECKED}) for _ in range(3)]
+        items = [create_test_claimitem(claim, "D") for claim in claims]
+
+        # When the database only takes one claim per statement
+        with patch.object(connection.ops, "bulk_batch_size", return_value=2):
+            prev_ids = Claim.save_histories(claims)
+
+        # Then
+        self.assertEqual(len(prev_ids), 3)
+        for claim, item in zip(claims, items):
+            history_item = ClaimItem.objects.get(claim_id=prev_ids[claim.id])
+            self.assertEqual(history_item.legacy_id, item.id)
+            self.assertIsNotNone(history_item.validity_to)
+
+        # tearDown
+        ClaimItem.objects.filter(claim_id__in=[*prev_ids, *prev_ids.values()]).delete()
+        Claim.objects.filter(id__in=prev_ids.values()).delete()
+        for claim in claims:
+            claim.delete()
+
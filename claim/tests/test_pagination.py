@@ -0,0 +1,92 @@
+import json
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
+
+from claim.apps import ClaimConfig
+from claim.models import Claim
+from claim.pagination import estimated_count, _count_cache_key, _count_queryset, _page_size, \
+    _selects_total_count, DEFAULT_PAGE_SIZE
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from graphql import parse
+
+
+class EstimatedCountTest(TestCase):
+    def setUp(self) -> None:
+        super(EstimatedCountTest, self).setUp()
+        self.queryset = Claim.objects.filter(validity_to__isnull=True, status=Claim.STATUS_ENTERED)
+
+    def test_exact_count_below_threshold(self):
+        # Given
+        with patch.object(ClaimConfig, "gql_query_claims_count_cache_ttl", 0), \
+                patch.object(ClaimConfig, "gql_query_claims_exact_count_threshold", 10 ** 9):
+            # When
+            count = estimated_count(self.queryset)
+
+        # Then
+        self.assertEqual(count, self.queryset.count())
+
+    @skipUnless(connection.vendor == "postgresql", "the estimate comes from the PostgreSQL planner")
+    def test_estimate_above_threshold(self):
+        # Given
+        sql, params = _count_queryset(self.queryset).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        with patch.object(ClaimConfig, "gql_query_claims_count_cache_ttl", 0), \
+                patch.object(ClaimConfig, "gql_query_claims_exact_count_threshold", 0), \
+                patch("claim.pagination.exact_count") as exact_count:
+            # When
+            estimate = estimated_count(self.queryset)
+
+        # Then the planner estimate is returned without counting
+        self.assertEqual(estimate, int(plan[0]["Plan"]["Plan Rows"]))
+        exact_count.assert_not_called()
+
+    def test_cached_count(self):
+        # Given
+        key = _count_cache_key(self.queryset)
+        cache.set(key, 12345, 60)
+
+        try:
+            with patch.object(ClaimConfig, "gql_query_claims_count_cache_ttl", 60), \
+                    patch.object(ClaimConfig, "gql_query_claims_exact_count_threshold", 0):
+                # When
+                count = estimated_count(self.queryset)
+
+            # Then the cached count is returned, neither estimated nor counted again
+            self.assertEqual(count, 12345)
+        finally:
+            # tearDown
+            cache.delete(key)
+
+
+class ClaimsConnectionFieldTest(TestCase):
+    @staticmethod
+    def _info(query):
+        document = parse(query)
+        operation = document.definitions[0]
+        fragments = {definition.name.value: definition for definition in document.definitions[1:]}
+        return SimpleNamespace(field_asts=list(operation.selection_set.selections), fragments=fragments)
+
+    def test_page_size(self):
+        self.assertEqual(_page_size(1000000, 100), 100)
+        self.assertEqual(_page_size(10, 100), 10)
+        self.assertEqual(_page_size(None, 100), 100)
+        self.assertEqual(_page_size(None, None), DEFAULT_PAGE_SIZE)
+
+    def test_selects_total_count(self):
+        self.assertTrue(_selects_total_count(self._info("{ claims { totalCount } }")))
+        self.assertFalse(_selects_total_count(self._info("{ claims { edges { node { totalCount } } } }")))
+        # through fragments
+        self.assertTrue(_selects_total_count(self._info(
+            "{ claims { ...Page } } fragment Page on ClaimGQLTypeConnection { totalCount }")))
+        self.assertFalse(_selects_total_count(self._info(
+            "{ claims { ...Page } } fragment Page on ClaimGQLTypeConnection { pageInfo { hasNextPage } }")))
+        self.assertTrue(_selects_total_count(self._info(
+            "{ claims { ... on ClaimGQLTypeConnection { totalCount } } }")))
@@ -0,0 +1,46 @@
+from unittest import skipUnless
+
+from claim.models import Claim
+from claim.sampling import sample_claims
+from claim.test_helpers import create_test_claim
+from django.db import connection
+from django.test import TestCase
+
+
+class SamplingTest(TestCase):
+    def test_sample_claims(self):
+        # Given
+        claims = [create_test_claim(custom_props={'status': Claim.STATUS_CHECKED}) for _ in range(5)]
+        queryset = Claim.objects.filter(id__in=[claim.id for claim in claims])
+
+        # When
+        by_count = sample_claims(queryset, count=2, seed="s1")
+        by_percentage = sample_claims(queryset, percentage=50, seed="s1")
+
+        # Then
+        self.assertEqual(len(by_count), 2)
+        self.assertEqual(len(by_percentage), 3)
+        self.assertTrue(set(by_count) <= {claim.uuid for claim in claims})
+        # the smaller of both
+        self.assertEqual(len(sample_claims(queryset, percentage=50, count=1)), 1)
+        self.assertEqual(sample_claims(queryset, count=0), [])
+
+        # tearDown
+        queryset.delete()
+
+    @skipUnless(connection.vendor == "postgresql", "the other databases ignore the seed")
+    def test_sample_claims_seeded(self):
+        # Given
+        claims = [create_test_claim(custom_props={'status': Claim.STATUS_CHECKED}) for _ in range(10)]
+        queryset = Claim.objects.filter(id__in=[claim.id for claim in claims])
+
+        # When
+        first = sample_claims(queryset, count=4, seed="s2")
+        second = sample_claims(queryset, count=4, seed="s2")
+
+        # Then the same seed gives the same sample
+        self.assertEqual(len(first), 4)
+        self.assertEqual(first, second)
+
+        # tearDown
+        queryset.delete()
@@ -1,15 +1,25 @@
-from django.test import TestCase
+from types import SimpleNamespace
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 from unittest import mock
 from location.test_helpers import create_test_location, create_test_health_facility, create_test_village
 from insuree.test_helpers import create_test_insuree
-from claim.test_helpers import create_test_claim_admin
-from claim.models import Claim, ClaimItem, ClaimService, ClaimDetail
+from claim.test_helpers import create_test_claim_admin, create_test_claim, create_test_claimservice, \
+    create_test_claimitem
+from claim.models import Claim, ClaimItem, ClaimService, ClaimDetail, ClaimDedRem
 from medical.models import Diagnosis, Item, Service
 from medical.test_helpers import create_test_item, create_test_service
+from medical_pricelist.test_helpers import add_service_to_hf_pricelist, add_item_to_hf_pricelist
+from policy.test_helpers import create_test_policy
+from product.test_helpers import create_test_product, create_test_product_service, create_test_product_item
 
+from core.models import User, InteractiveUser
+from core.test_helpers import create_test_officer
 from core.services import create_or_update_interactive_user, create_or_update_core_user
 import datetime
 from claim.services import *
+from claim.validations import REJECTION_REASON_INVALID_CLAIM
 import core
 
 
@@ -312,3 +322,201 @@ class ClaimSubmitServiceTestCase(TestCase):
                 "audit_user_id": self.test_claim_service.audit_user_id
             }]
         }
+
+
+class PartitionClaimsTestCase(TestCase):
+    def test_partition_claims_by_family(self):
+        claims = [SimpleNamespace(id=claim_id, insuree_id=insuree_id, insuree=SimpleNamespace(family_id=family_id))
+                  for claim_id, insuree_id, family_id in
+                  ((1, 10, 100), (2, 20, None), (3, 11, 100), (4, 30, 300), (5, 20, None), (6, 10, 100))]
+
+        partitions = partition_claims_by_family(claims, 2)
+
+        self.assertEqual([[claim.id for claim in partition] for partition in partitions], [[1, 3, 6], [2, 5, 4]])
+        self.assertEqual(len(partition_claims_by_family(claims, 8)), 3)
+        self.assertEqual(partition_claims_by_family([], 4), [])
+
+
+class SubmitClaimsInParallelTestCase(TransactionTestCase):
+    """
+    The workers of submit_claims_in_parallel run in their own threads and connections: they only see committed
+    fixtures, so this test cannot run in the transaction of a TestCase. The tables are flushed after the test.
+    """
+    serialized_rollback = True
+
+    def setUp(self):
+        super(SubmitClaimsInParallelTestCase, self).setUp()
+        self.user = User(i_user=InteractiveUser(login_name="test_batch_run", audit_user_id=978911, id=97891))
+
+    @staticmethod
+    def _create_family_claims(in_pricelist):
+        """
+        Entered claims of a new family, one per element of in_pricelist, with a service and an item in the price
+        list of the health facility if True, out of it (so that the claim is rejected) otherwise
+        """
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT", custom_props={})
+        create_test_policy(product, insuree, link=True)
+        priced = (create_test_service("V", custom_props={}), create_test_item("D", custom_props={}))
+        create_test_product_service(product, priced[0])
+        create_test_product_item(product, priced[1])
+        add_service_to_hf_pricelist(priced[0])
+        add_item_to_hf_pricelist(priced[1])
+        unpriced = (create_test_service("V", custom_props={}), create_test_item("D", custom_props={}))
+        claims = []
+        for priced_claim in in_pricelist:
+            service, item = priced if priced_claim else unpriced
+            claim = create_test_claim({"insuree_id": insuree.id})
+            create_test_claimservice(claim, custom_props={"service_id": service.id})
+            create_test_claimitem(claim, "D", custom_props={"item_id": item.id})
+            claims.append(claim)
+        return claims
+
+    @staticmethod
+    def _outcome(claim, errors):
+        claim.refresh_from_db()
+        dedrem = ClaimDedRem.objects.filter(claim_id=claim.id).values_list("ded_g", "rem_g", "rem_op").first()
+        return claim.status, dedrem, sorted(error.get("code") for error in errors)
+
+    def test_submit_claims_in_parallel(self):
+        # Given two families, submitted in order by the serial path
+        serial_claims = self._create_family_claims([True, True]) + self._create_family_claims([True, False])
+        with transaction.atomic():
+            serial = [self._outcome(claim, submit_claim(claim, self.user)) for claim in serial_claims]
+        # ... and the same two families, with a claim that is no longer entered
+        claims = self._create_family_claims([True, True]) + self._create_family_claims([True, False])
+        checked_claim = create_test_claim({"status": Claim.STATUS_CHECKED})
+        claims.insert(2, checked_claim)
+
+        # When
+        results = submit_claims_in_parallel(claims, self.user, 2)
+
+        # Then the claims come back in order, with the statuses, dedrems and errors of the serial path
+        self.assertEqual([claim.id for claim, _ in results], [claim.id for claim in claims])
+        outcomes = [self._outcome(claim, errors) for claim, errors in results]
+        skipped = outcomes.pop(2)
+        self.assertEqual(outcomes, serial)
+        self.assertEqual([status for status, _, _ in outcomes],
+                         [Claim.STATUS_CHECKED, Claim.STATUS_CHECKED, Claim.STATUS_CHECKED, Claim.STATUS_REJECTED])
+        # the claim no longer entered is left as it is and reported, like in the serial path
+        self.assertEqual(skipped, (Claim.STATUS_CHECKED, None, [REJECTION_REASON_INVALID_CLAIM]))
+        self.assertFalse(Claim.objects.filter(legacy_id=checked_claim.id).exists())
+        with transaction.atomic():
+            self.assertEqual(submit_claims([checked_claim], self.user)[0][1][0]['code'],
+                             REJECTION_REASON_INVALID_CLAIM)
+
+    def test_failed_partition(self):
+        # Given two families, the submission of the claims of the second one failing
+        claims = self._create_family_claims([True]) + self._create_family_claims([True, True])
+        failing_insuree_id = claims[1].insuree_id
+        submit = submit_claim
+
+        def fail_for_second_family(claim, user):
+            if claim.insuree_id == failing_insuree_id:
+                raise ValueError("submission failure")
+            return submit(claim, user)
+
+        # When
+        with mock.patch("claim.services.submit_claim", side_effect=fail_for_second_family):
+            results = submit_claims_in_parallel(claims, self.user, 2)
+
+        # Then the failing partition is rolled back and reported, the other one is submitted
+        self.assertEqual(results[0][1], [])
+        for claim, errors in results[1:]:
+            self.assertIn(claim.code, errors[0]['message'])
+            self.assertEqual(errors[1], {'message': "submission failure"})
+        self.assertEqual([Claim.objects.get(id=claim.id).status for claim in claims],
+                         [Claim.STATUS_CHECKED, Claim.STATUS_ENTERED, Claim.STATUS_ENTERED])
+
+    def test_no_parallel_submission_in_transaction(self):
+        with transaction.atomic(), self.assertRaises(AssertionError):
+            submit_claims_in_parallel([], self.user, 2)
+
+
+class SetClaimsStatusTestCase(TestCase):
+    def test_set_status_in_bulk(self):
+        # Given
+        claim1 = create_test_claim(custom_props={'status': Claim.STATUS_CHECKED})
+        item1 = create_test_claimitem(claim1, "D")
+        claim2 = create_test_claim(custom_props={'status': Claim.STATUS_CHECKED,
+                                                 'review_status': Claim.REVIEW_DELIVERED})
+
+        # When
+        errors = set_claims_status([claim1.uuid, claim2.uuid], 'review_status', Claim.REVIEW_SELECTED,
+                                   {'audit_user_id_review': -1})
+
+        # Then
+        claim1.refresh_from_db()
+        claim2.refresh_from_db()
+        self.assertEqual(errors, [])
+        self.assertEqual(claim1.review_status, Claim.REVIEW_SELECTED)
+        self.assertEqual(claim2.review_status, Claim.REVIEW_SELECTED)
+        self.assertEqual(claim1.audit_user_id_review, -1)
+        history = Claim.objects.get(legacy_id=claim1.id)
+        self.assertIsNotNone(history.validity_to)
+        self.assertEqual(history.review_status, Claim.REVIEW_IDLE)
+        self.assertEqual(ClaimItem.objects.get(claim_id=history.id).legacy_id, item1.id)
+        history2 = Claim.objects.get(legacy_id=claim2.id)
+        self.assertEqual(history2.review_status, Claim.REVIEW_DELIVERED)
+
+        # tearDown
+        ClaimItem.objects.filter(claim_id__in=[claim1.id, history.id]).delete()
+        history2.delete()
+        history.delete()
+        claim1.delete()
+        claim2.delete()
+
+    def test_set_status_in_bulk_failure(self):
+        # Given
+        claim1 = create_test_claim(custom_props={'status': Claim.STATUS_CHECKED})
+        claim2 = create_test_claim(custom_props={'status': Claim.STATUS_CHECKED})
+        save_history = Claim.save_history
+
+        def fail_for_claim2(claim, **kwargs):
+            if claim.id == claim2.id:
+                raise ValueError("history failure")
+            return save_history(claim, **kwargs)
+
+        # When the bulk write fails, then the history of claim2 fails too
+        with mock.patch.object(Claim, "save_histories", side_effect=ValueError("bulk failure")), \
+                mock.patch.object(Claim, "save_history", autospec=True, side_effect=fail_for_claim2):
+            errors = set_claims_status([claim1.uuid, claim2.uuid], 'review_status', Claim.REVIEW_SELECTED,
+                                       {'audit_user_id_review': -1})
+
+        # Then the claims are set one by one and only claim2 is reported
+        claim1.refresh_from_db()
+        claim2.refresh_from_db()
+        self.assertEqual(claim1.review_status, Claim.REVIEW_SELECTED)
+        self.assertEqual(claim1.audit_user_id_review, -1)
+        self.assertNotEqual(claim2.review_status, Claim.REVIEW_SELECTED)
+        self.assertEqual(len(errors), 2)
+        self.assertIn(claim2.code, errors[0]['message'])
+        self.assertEqual(errors[1], {'message': "history failure"})
+
+        # tearDown
+        Claim.objects.filter(legacy_id__in=[claim1.id, claim2.id]).delete()
+        claim1.delete()
+        claim2.delete()
+
+
+class FeedbackOfficerIndexTestCase(TestCase):
+    def test_feedback_officer_index(self):
+        # Given
+        insuree = create_test_insuree()
+        village = insuree.current_village or insuree.family.location
+        officer = create_test_officer(villages=[village])
+        claim = create_test_claim(custom_props={'status': Claim.STATUS_CHECKED, 'insuree': insuree})
+
+        # When
+        index = FeedbackOfficerIndex.for_claims([claim])
+        with self.assertNumQueries(0):
+            with_phone, first = index.get_officers([village])
+
+        # Then
+        self.assertEqual(with_phone[0], officer.id)
+        self.assertEqual(with_phone[2], officer.phone)
+        self.assertEqual(first, with_phone)
+        self.assertEqual(index.get_officers([]), (None, None))
+
+        # tearDown
+        claim.delete()
@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+from claim.apps import ClaimConfig
+from claim.models import Claim, ClaimUtilization
+from claim.test_helpers import create_test_claim, create_test_claimitem
+from claim.utilization import refresh_claims_utilization, count_claims_by_category, get_quantities_by_date
+from django.test import TestCase
+
+
+class ClaimUtilizationTest(TestCase):
+    def test_claim_utilization(self):
+        # Given
+        claim = create_test_claim({"status": Claim.STATUS_CHECKED, "category": "V"})
+        item = create_test_claimitem(claim, "D", custom_props={"qty_provided": 3})
+        claim.refresh_from_db()
+        with patch.object(ClaimConfig, "claim_utilization_enabled", True):
+            # When
+            refresh_claims_utilization([claim.id])
+
+            # Then
+            self.assertEqual(count_claims_by_category(claim.insuree_id, "V", claim.date_to, claim.date_to), 1)
+            self.assertEqual(count_claims_by_category(claim.insuree_id, "V", claim.date_to, claim.date_to, claim), 0)
+            quantities = get_quantities_by_date(claim.insuree_id, "item_id", [item.item_id],
+                                                claim.date_to, claim.date_to)
+            self.assertEqual([(elt_id, qty) for elt_id, _, qty in quantities], [(item.item_id, 3)])
+
+            # When the claim is rejected, it is not counted anymore
+            claim.status = Claim.STATUS_REJECTED
+            claim.save()
+            self.assertFalse(ClaimUtilization.objects.filter(claim=claim).exists())
+
+        # tearDown
+        ClaimUtilization.objects.filter(claim=claim).delete()
+        item.delete()
+        claim.delete()
+
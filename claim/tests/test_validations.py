@@ -6,8 +6,14 @@ from core.test_helpers import create_test_officer
 
 
 from claim.validations import get_claim_category, validate_claim, validate_assign_prod_to_claimitems_and_services, \
-    process_dedrem, REJECTION_REASON_WAITING_PERIOD_FAIL, REJECTION_REASON_INVALID_ITEM_OR_SERVICE
+    process_dedrem, _get_total_qty_provided, REJECTION_REASON_WAITING_PERIOD_FAIL, \
+    REJECTION_REASON_INVALID_ITEM_OR_SERVICE, REJECTION_REASON_FREQUENCY_FAILURE, REJECTION_REASON_NO_PRODUCT_FOUND, \
+    REJECTION_REASON_QTY_OVER_LIMIT, REJECTION_REASON_MAX_VISITS
+from claim.validation_context import ClaimValidationContext
+import datetime
+from claim.dedrem_ledger import replace_claim_dedrems
 from core.models import User, InteractiveUser
+from django.db.models import Prefetch, Q
 from django.test import TestCase
 from insuree.models import Family, Insuree
 from insuree.test_helpers import create_test_insuree
@@ -185,6 +191,35 @@ class ValidationTest(TestCase):
         item1.delete()
         claim.delete()
 
+    def test_validation_context_pricelist(self):
+        # Given
+        item_in_pricelist = create_test_item("D")
+        item_not_in_pricelist = create_test_item("D")
+        pricelist_detail = add_item_to_hf_pricelist(item_in_pricelist)
+        claim = create_test_claim()
+        item1 = create_test_claimitem(claim, "D", custom_props={"item_id": item_in_pricelist.id})
+        item2 = create_test_claimitem(claim, "D", custom_props={"item_id": item_not_in_pricelist.id})
+
+        # When
+        context = ClaimValidationContext(claim)
+
+        # Then
+        self.assertEqual({i.id for i in context.items}, {item1.id, item2.id})
+        self.assertIn(item_in_pricelist.id, context.items_pricelist_details)
+        self.assertNotIn(item_not_in_pricelist.id, context.items_pricelist_details)
+        with self.assertNumQueries(0):
+            # everything is already loaded
+            [claim_item.item for claim_item in context.items]
+            context.items_pricelist_details
+
+        # tearDown
+        item1.delete()
+        item2.delete()
+        claim.delete()
+        pricelist_detail.delete()
+        item_in_pricelist.delete()
+        item_not_in_pricelist.delete()
+
     def test_validate_family(self):
         # When the insuree family is invalid
         # Given
@@ -529,6 +564,199 @@ class ValidationTest(TestCase):
         service.delete()
         product.delete()
 
+    def test_frequency_rejection_reasons(self):
+        # Given a service that can be provided once every 10 days
+        insuree = create_test_insuree()
+        product = create_test_product("CSECT")
+        policy = create_test_policy(product, insuree, link=True)
+        service = create_test_service("C", custom_props={"code": "FRQ1", "frequency": 10})
+        product_service = create_test_product_service(product, service)
+        pricelist_detail = add_service_to_hf_pricelist(service)
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim1, custom_props={"service_id": service.id})
+        self.assertEqual(validate_claim(claim1, True), [])
+        mark_test_claim_as_processed(claim1)
+
+        # When it is claimed again within and after its frequency
+        claim2 = create_test_claim({"insuree_id": insuree.id, "date_from": datetime.date(2019, 6, 5),
+                                    "date_to": datetime.date(2019, 6, 5)})
+        service2 = create_test_claimservice(claim2, custom_props={"service_id": service.id})
+        errors2 = validate_claim(claim2, True)
+        claim3 = create_test_claim({"insuree_id": insuree.id, "date_from": datetime.date(2019, 6, 20),
+                                    "date_to": datetime.date(2019, 6, 20)})
+        service3 = create_test_claimservice(claim3, custom_props={"service_id": service.id})
+        errors3 = validate_claim(claim3, True)
+
+        # Then, as the per line frequency check did
+        service2.refresh_from_db()
+        service3.refresh_from_db()
+        self.assertIn(REJECTION_REASON_FREQUENCY_FAILURE, [error['code'] for error in errors2])
+        self.assertEqual((service2.status, service2.rejection_reason, service2.qty_approved),
+                         (ClaimService.STATUS_REJECTED, REJECTION_REASON_FREQUENCY_FAILURE, 0))
+        self.assertEqual(errors3, [])
+        self.assertEqual((service3.status, service3.rejection_reason), (ClaimService.STATUS_PASSED, 0))
+
+        # tearDown
+        for claim_service in (service3, service2, service1):
+            claim_service.delete()
+        for claim in (claim3, claim2, claim1):
+            claim.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_service.delete()
+        pricelist_detail.delete()
+        service.delete()
+        product.delete()
+
+    def test_no_product_rejection_reasons(self):
+        # Given a product covering one of the two priced services and none of the items
+        insuree = create_test_insuree()
+        product = create_test_product("CSECT")
+        policy = create_test_policy(product, insuree, link=True)
+        covered = create_test_service("C", custom_props={"code": "NPC1"})
+        uncovered = create_test_service("C", custom_props={"code": "NPU1"})
+        item = create_test_item("D", custom_props={"code": "NPI1"})
+        product_service = create_test_product_service(product, covered)
+        pricelist_details = [add_service_to_hf_pricelist(covered), add_service_to_hf_pricelist(uncovered),
+                             add_item_to_hf_pricelist(item)]
+        claim = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim, custom_props={"service_id": covered.id})
+        service2 = create_test_claimservice(claim, custom_props={"service_id": uncovered.id})
+        item1 = create_test_claimitem(claim, "D", custom_props={"item_id": item.id})
+
+        # When
+        errors = validate_claim(claim, True)
+
+        # Then each line gets the outcome of the per line product lookup
+        for detail in (service1, service2, item1):
+            detail.refresh_from_db()
+        # the line errors are only reported when all the lines are rejected
+        self.assertEqual(errors, [])
+        self.assertEqual((service1.status, service1.rejection_reason), (ClaimService.STATUS_PASSED, 0))
+        self.assertEqual((service2.status, service2.rejection_reason),
+                         (ClaimService.STATUS_REJECTED, REJECTION_REASON_NO_PRODUCT_FOUND))
+        self.assertEqual((item1.status, item1.rejection_reason),
+                         (ClaimItem.STATUS_REJECTED, REJECTION_REASON_NO_PRODUCT_FOUND))
+
+        # tearDown
+        for detail in (item1, service2, service1):
+            detail.delete()
+        claim.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_service.delete()
+        for pricelist_detail in pricelist_details:
+            pricelist_detail.delete()
+        item.delete()
+        uncovered.delete()
+        covered.delete()
+        product.delete()
+
+    def test_max_provision_over_window(self):
+        # Given a service limited to 5 per policy and a claim long before the policy
+        insuree = create_test_insuree()
+        product = create_test_product("CSECT")
+        policy = create_test_policy(product, insuree, link=True)
+        service = create_test_service("C", custom_props={"code": "MXP1"})
+        product_service = create_test_product_service(product, service, custom_props={"limit_no_adult": 5})
+        pricelist_detail = add_service_to_hf_pricelist(service)
+        claim0 = create_test_claim({"insuree_id": insuree.id, "date_from": datetime.date(2000, 1, 1),
+                                    "date_to": datetime.date(2000, 1, 1)})
+        service0 = create_test_claimservice(claim0, custom_props={"service_id": service.id, "qty_provided": 9,
+                                                                  "status": ClaimService.STATUS_PASSED})
+        mark_test_claim_as_processed(claim0)
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim1, custom_props={"service_id": service.id, "qty_provided": 3})
+        self.assertEqual(validate_claim(claim1, True), [])
+        mark_test_claim_as_processed(claim1)
+
+        # When a claim goes over the limit, then another one is made once it is reached
+        claim2 = create_test_claim({"insuree_id": insuree.id})
+        service2 = create_test_claimservice(claim2, custom_props={"service_id": service.id, "qty_provided": 4})
+        errors2 = validate_claim(claim2, True)
+        mark_test_claim_as_processed(claim2)
+        claim3 = create_test_claim({"insuree_id": insuree.id})
+        service3 = create_test_claimservice(claim3, custom_props={"service_id": service.id, "qty_provided": 1})
+        context = ClaimValidationContext(claim3)
+        product_line = context.service_products[service.id][0]
+        start_date, expiry_date = context.coverage_window(product_line)
+        claim_detail = context.services[0]
+        total_qty_provided = context.get_total_qty_provided(claim_detail, start_date, expiry_date)
+        legacy_total_qty_provided = _get_total_qty_provided(claim_detail, service, start_date, expiry_date,
+                                                            insuree.id)
+        errors3 = validate_claim(claim3, True)
+
+        # Then the quantities are the ones of the per line query, which ignores the claims out of the window
+        service2.refresh_from_db()
+        service3.refresh_from_db()
+        self.assertEqual(errors2, [])
+        self.assertEqual((service2.status, service2.qty_provided), (ClaimService.STATUS_PASSED, 2))
+        self.assertEqual(total_qty_provided, legacy_total_qty_provided)
+        self.assertEqual(total_qty_provided, 5)
+        self.assertIn(REJECTION_REASON_QTY_OVER_LIMIT, [error['code'] for error in errors3])
+        self.assertEqual((service3.status, service3.rejection_reason),
+                         (ClaimService.STATUS_REJECTED, REJECTION_REASON_QTY_OVER_LIMIT))
+
+        # tearDown
+        for claim_service in (service3, service2, service1, service0):
+            claim_service.delete()
+        for claim in (claim3, claim2, claim1, claim0):
+            claim.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_service.delete()
+        pricelist_detail.delete()
+        service.delete()
+        product.delete()
+
+    def test_reject_details_left_out_of_the_prefetch(self):
+        # Given a second visit over the maximum, with a line already rejected that the caller does not load
+        insuree = create_test_insuree()
+        product = create_test_product("DELIV", custom_props={"max_no_visits": 1})
+        policy = create_test_policy(product, insuree, link=True)
+        service = create_test_service("V", custom_props={"code": "LOV1"})
+        product_service = create_test_product_service(product, service)
+        pricelist_detail = add_service_to_hf_pricelist(service)
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim1, custom_props={"service_id": service.id})
+        self.assertEqual(validate_claim(claim1, True), [])
+        mark_test_claim_as_processed(claim1)
+        claim2 = create_test_claim({"insuree_id": insuree.id})
+        service2 = create_test_claimservice(claim2, custom_props={"service_id": service.id})
+        left_out = create_test_claimitem(claim2, "D", custom_props={"rejection_reason": 2})
+        claim2 = Claim.objects \
+            .filter(id=claim2.id) \
+            .prefetch_related(Prefetch('items', queryset=ClaimItem.objects.filter(
+                Q(rejection_reason=0) | Q(rejection_reason__isnull=True), validity_to__isnull=True))) \
+            .prefetch_related(Prefetch('services', queryset=ClaimService.objects.filter(
+                Q(rejection_reason=0) | Q(rejection_reason__isnull=True), validity_to__isnull=True))) \
+            .get()
+
+        # When
+        errors = validate_claim(claim2, True)
+
+        # Then, as the legacy UPDATE of all the current lines, the left out line is rejected for the category too
+        service2.refresh_from_db()
+        left_out.refresh_from_db()
+        self.assertEqual([error['code'] for error in errors][:2],
+                         [REJECTION_REASON_INVALID_ITEM_OR_SERVICE, REJECTION_REASON_MAX_VISITS])
+        for detail in (service2, left_out):
+            self.assertEqual((detail.status, detail.qty_approved, detail.rejection_reason),
+                             (ClaimDetail.STATUS_REJECTED, 0, REJECTION_REASON_MAX_VISITS))
+
+        # tearDown
+        left_out.delete()
+        service2.delete()
+        claim2.delete()
+        service1.delete()
+        claim1.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_service.delete()
+        pricelist_detail.delete()
+        service.delete()
+        product.delete()
+
     def test_waiting_period(self):
         # When the insuree already reaches his limit of visits
         # Given
@@ -660,6 +888,54 @@ class ValidationTest(TestCase):
         item.delete()
         product.delete()
 
+    def test_process_dedrem_quantities(self):
+        # Given a passed item with an approved quantity and a rejected one
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT", custom_props={})
+        policy = create_test_policy(product, insuree, link=True)
+        service = create_test_service("V", custom_props={})
+        item = create_test_item("D", custom_props={})
+        product_service = create_test_product_service(product, service)
+        product_item = create_test_product_item(product, item)
+        pricelist_detail1 = add_service_to_hf_pricelist(service)
+        pricelist_detail2 = add_item_to_hf_pricelist(item)
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim1, custom_props={"service_id": service.id})
+        item1 = create_test_claimitem(claim1, "D", custom_props={"item_id": item.id, "qty_approved": 3})
+        item2 = create_test_claimitem(claim1, "D", custom_props={"item_id": item.id, "rejection_reason": 2})
+        errors = validate_claim(claim1, True)
+        errors += validate_assign_prod_to_claimitems_and_services(claim1)
+
+        # When
+        errors += process_dedrem(claim1, -1, True)
+
+        # Then the approved quantity is valuated and the rejected line is left alone, as in the per detail loop
+        self.assertEqual(errors, [])
+        item1.refresh_from_db()
+        item2.refresh_from_db()
+        service1.refresh_from_db()
+        self.assertEqual((item1.price_valuated, item1.remunerated_amount), (300, 300))
+        self.assertEqual((service1.price_valuated, service1.remunerated_amount), (700, 700))
+        self.assertEqual((item2.status, item2.qty_approved), (ClaimItem.STATUS_REJECTED, 0))
+        self.assertIsNone(item2.price_valuated)
+        self.assertEqual(ClaimDedRem.objects.get(claim=claim1).rem_g, 1000)
+
+        # tearDown
+        replace_claim_dedrems(claim1)
+        service1.delete()
+        item2.delete()
+        item1.delete()
+        claim1.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_item.delete()
+        product_service.delete()
+        pricelist_detail1.delete()
+        pricelist_detail2.delete()
+        service.delete()
+        item.delete()
+        product.delete()
+
     def test_submit_claim_dedrem_limit_delivery(self):
         # Given
         insuree = create_test_insuree()
@@ -0,0 +1,137 @@
+from claim.dedrem_ledger import replace_claim_dedrems
+from claim.models import ClaimDedRem, ClaimDedRemLedger, ClaimItem, ClaimService
+from claim.test_helpers import create_test_claim, create_test_claimservice, create_test_claimitem
+from claim.validations import validate_claim, validate_assign_prod_to_claimitems_and_services, process_dedrem
+from claim.valuation import package_components_match, ValuationBatch, ValuationPlan
+from django.test import TestCase
+from insuree.test_helpers import create_test_insuree
+from medical.test_helpers import create_test_service, create_test_item
+from medical_pricelist.test_helpers import add_service_to_hf_pricelist, add_item_to_hf_pricelist
+from policy.test_helpers import create_test_policy
+from product.test_helpers import create_test_product, create_test_product_service, create_test_product_item
+
+
+class ValuationTest(TestCase):
+    def test_package_components_match(self):
+        self.assertTrue(package_components_match([(1, 2), (3, 1)], [(3, 1), (1, 2)]))
+        self.assertTrue(package_components_match([], []))
+        # different quantity
+        self.assertFalse(package_components_match([(1, 2), (3, 1)], [(1, 2), (3, 4)]))
+        # different number of components
+        self.assertFalse(package_components_match([(1, 2)], [(1, 2), (1, 2)]))
+
+    def test_valuation_batch(self):
+        # When the plan of a claim is preloaded with a batch
+        # Given
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT", custom_props={})
+        policy = create_test_policy(product, insuree, link=True)
+        service = create_test_service("V", custom_props={})
+        item = create_test_item("D", custom_props={})
+        product_service = create_test_product_service(product, service)
+        product_item = create_test_product_item(product, item)
+        pricelist_detail1 = add_service_to_hf_pricelist(service)
+        pricelist_detail2 = add_item_to_hf_pricelist(item)
+
+        claim1 = create_test_claim({"insuree_id": insuree.id})
+        service1 = create_test_claimservice(claim1, custom_props={"service_id": service.id})
+        item1 = create_test_claimitem(claim1, "D", custom_props={"item_id": item.id})
+        errors = validate_claim(claim1, True)
+        errors += validate_assign_prod_to_claimitems_and_services(claim1)
+        self.assertEqual(len(errors), 0)
+
+        # When
+        batch_plan = ValuationBatch([claim1]).plans()[claim1.id]
+        claim_plan = ValuationPlan(claim1, claim1.date_to if claim1.date_to else claim1.date_from)
+
+        # Then
+        self.assertEqual(batch_plan.policy_products, claim_plan.policy_products)
+        self.assertEqual(batch_plan.details, claim_plan.details)
+        self.assertEqual(batch_plan.products, claim_plan.products)
+        self.assertEqual(batch_plan.policy_members, claim_plan.policy_members)
+        self.assertEqual(batch_plan.get_pricelist_detail(item1), claim_plan.get_pricelist_detail(item1))
+        self.assertEqual(batch_plan.get_product_itemsvc(service1), claim_plan.get_product_itemsvc(service1))
+
+        errors += process_dedrem(claim1, -1, True, plan=batch_plan)
+        self.assertEqual(len(errors), 0)
+        item1.refresh_from_db()
+        self.assertEqual(item1.price_valuated, 700)
+        self.assertEqual(item1.remunerated_amount, 700)
+        dedrem_qs = ClaimDedRem.objects.filter(claim=claim1)
+        self.assertEqual(dedrem_qs.first().rem_g, 1400)
+
+        # tearDown
+        replace_claim_dedrems(claim1)
+        ClaimDedRemLedger.objects.filter(policy=policy).delete()
+        service1.delete()
+        item1.delete()
+        claim1.delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        product_item.delete()
+        product_service.delete()
+        pricelist_detail1.delete()
+        pricelist_detail2.delete()
+        service.delete()
+        item.delete()
+        product.delete()
+
+
+    def test_valuation_batch_order(self):
+        # Given a deductible and a ceiling per treatment that bind partway through the details of two identical
+        # claims
+        insuree = create_test_insuree()
+        product = create_test_product("VISIT", custom_props={"ded_treatment": 500, "max_treatment": 2500})
+        policy = create_test_policy(product, insuree, link=True)
+        items = [create_test_item("D", custom_props={}) for _ in range(3)]
+        services = [create_test_service("V", custom_props={}) for _ in range(2)]
+        product_lines = [create_test_product_item(product, item) for item in items] + \
+            [create_test_product_service(product, service) for service in services]
+        pricelist_details = [add_item_to_hf_pricelist(item) for item in items] + \
+            [add_service_to_hf_pricelist(service) for service in services]
+        claims = []
+        for _ in range(2):
+            claim = create_test_claim({"insuree_id": insuree.id})
+            for item in items:
+                create_test_claimitem(claim, "D", custom_props={"item_id": item.id})
+            for service in services:
+                create_test_claimservice(claim, custom_props={"service_id": service.id})
+            errors = validate_claim(claim, True)
+            errors += validate_assign_prod_to_claimitems_and_services(claim)
+            self.assertEqual(len(errors), 0)
+            claims.append(claim)
+        claim1, claim2 = claims
+
+        # When the first claim is valuated with its own plan and the second with a batch plan
+        errors = process_dedrem(claim1, -1, True)
+        errors += process_dedrem(claim2, -1, True, plan=ValuationBatch([claim2]).plans()[claim2.id])
+
+        # Then both claims are valuated the same, detail by detail
+        self.assertEqual(len(errors), 0)
+
+        def valuations(claim):
+            return [(detail.deductable_amount, detail.price_valuated, detail.exceed_ceiling_amount,
+                     detail.remunerated_amount)
+                    for model in (ClaimItem, ClaimService)
+                    for detail in model.objects.filter(claim=claim, validity_to__isnull=True).order_by("id")]
+
+        claim1_valuations = valuations(claim1)
+        self.assertEqual(claim1_valuations, valuations(claim2))
+        # the deductible and the ceiling only hit some of the details
+        self.assertNotEqual(len({valuation[1] for valuation in claim1_valuations}), 1)
+        fields = ("ded_g", "rem_g", "rem_op", "rem_ip", "rem_consult")
+        self.assertEqual(ClaimDedRem.objects.filter(claim=claim1).values(*fields).get(),
+                         ClaimDedRem.objects.filter(claim=claim2).values(*fields).get())
+
+        # tearDown
+        for claim in claims:
+            replace_claim_dedrems(claim)
+            ClaimItem.objects.filter(claim=claim).delete()
+            ClaimService.objects.filter(claim=claim).delete()
+            claim.delete()
+        ClaimDedRemLedger.objects.filter(policy=policy).delete()
+        policy.insuree_policies.first().delete()
+        policy.delete()
+        for record in product_lines + pricelist_details + items + services:
+            record.delete()
+        product.delete()
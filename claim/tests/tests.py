@@ -1,4 +1,5 @@
 import base64
+import datetime
 import json
 from dataclasses import dataclass
 from core.models import User
@@ -15,6 +16,8 @@ from graphene.test import Client
 from graphene import Schema
 
 from claim.models import Claim, ClaimAdmin
+from claim.test_helpers import create_test_claim, create_test_claimservice, \
+    delete_claim_with_itemsvc_dedrem_and_history
 
 
 from policy.models import Policy
@@ -125,6 +128,84 @@ class ClaimGraphQLTestCase(openIMISGraphQLTestCase):
         # This validates the status code and if you get errors
         self.assertResponseNoErrors(response)
         
+    def test_claims_query_with_details(self):
+        claim = create_test_claim({"insuree_id": self.insuree.id})
+        claim_service = create_test_claimservice(claim, custom_props={"service_id": self.service.id})
+        response = self.query(
+            '''
+            query claims($uuid: String!) {
+                claims(uuid: $uuid)
+                {
+                    edges
+                    {
+                        node
+                        {
+                            uuid,attachmentsCount,clientMutationId,items { id },services { id }
+                        }
+                    }
+                }
+            }
+            ''',
+            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+            variables={"uuid": str(claim.uuid)}
+        )
+
+        self.assertResponseNoErrors(response)
+        node = json.loads(response.content)["data"]["claims"]["edges"][0]["node"]
+        self.assertEqual(node["attachmentsCount"], 0)
+        self.assertIsNone(node["clientMutationId"])
+        self.assertEqual(node["items"], [])
+        self.assertEqual([service["id"] for service in node["services"]], [str(claim_service.id)])
+
+        delete_claim_with_itemsvc_dedrem_and_history(claim)
+
+    def test_claims_keyset_pagination(self):
+        claims = [create_test_claim({"insuree_id": self.insuree.id, "date_claimed": date_claimed})
+                  for date_claimed in (datetime.date(2019, 6, 1), datetime.date(2019, 6, 1), datetime.date(2019, 7, 1))]
+        query = '''
+            query claims($chfId: String!, $after: String) {
+                claims(insuree_ChfId: $chfId, keyset: true, first: 2, after: $after)
+                {
+                    totalCount
+                    pageInfo { hasNextPage, hasPreviousPage, endCursor }
+                    edges { node { uuid } }
+                }
+            }
+            '''
+
+        response = self.query(query, headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+                              variables={"chfId": self.insuree.chf_id})
+        self.assertResponseNoErrors(response)
+        first_page = json.loads(response.content)["data"]["claims"]
+        response = self.query(query, headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+                              variables={"chfId": self.insuree.chf_id,
+                                         "after": first_page["pageInfo"]["endCursor"]})
+        self.assertResponseNoErrors(response)
+        second_page = json.loads(response.content)["data"]["claims"]
+
+        # most recent first, the claims of a day by descending id
+        self.assertEqual([edge["node"]["uuid"] for edge in first_page["edges"] + second_page["edges"]],
+                         [str(claims[2].uuid), str(claims[1].uuid), str(claims[0].uuid)])
+        self.assertEqual(first_page["totalCount"], 3)
+        self.assertTrue(first_page["pageInfo"]["hasNextPage"])
+        self.assertFalse(second_page["pageInfo"]["hasNextPage"])
+        self.assertTrue(second_page["pageInfo"]["hasPreviousPage"])
+
+        # the keyset pages can only be ordered by date claimed
+        response = self.query('''
+            query claims($chfId: String!) {
+                claims(insuree_ChfId: $chfId, keyset: true, first: 2, orderBy: ["code"])
+                {
+                    edges { node { uuid } }
+                }
+            }
+            ''', headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+            variables={"chfId": self.insuree.chf_id})
+        self.assertResponseHasErrors(response)
+
+        for claim in claims:
+            delete_claim_with_itemsvc_dedrem_and_history(claim)
+
     def execute_mutation(self, mutation):
         mutation_result = self.graph_client.execute(mutation, context=DummyContext(user=self.admin_user))
         return mutation_result
@@ -12,7 +12,7 @@ import datetime
 from claim.services import *
 import core
 from medical.test_helpers import create_test_service, create_test_item
-from claim.utils import service_create_hook, calcul_amount_service, service_update_hook
+from claim.utils import service_create_hook, calcul_amount_service, service_update_hook, process_services_relations
 from claim.test_helpers import create_test_claim
 from claim.models import ClaimServiceItem, ClaimServiceService
 
@@ -321,6 +321,34 @@ class ClaimSubmitServiceTestCase(TestCase):
         claim_service_item.refresh_from_db()
         self.assertEqual(90, claim_service_item.qty_displayed)
     
+    def test_process_services_relations_in_bulk(self):
+        item = create_test_item("D", custom_props={})
+        sub_service = create_test_service("V")
+        service = create_test_service("V", custom_props={"maximum_amount": 10})
+        claim = create_test_claim()
+        services = [{
+            "qty_provided": qty, "price_asked": 11, "service_id": service.id,
+            "service_item_set": [{"sub_item_code": item.code, "qty_asked": qty, "qty_provided": 7, "price_asked": 11}],
+            "service_service_set": [
+                {"sub_service_code": sub_service.code, "qty_asked": 2, "qty_provided": 3, "price_asked": 20}]
+        } for qty in (1, 2, 3)]
+
+        process_services_relations(mock.Mock(id_for_audit=-1), claim, services)
+
+        claim_services = list(ClaimService.objects.filter(claim=claim).order_by("id"))
+        self.assertEqual([claim_service.qty_provided for claim_service in claim_services], [1, 2, 3])
+        self.assertEqual(
+            [claim_service_item.qty_displayed for claim_service_item in
+             ClaimServiceItem.objects.filter(claim_service__in=claim_services).order_by("claim_service_id")],
+            [1, 2, 3])
+        self.assertEqual(ClaimServiceService.objects.filter(
+            claim_service__in=claim_services, service=sub_service).count(), 3)
+
+        with self.assertRaises(ValidationError):
+            process_services_relations(mock.Mock(id_for_audit=-1), claim, [{
+                "qty_provided": 11, "price_asked": 11, "service_id": service.id,
+                "service_item_set": [], "service_service_set": []}])
+
     def test_calcul_amount_service(self):
         item = create_test_item("D", custom_props={})
         service = create_test_service("V")
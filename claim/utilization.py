@@ -0,0 +1,121 @@
+import logging
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
+
+from .apps import ClaimConfig
+from .models import Claim, ClaimItem, ClaimService, ClaimUtilization
+
+logger = logging.getLogger(__name__)
+
+
+def build_claims_utilization(claim_ids):
+    """
+    Computes the utilization of the given claims from the claim tables. Claims that are not current or not
+    checked, processed or valuated have none.
+    :return: list of unsaved ClaimUtilization
+    """
+    claims = Claim.objects \
+        .filter(id__in=claim_ids, validity_to__isnull=True, status__gt=Claim.STATUS_ENTERED) \
+        .values_list("id", "insuree_id", "date_from", "date_to", "category")
+    utilizations = []
+    claims_target = {}
+    for claim_id, insuree_id, date_from, date_to, category in claims:
+        claims_target[claim_id] = (insuree_id, date_to if date_to else date_from)
+        utilizations.append(ClaimUtilization(claim_id=claim_id, insuree_id=insuree_id,
+                                             target_date=date_to if date_to else date_from, category=category))
+    if not claims_target:
+        return utilizations
+    for detail_model in (ClaimItem, ClaimService):
+        elt_field = f"{detail_model.model_prefix}_id"
+        quantities = detail_model.objects \
+            .filter(Q(rejection_reason=0) | Q(rejection_reason__isnull=True),
+                    validity_to__isnull=True,
+                    policy__validity_to__isnull=True,
+                    claim_id__in=list(claims_target)) \
+            .order_by() \
+            .values("claim_id", elt_field) \
+            .annotate(qty=Sum(Coalesce("qty_approved", "qty_provided"))) \
+            .values_list("claim_id", elt_field, "qty")
+        for claim_id, elt_id, qty in quantities:
+            insuree_id, target_date = claims_target[claim_id]
+            utilizations.append(ClaimUtilization(claim_id=claim_id, insuree_id=insuree_id, target_date=target_date,
+                                                 qty=qty or 0, **{elt_field: elt_id}))
+    return utilizations
+
+
+@transaction.atomic
+def refresh_claims_utilization(claim_ids):
+    """
+    Replaces the utilization of the given claims by the one computed from the claim tables.
+    To be called whenever claims move into or out of the checked/processed/valuated statuses or their details change
+    without saving the claim: claim.save() is covered by on_claim_saved, QuerySet.update() and bulk_create() send no
+    post_save. The submission, processing and review paths save each claim after writing its details;
+    update_claims_dedrems, which does not, refreshes its claims explicitly.
+    """
+    if not ClaimConfig.claim_utilization_enabled:
+        return
+    claim_ids = list(claim_ids)
+    ClaimUtilization.objects.filter(claim_id__in=claim_ids).delete()
+    ClaimUtilization.objects.bulk_create(build_claims_utilization(claim_ids))
+
+
+def utilization_key(utilization):
+    """
+    Comparable value of a ClaimUtilization, used to verify the table against the claim tables
+    """
+    return (utilization.claim_id, utilization.insuree_id, utilization.target_date,
+            utilization.category if not utilization.item_id and not utilization.service_id else None,
+            utilization.item_id, utilization.service_id,
+            round(Decimal(utilization.qty), 2) if utilization.qty is not None else None)
+
+
+def count_claims_by_category(insuree_id, category, start_date, end_date, claim=None):
+    """
+    Utilization counterpart of get_claim_queryset_by_category(...).count()
+    """
+    queryset = ClaimUtilization.objects.filter(insuree_id=insuree_id,
+                                               item__isnull=True,
+                                               service__isnull=True,
+                                               target_date__gte=start_date,
+                                               target_date__lte=end_date)
+    if claim:
+        queryset = queryset.exclude(claim_id=claim.id)
+    if category == 'V':
+        queryset = queryset.filter(Q(category=category) | Q(category__isnull=True))
+    else:
+        queryset = queryset.filter(category=category)
+    return queryset.count()
+
+
+def get_quantities_by_date(insuree_id, elt_field, elt_ids, start_date, end_date):
+    """
+    Quantities provided to the insuree per item (or service) and claim target date
+    :param elt_field: item_id or service_id
+    :return: iterable of (item_id/service_id, target date, quantity)
+    """
+    return ClaimUtilization.objects \
+        .filter(insuree_id=insuree_id,
+                target_date__gte=start_date,
+                target_date__lte=end_date,
+                **{f"{elt_field}__in": list(elt_ids)}) \
+        .order_by() \
+        .values(elt_field, "target_date") \
+        .annotate(total_qty=Sum("qty")) \
+        .values_list(elt_field, "target_date", "total_qty")
+
+
+def on_claim_saved(sender, instance, created=False, **kwargs):
+    if not ClaimConfig.claim_utilization_enabled:
+        return
+    if created and (instance.validity_to is not None or instance.status <= Claim.STATUS_ENTERED):
+        # new claims and history copies have nothing to count yet
+        return
+    refresh_claims_utilization([instance.id])
+
+
+def bind_signals():
+    post_save.connect(on_claim_saved, sender=Claim, dispatch_uid="claim_utilization_on_claim_saved")
@@ -2,6 +2,8 @@ import math
 from claim.models import Claim, ClaimItem, ClaimService, ClaimDetail, ClaimServiceItem, ClaimServiceService
 from medical.models import Item, Service
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
 from django.utils.translation import gettext as _
 from .apps import ClaimConfig
 
@@ -11,6 +13,9 @@ def process_child_relation(user, data_children, claim_id, children, create_hook)
     from core.utils import TimeUtils
     if __check_if_maximum_amount_overshoot(data_children, children):
         raise ValidationError(_("mutation.claim_item_service_maximum_amount_overshoot"))
+    sub_elements = load_sub_elements(data_children) if create_hook == service_create_hook else None
+    existing = children.in_bulk([data_elt['id'] for data_elt in data_children if data_elt.get('id')])
+    to_create = []
     for data_elt in data_children:
         if ClaimConfig.native_code_for_services == False:
             if create_hook == service_create_hook:
@@ -23,14 +28,16 @@ def process_child_relation(user, data_children, claim_id, children, create_hook)
         elt_id = data_elt.pop('id') if 'id' in data_elt else None
         if elt_id:
             # elt has been historized along with claim historization
-            elt = children.get(id=elt_id)
+            elt = existing.get(elt_id)
+            if elt is None:
+                raise children.model.DoesNotExist(f"{children.model.__name__} {elt_id} not found in the claim")
             [setattr(elt, k, v) for k, v in data_elt.items()]
             elt.validity_from = TimeUtils.now()
             elt.audit_user_id = user.id_for_audit
             elt.claim_id = claim_id
             elt.validity_to = None
             if create_hook == service_create_hook:
-                service_update_hook(elt.claim_id, data_elt)
+                service_update_hook(elt.claim_id, data_elt, sub_elements)
 
             elt.save()
         else:
@@ -41,8 +48,13 @@ def process_child_relation(user, data_children, claim_id, children, create_hook)
             # Should entered claim items/services have status passed assigned?
             # Status is mandatory field, and it doesn't have default value in model
             data_elt['status'] = ClaimDetail.STATUS_PASSED
-            create_hook(claim_id, data_elt)
+            if create_hook in BULK_CREATE_HOOKS:
+                to_create.append(data_elt)
+            else:
+                create_hook(claim_id, data_elt)
 
+    if to_create:
+        BULK_CREATE_HOOKS[create_hook](claim_id, to_create, sub_elements)
     return claimed
 
 
@@ -62,66 +74,124 @@ def calcul_amount_service(elt):
 
 
 def __check_if_maximum_amount_overshoot(data_children, children):
-    is_overshoot = False
+    if children.model == ClaimItem:
+        model, elt_field = Item, 'item_id'
+    elif children.model == ClaimService:
+        model, elt_field = Service, 'service_id'
+    else:
+        return False
+    elt_ids = {entity[elt_field] for entity in data_children}
+    maximum_amounts = dict(model.objects
+                           .filter(id__in=elt_ids, validity_to__isnull=True)
+                           .values_list('id', 'maximum_amount'))
     for entity in data_children:
+        if entity[elt_field] not in maximum_amounts:
+            raise model.DoesNotExist(f"{model.__name__} {entity[elt_field]} not found")
         quantity = entity.get('qty_provided')
-        maximum_amount = None
+        maximum_amount = int(maximum_amounts[entity[elt_field]]) if maximum_amounts[entity[elt_field]] else None
+        if maximum_amount is not None and (quantity > maximum_amount):
+            return True
+    return False
 
-        if children.model == ClaimItem:
-            current_item = Item.objects.get(id=entity['item_id'], validity_to__isnull=True)
-            maximum_amount = int(current_item.maximum_amount) if current_item.maximum_amount else None
-        elif children.model == ClaimService:
-            current_service = Service.objects.get(id=entity['service_id'], validity_to__isnull=True)
-            maximum_amount = int(current_service.maximum_amount) if current_service.maximum_amount else None
 
-        if maximum_amount is not None and (quantity > maximum_amount):
-            is_overshoot = True
-            break
+def load_sub_elements(services):
+    """
+    Items and services referenced by code in the service_item_set/service_service_set of the services, with one
+    query per model
+    :return: {"items": code -> Item, "services": code -> Service}, the first one by id for each code
+    """
+    sub_elements = {"items": {}, "services": {}}
+    for key, model, set_field, code_field in (
+            ("items", Item, "service_item_set", "sub_item_code"),
+            ("services", Service, "service_service_set", "sub_service_code")):
+        codes = {line[code_field] for service in services for line in service.get(set_field) or []
+                 if code_field in line}
+        if codes:
+            for element in model.objects.filter(code__in=codes).order_by("id"):
+                sub_elements[key].setdefault(element.code, element)
+    return sub_elements
+
 
-    return is_overshoot
+def _sub_element(sub_elements, key, model, code):
+    if sub_elements is None:
+        return model.objects.filter(code=code).first()
+    return sub_elements[key].get(code)
+
+
+def _qty_asked(line):
+    if "qty_asked" in line:
+        if (math.isnan(line["qty_asked"])):
+            line["qty_asked"] = 0
 
 
 def item_create_hook(claim_id, item):
+    item_bulk_create_hook(claim_id, [item])
+
+
+def item_bulk_create_hook(claim_id, items, sub_elements=None):
     # TODO: investigate 'availability' is mandatory,
     # but not in UI > always true?
-    item['availability'] = True
-    ClaimItem.objects.create(claim_id=claim_id, **item)
+    ClaimItem.objects.bulk_create([ClaimItem(claim_id=claim_id, **{**item, 'availability': True}) for item in items])
 
 
 def service_create_hook(claim_id, service):
-    service_item_set = service.pop('service_item_set', None)
-    service_service_set = service.pop('service_service_set', None)
-    ClaimServiceId = ClaimService.objects.create(claim_id=claim_id, **service)
-    if (service_item_set):
+    service_bulk_create_hook(claim_id, [service])
+
+
+def service_bulk_create_hook(claim_id, services, sub_elements=None):
+    """
+    Creates the claim services and their sub-items/sub-services, with one INSERT per table where the database returns
+    the ids of bulk inserted rows (and one per claim service elsewhere)
+    """
+    if sub_elements is None:
+        sub_elements = load_sub_elements(services)
+    claim_services = []
+    sub_lines = []
+    for service in services:
+        service_item_set = service.pop('service_item_set', None)
+        service_service_set = service.pop('service_service_set', None)
+        claim_services.append(ClaimService(claim_id=claim_id, **service))
+        sub_lines.append((service_item_set or [], service_service_set or []))
+    if connection.features.can_return_rows_from_bulk_insert:
+        ClaimService.objects.bulk_create(claim_services)
+    else:
+        for claim_service in claim_services:
+            claim_service.save()
+
+    claim_service_items = []
+    claim_service_services = []
+    for claim_service, (service_item_set, service_service_set) in zip(claim_services, sub_lines):
         for serviceL in service_item_set:
-            if "qty_asked" in serviceL:
-                if (math.isnan(serviceL["qty_asked"])):
-                    serviceL["qty_asked"] = 0
-            itemId = Item.objects.filter(code=serviceL["sub_item_code"]).first()
-            ClaimServiceItem.objects.create(
-                item=itemId,
-                claim_service=ClaimServiceId,
+            _qty_asked(serviceL)
+            claim_service_items.append(ClaimServiceItem(
+                item=_sub_element(sub_elements, "items", Item, serviceL["sub_item_code"]),
+                claim_service=claim_service,
                 qty_displayed=serviceL["qty_asked"],
                 qty_provided=serviceL["qty_provided"],
                 price_asked=serviceL["price_asked"],
-            )
-
-    if (service_service_set):
+            ))
         for service_service in service_service_set:
-            if "qty_asked" in service_service:
-                if (math.isnan(service_service["qty_asked"])):
-                    service_service["qty_asked"] = 0
-            serviceId = Service.objects.filter(code=service_service["sub_service_code"]).first()
-            ClaimServiceService.objects.create(
-                service=serviceId,
-                claim_service=ClaimServiceId,
+            _qty_asked(service_service)
+            claim_service_services.append(ClaimServiceService(
+                service=_sub_element(sub_elements, "services", Service, service_service["sub_service_code"]),
+                claim_service=claim_service,
                 qty_displayed=service_service["qty_asked"],
                 qty_provided=service_service["qty_provided"],
                 price_asked=service_service["price_asked"],
-            )
+            ))
+    if claim_service_items:
+        ClaimServiceItem.objects.bulk_create(claim_service_items)
+    if claim_service_services:
+        ClaimServiceService.objects.bulk_create(claim_service_services)
+
+
+BULK_CREATE_HOOKS = {
+    item_create_hook: item_bulk_create_hook,
+    service_create_hook: service_bulk_create_hook,
+}
 
 
-def service_update_hook(claim_id, service):
+def service_update_hook(claim_id, service, sub_elements=None):
     service_item_set = service.get("service_item_set")
     service_service_set = service.get("service_service_set")
     service.pop('service_item_set', None)
@@ -129,10 +199,8 @@ def service_update_hook(claim_id, service):
     ClaimServiceId = ClaimService.objects.filter(claim=claim_id, service=service["service_id"]).first()
     if (service_item_set):
         for serviceL in service_item_set:
-            if "qty_asked" in serviceL:
-                if (math.isnan(serviceL["qty_asked"])):
-                    serviceL["qty_asked"] = 0
-            itemId = Item.objects.filter(code=serviceL["sub_item_code"]).first()
+            _qty_asked(serviceL)
+            itemId = _sub_element(sub_elements, "items", Item, serviceL["sub_item_code"])
             claimServiceItemId = ClaimServiceItem.objects.filter(
                 item=itemId,
                 claim_service=ClaimServiceId
@@ -142,10 +210,8 @@ def service_update_hook(claim_id, service):
 
     if (service_service_set):
         for service_service in service_service_set:
-            if "qty_asked" in service_service:
-                if (math.isnan(service_service["qty_asked"])):
-                    service_service["qty_asked"] = 0
-            serviceId = Service.objects.filter(code=service_service["sub_service_code"]).first()
+            _qty_asked(service_service)
+            serviceId = _sub_element(sub_elements, "services", Service, service_service["sub_service_code"])
             claimServiceServiceId = ClaimServiceService.objects.filter(
                 service=serviceId,
                 claim_service=ClaimServiceId
@@ -195,3 +261,18 @@ def get_queryset_valid_at_date(queryset, date):
     if filtered_qs.exists():
         return filtered_qs
     return queryset.filter(validity_from__lte=date, validity_to__isnull=True)
+
+
+def get_valid_at_date_by_key(queryset, date, key):
+    """
+    Set-based version of get_queryset_valid_at_date(...).first(): one query for all the values of `key`
+    (e.g. item_id), records closed after the date taking precedence over the open ones.
+    :return: dict of key value -> first record (by pk) valid at the date
+    """
+    records = queryset \
+        .filter(Q(validity_to__gte=date) | Q(validity_to__isnull=True), validity_from__lte=date) \
+        .order_by("pk")
+    closed, opened = {}, {}
+    for record in records:
+        (opened if record.validity_to is None else closed).setdefault(getattr(record, key), record)
+    return {**opened, **closed}
@@ -0,0 +1,323 @@
+from collections import defaultdict
+
+from core import utils, datetime
+from core.datetimes.shared import datetimedelta
+from django.db import connection
+from django.db.models import prefetch_related_objects, Max, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
+from medical_pricelist.models import ItemsPricelistDetail, ServicesPricelistDetail
+from policy.models import Policy
+from product.models import ProductItem, ProductService
+
+from .apps import ClaimConfig
+from .models import Claim, ClaimDetail, ClaimItem, ClaimService
+from .utilization import get_quantities_by_date
+from .utils import get_valid_at_date_by_key
+
+
+def get_frequency_violations(claim, detail_model, frequencies):
+    """
+    Set-based frequency check of all the items (or services) of a claim, in one grouped query
+    :param detail_model: ClaimItem or ClaimService
+    :param frequencies: dict item_id/service_id -> frequency (in days)
+    :return: set of the item_id/service_id already provided to the insuree within their frequency
+    """
+    frequencies = {elt_id: frequency for elt_id, frequency in frequencies.items() if frequency}
+    if not frequencies:
+        return set()
+    target_date = claim.date_from if not claim.date_to else claim.date_to
+    thresholds = {elt_id: target_date - datetimedelta(days=frequency) for elt_id, frequency in frequencies.items()}
+    min_threshold = min(thresholds.values())
+    elt_field = f"{detail_model.model_prefix}_id"
+    last_dates = detail_model.objects \
+        .filter(Q(rejection_reason=0) | Q(rejection_reason__isnull=True),
+                # Coalesce("claim__date_to", "claim__date_from") >= min_threshold, written to be index friendly
+                Q(claim__date_to__gte=min_threshold) |
+                Q(claim__date_to__isnull=True, claim__date_from__gte=min_threshold),
+                validity_to__isnull=True,
+                status=ClaimDetail.STATUS_PASSED,
+                claim__insuree_id=claim.insuree_id,
+                claim__status__gt=Claim.STATUS_ENTERED,
+                **{f"{elt_field}__in": list(frequencies)}) \
+        .exclude(claim__uuid=claim.uuid) \
+        .order_by() \
+        .values(elt_field) \
+        .annotate(last_date=Max(Coalesce("claim__date_to", "claim__date_from"))) \
+        .values_list(elt_field, "last_date")
+    return {elt_id for elt_id, last_date in last_dates if last_date >= thresholds[elt_id]}
+
+
+def get_products_by_element(target_date, elt_ids, insuree_id, adult, item_or_service):
+    """
+    Products covering the insuree at the target date for all the items (or services) of a claim, in one round trip.
+    :param item_or_service: 'Item' or 'Service'
+    :return: dict item_id/service_id -> list of ProductItem/ProductService ordered by end of waiting period, each
+        annotated with insuree_policy_effective_date, policy_effective_date, expiry_date and policy_stage
+    """
+    elt_ids = list(elt_ids)
+    if not elt_ids:
+        return {}
+    waiting_period = "WaitingPeriodAdult" if adult else "WaitingPeriodChild"
+    placeholders = ", ".join(["%s"] * len(elt_ids))
+    # about deductions and ceilings...
+    # tblProduct.DedInsuree, tblProduct.DedOPInsuree, tblProduct.DedIPInsuree,
+    # tblProduct.MaxInsuree, tblProduct.MaxOPInsuree, tblProduct.MaxIPInsuree,
+    # tblProduct.DedTreatment, tblProduct.DedOPTreatment, tblProduct.DedIPTreatment,
+    # tblProduct.MaxTreatment, tblProduct.MaxOPTreatment, tblProduct.MaxIPTreatment,
+    # tblProduct.DedPolicy, tblProduct.DedOPPolicy, tblProduct.DedIPPolicy,
+    # tblProduct.MaxPolicy, tblProduct.MaxOPPolicy, tblProduct.MaxIPPolicy
+    if connection.vendor == "postgresql":
+        sql = f"""
+                    SELECT 
+                        "tblProduct{item_or_service}s".*,
+                        "tblInsureePolicy"."EffectiveDate" AS insuree_policy_effective_date,
+                        "tblPolicy"."EffectiveDate" AS policy_effective_date,
+                        CASE
+                            WHEN "tblPolicy"."ExpiryDate" < "tblInsureePolicy"."ExpiryDate" THEN "tblPolicy"."ExpiryDate"
+                            ELSE "tblInsureePolicy"."ExpiryDate"
+                        END AS expiry_date,
+                        "tblPolicy"."PolicyStage" AS policy_stage
+                    FROM "tblInsuree" 
+                        INNER JOIN "tblInsureePolicy" ON "tblInsureePolicy"."InsureeID" = "tblInsuree"."InsureeID"
+                        LEFT OUTER JOIN "tblPolicy"
+                        LEFT OUTER JOIN "tblProduct" ON "tblPolicy"."ProdID" = "tblProduct"."ProdID"
+                        INNER JOIN "tblProduct{item_or_service}s" 
+                            ON "tblProduct"."ProdID" = "tblProduct{item_or_service}s"."ProdID"            
+                        RIGHT OUTER JOIN "tblFamilies" ON "tblPolicy"."FamilyID" = "tblFamilies"."FamilyID"
+                        ON "tblInsuree"."FamilyID" = "tblFamilies"."FamilyID"
+                    WHERE ("tblInsuree"."ValidityTo" IS NULL) AND ("tblInsuree"."InsureeID" = %s)
+                        AND ("tblInsureePolicy"."PolicyId" = "tblPolicy"."PolicyID")
+                        AND ("tblPolicy"."ValidityTo" IS NULL)
+                        AND ("tblPolicy"."EffectiveDate" <= %s) AND ("tblPolicy"."ExpiryDate" >= %s)
+                        AND ("tblInsureePolicy"."ValidityTo" IS NULL)
+                        AND ("tblInsureePolicy"."EffectiveDate" <= %s) AND ("tblInsureePolicy"."ExpiryDate" >= %s)
+                        AND ("tblPolicy"."PolicyStatus" in ({Policy.STATUS_ACTIVE}, {Policy.STATUS_EXPIRED}))
+                        AND ("tblProduct{item_or_service}s"."ValidityTo" IS NULL) 
+                            AND ("tblProduct{item_or_service}s"."{item_or_service}ID" IN ({placeholders}))
+                    ORDER BY "tblPolicy"."EffectiveDate" + coalesce("tblProduct{item_or_service}s"."{waiting_period}", 0) 
+                        * INTERVAL '1 MONTH'            
+                """
+    else:
+        sql = f"""
+            SELECT 
+                tblProduct{item_or_service}s.*,
+                tblInsureePolicy.EffectiveDate AS insuree_policy_effective_date,
+                tblPolicy.EffectiveDate AS policy_effective_date,
+                CASE
+                    WHEN tblPolicy.ExpiryDate < tblInsureePolicy.ExpiryDate THEN tblPolicy.ExpiryDate
+                    ELSE tblInsureePolicy.ExpiryDate
+                END AS expiry_date,
+                tblPolicy.PolicyStage AS policy_stage
+            FROM tblInsuree 
+                INNER JOIN tblInsureePolicy ON tblInsureePolicy.InsureeID = tblInsuree.InsureeID
+                LEFT OUTER JOIN tblPolicy
+                LEFT OUTER JOIN  tblProduct ON tblPolicy.ProdID = tblProduct.ProdID
+                INNER JOIN tblProduct{item_or_service}s ON tblProduct.ProdID = tblProduct{item_or_service}s.ProdID            
+                RIGHT OUTER JOIN tblFamilies ON tblPolicy.FamilyID = tblFamilies.FamilyID
+                ON tblInsuree.FamilyID = tblFamilies.FamilyID
+            WHERE (tblInsuree.ValidityTo IS NULL) AND (tblInsuree.InsureeId = %s)
+                AND (tblInsureePolicy.PolicyId = tblPolicy.PolicyID)
+                AND (tblPolicy.ValidityTo IS NULL)
+                AND (tblPolicy.EffectiveDate <= %s) AND (tblPolicy.ExpiryDate >= %s)
+                AND (tblInsureePolicy.ValidityTo IS NULL)
+                AND (tblInsureePolicy.EffectiveDate <= %s) AND (tblInsureePolicy.ExpiryDate >= %s)
+                AND (tblPolicy.PolicyStatus in ({Policy.STATUS_ACTIVE}, {Policy.STATUS_EXPIRED}))
+                AND (tblProduct{item_or_service}s.ValidityTo IS NULL)
+                    AND (tblProduct{item_or_service}s.{item_or_service}ID IN ({placeholders}))
+            ORDER BY DATEADD(m,ISNULL(tblProduct{item_or_service}s.{waiting_period}, 0),
+                tblPolicy.EffectiveDate)            
+        """
+    product_elt_model = ProductItem if item_or_service == 'Item' else ProductService
+    elt_field = f"{item_or_service.lower()}_id"
+    products = defaultdict(list)
+    # Raw query on the ProductItem/ProductService model so that the lines come back as model instances,
+    # the policy columns being added as extra attributes
+    for product_elt in product_elt_model.objects.raw(
+            sql, [insuree_id, target_date, target_date, target_date, target_date, *elt_ids]):
+        products[getattr(product_elt, elt_field)].append(product_elt)
+    return products
+
+
+def get_provided_quantities(insuree_id, detail_model, windows):
+    """
+    Quantities of items (or services) already provided to the insuree within policy windows, for all the lines
+    of a claim in one query grouped by item/service and claim date.
+    :param detail_model: ClaimItem or ClaimService
+    :param windows: dict item_id/service_id -> set of (insuree policy effective date, expiry date)
+    :return: dict (item_id/service_id, effective date, expiry date) -> total quantity provided
+    """
+    windows = {elt_id: elt_windows for elt_id, elt_windows in windows.items() if elt_windows}
+    totals = {(elt_id, start, end): 0 for elt_id, elt_windows in windows.items() for start, end in elt_windows}
+    if not totals:
+        return totals
+    elt_field = f"{detail_model.model_prefix}_id"
+    start_date = min(start for _, start, _ in totals)
+    end_date = max(end for _, _, end in totals)
+    if ClaimConfig.claim_utilization_enabled:
+        quantities = get_quantities_by_date(insuree_id, elt_field, windows, start_date, end_date)
+    else:
+        quantities = detail_model.objects \
+            .annotate(target_date=Coalesce("claim__date_to", "claim__date_from")) \
+            .filter(Q(rejection_reason=0) | Q(rejection_reason__isnull=True),
+                    validity_to__isnull=True,
+                    policy__validity_to__isnull=True,
+                    target_date__gte=start_date,
+                    target_date__lte=end_date,
+                    claim__insuree_id=insuree_id,
+                    claim__status__gt=Claim.STATUS_ENTERED,
+                    claim__validity_to__isnull=True,
+                    **{f"{elt_field}__in": list(windows)}) \
+            .order_by() \
+            .values(elt_field, "target_date") \
+            .annotate(qty=Sum(Coalesce("qty_approved", "qty_provided"))) \
+            .values_list(elt_field, "target_date", "qty")
+    for elt_id, target_date, qty in quantities:
+        for start, end in windows[elt_id]:
+            if start <= target_date <= end:
+                totals[(elt_id, start, end)] += qty or 0
+    return totals
+
+
+class ClaimValidationContext:
+    """
+    Reference data needed by the validation rules of one claim, loaded once per claim instead of once per
+    claim item/service. Every dataset is loaded lazily on first access, in a single query, so that the number
+    of queries doesn't depend on the number of lines of the claim.
+    """
+
+    def __init__(self, claim):
+        self.claim = claim
+        # The legacy code is not consistent about the reference date: the product checks use the start date
+        # while the price list and limitation checks use the end date.
+        self.target_date = claim.date_to if claim.date_to else claim.date_from
+        self.start_date = claim.date_from if claim.date_from else claim.date_to
+
+    @cached_property
+    def health_facility(self):
+        return self.claim.health_facility
+
+    @cached_property
+    def insuree(self):
+        return self.claim.insuree
+
+    @cached_property
+    def adult(self):
+        return self.insuree.is_adult(self.start_date)
+
+    @cached_property
+    def patient_category_mask(self):
+        return utils.patient_category_mask(self.insuree, self.target_date)
+
+    @cached_property
+    def items(self):
+        # claim.items.all() to keep using the items prefetched by the caller, if any
+        claim_items = list(self.claim.items.all())
+        prefetch_related_objects(claim_items, "item")
+        return claim_items
+
+    @cached_property
+    def services(self):
+        claim_services = list(self.claim.services.all())
+        prefetch_related_objects(claim_services, "service")
+        return claim_services
+
+    def save_details(self):
+        """
+        Writes back the status, rejection reason and quantities set by the validation rules on the loaded
+        claim items and services, with one statement per model.
+        """
+        fields = ["status", "rejection_reason", "qty_provided", "qty_approved"]
+        if self.items:
+            ClaimItem.objects.bulk_update(self.items, fields)
+        if self.services:
+            ClaimService.objects.bulk_update(self.services, fields)
+
+    @cached_property
+    def item_frequency_violations(self):
+        return get_frequency_violations(
+            self.claim, ClaimItem, {claim_item.item_id: claim_item.item.frequency for claim_item in self.items})
+
+    @cached_property
+    def service_frequency_violations(self):
+        return get_frequency_violations(
+            self.claim, ClaimService,
+            {claim_service.service_id: claim_service.service.frequency for claim_service in self.services})
+
+    @cached_property
+    def item_products(self):
+        return get_products_by_element(self.start_date, {claim_item.item_id for claim_item in self.items},
+                                       self.claim.insuree_id, self.adult, 'Item')
+
+    @cached_property
+    def service_products(self):
+        products = get_products_by_element(
+            self.start_date, {claim_service.service_id for claim_service in self.services},
+            self.claim.insuree_id, self.adult, 'Service')
+        # the category checks need the products themselves
+        prefetch_related_objects([product_service for product_services in products.values()
+                                  for product_service in product_services], "product")
+        return products
+
+    @staticmethod
+    def coverage_window(product_elt):
+        """
+        (insuree policy effective date, expiry date) of a product line returned by get_products_by_element
+        """
+        return (datetime.date.from_ad_date(product_elt.insuree_policy_effective_date),
+                datetime.date.from_ad_date(product_elt.expiry_date))
+
+    def _max_provision_windows(self, products):
+        windows = defaultdict(set)
+        for elt_id, product_elts in products.items():
+            for product_elt in product_elts:
+                limit_no = product_elt.limit_no_adult if self.adult else product_elt.limit_no_child
+                if limit_no is not None and limit_no >= 0:
+                    windows[elt_id].add(self.coverage_window(product_elt))
+        return windows
+
+    @cached_property
+    def item_provided_quantities(self):
+        return get_provided_quantities(self.claim.insuree_id, ClaimItem,
+                                       self._max_provision_windows(self.item_products))
+
+    @cached_property
+    def service_provided_quantities(self):
+        return get_provided_quantities(self.claim.insuree_id, ClaimService,
+                                       self._max_provision_windows(self.service_products))
+
+    def get_total_qty_provided(self, claim_detail, insuree_policy_effective_date, expiry_date):
+        provided_quantities = self.item_provided_quantities if isinstance(claim_detail, ClaimItem) \
+            else self.service_provided_quantities
+        return provided_quantities.get((claim_detail.itemsvc.id, insuree_policy_effective_date, expiry_date), 0)
+
+    @cached_property
+    def items_pricelist_details(self):
+        """
+        item_id -> ItemsPricelistDetail of the health facility valid at the claim target date
+        """
+        return get_valid_at_date_by_key(
+            ItemsPricelistDetail.objects.filter(
+                item_id__in={claim_item.item_id for claim_item in self.items},
+                validity_to__isnull=True,
+                items_pricelist_id=self.health_facility.items_pricelist_id,
+                items_pricelist__validity_to__isnull=True,
+            ),
+            self.target_date,
+            "item_id",
+        )
+
+    @cached_property
+    def services_pricelist_details(self):
+        """
+        service_id -> ServicesPricelistDetail of the health facility valid at the claim target date
+        """
+        return get_valid_at_date_by_key(
+            ServicesPricelistDetail.objects.filter(
+                service_id__in={claim_service.service_id for claim_service in self.services},
+                services_pricelist_id=self.health_facility.services_pricelist_id,
+                services_pricelist__validity_to__isnull=True,
+            ),
+            self.target_date,
+            "service_id",
+        )
@@ -0,0 +1,347 @@
+import logging
+from collections import Counter, defaultdict
+
+from core.utils import filter_validity
+from django.db.models import Count, IntegerField, Q, Value
+from django.utils.functional import cached_property
+from insuree.models import InsureePolicy
+from medical.models import ServiceItem, ServiceService
+from medical_pricelist.models import ItemsPricelistDetail, ServicesPricelistDetail
+from policy.models import Policy
+from product.models import Product, ProductItem, ProductService
+
+from .models import ClaimItem, ClaimService, ClaimServiceItem, ClaimServiceService
+from .utils import get_valid_at_date_by_key
+
+logger = logging.getLogger(__name__)
+
+
+def package_components_match(defined, claimed):
+    """
+    Package consistency check of the legacy valuation, in linear time: the claim must have as many components as
+    the package definition and each claimed component of the definition must have the defined quantity.
+    :param defined: list of (item_id/service_id, qty_provided) of the package definition
+    :param claimed: list of (item_id/service_id, qty_displayed) of the claimed service
+    """
+    if len(defined) != len(claimed):
+        return False
+    claimed_qtys = defaultdict(Counter)
+    for component_id, qty in claimed:
+        claimed_qtys[component_id][qty] += 1
+    return all(set(claimed_qtys[component_id]) <= {qty}
+               for component_id, qty in defined if component_id in claimed_qtys)
+
+
+class ValuationPlan:
+    """
+    Everything process_dedrem reads to valuate a claim: its (policy, product) pairs, passed details, price lists,
+    product lines, products, policies and policy member counts, each loaded once for the whole claim and keyed by id.
+    """
+
+    def __init__(self, claim, target_date):
+        self.claim = claim
+        self.target_date = target_date
+
+    @cached_property
+    def health_facility(self):
+        return self.claim.health_facility
+
+    @cached_property
+    def policy_products(self):
+        """
+        (policy_id, product_id) of each valuated detail, items then services, by id. The legacy product loop goes
+        through them all, duplicates included, and the last one determines the ClaimDedRem.
+        """
+        items_query = self.claim.items.filter(
+            *filter_validity(validity=self.target_date, prefix='item__'),
+            *filter_validity(),
+            *filter_validity(prefix='product__'),
+            rejection_reason=0,
+        ).annotate(detail_order=Value(0, output_field=IntegerField())) \
+            .values("policy_id", "product_id", "detail_order", "id")
+        services_query = self.claim.services.filter(
+            *filter_validity(validity=self.target_date, prefix='service__'),
+            *filter_validity(),
+            *filter_validity(prefix='product__'),
+            rejection_reason=0,
+        ).annotate(detail_order=Value(1, output_field=IntegerField())) \
+            .values("policy_id", "product_id", "detail_order", "id")
+        return [{"policy_id": row["policy_id"], "product_id": row["product_id"]}
+                for row in items_query.union(services_query, all=True).order_by("detail_order", "id")]
+
+    @cached_property
+    def details(self):
+        """
+        Passed claim items then services, by id, with their item/service: the deductibles and ceilings are used up
+        in this order
+        """
+        return list(self.claim.items
+                    .filter(validity_to__isnull=True, status=ClaimItem.STATUS_PASSED)
+                    .select_related("item")
+                    .order_by("id")) + \
+            list(self.claim.services
+                 .filter(validity_to__isnull=True, status=ClaimService.STATUS_PASSED)
+                 .select_related("service")
+                 .order_by("id"))
+
+    @cached_property
+    def items(self):
+        return [detail for detail in self.details if isinstance(detail, ClaimItem)]
+
+    @cached_property
+    def services(self):
+        return [detail for detail in self.details if isinstance(detail, ClaimService)]
+
+    @cached_property
+    def products(self):
+        """
+        product_id -> Product valid at the target date, the product_id being either its id or its legacy_id
+        """
+        return self._load_products({policy_product["product_id"] for policy_product in self.policy_products},
+                                   self.target_date)
+
+    @staticmethod
+    def _load_products(product_ids, target_date):
+        products = {}
+        if not product_ids:
+            return products
+        for product in Product.objects.filter(*filter_validity(validity=target_date),
+                                              Q(id__in=product_ids) | Q(legacy_id__in=product_ids)):
+            for product_id in (product.id, product.legacy_id):
+                if product_id in product_ids:
+                    products.setdefault(product_id, product)
+        return products
+
+    @cached_property
+    def policies(self):
+        return Policy.objects.in_bulk({policy_product["policy_id"] for policy_product in self.policy_products
+                                       if policy_product["policy_id"] is not None})
+
+    @cached_property
+    def policy_members(self):
+        """
+        policy_id -> number of insurees covered by the policy at the target date
+        """
+        return self._load_policy_members(list(self.policies), self.target_date)
+
+    @staticmethod
+    def _load_policy_members(policy_ids, target_date):
+        if not policy_ids:
+            return Counter()
+        return Counter(dict(InsureePolicy.objects
+                            .filter(policy_id__in=policy_ids,
+                                    effective_date__isnull=False,
+                                    effective_date__lte=target_date,
+                                    expiry_date__gte=target_date,
+                                    validity_to__isnull=True)
+                            .order_by()
+                            .values("policy_id")
+                            .annotate(members=Count("id"))
+                            .values_list("policy_id", "members")))
+
+    @cached_property
+    def items_pricelist_details(self):
+        """
+        item_id -> ItemsPricelistDetail of the health facility valid at the target date
+        """
+        return self._load_pricelist_details(ItemsPricelistDetail, "item_id", "items_pricelist",
+                                            self.health_facility.items_pricelist_id, self.items, self.target_date)
+
+    @cached_property
+    def services_pricelist_details(self):
+        """
+        service_id -> ServicesPricelistDetail of the health facility valid at the target date
+        """
+        return self._load_pricelist_details(ServicesPricelistDetail, "service_id", "services_pricelist",
+                                            self.health_facility.services_pricelist_id, self.services,
+                                            self.target_date)
+
+    @staticmethod
+    def _load_pricelist_details(model, elt_field, pricelist_field, pricelist_id, details, target_date):
+        return get_valid_at_date_by_key(
+            model.objects.filter(
+                **{f"{elt_field}__in": {getattr(detail, elt_field) for detail in details},
+                   f"{pricelist_field}_id": pricelist_id,
+                   f"{pricelist_field}__validity_to__isnull": True}),
+            target_date,
+            elt_field,
+        )
+
+    @cached_property
+    def product_items(self):
+        """
+        (product_id, item_id) -> current ProductItem
+        """
+        return self._product_lines(ProductItem, "item_id", self.items)
+
+    @cached_property
+    def product_services(self):
+        """
+        (product_id, service_id) -> current ProductService
+        """
+        return self._product_lines(ProductService, "service_id", self.services)
+
+    @staticmethod
+    def _product_lines(model, elt_field, details):
+        if not details:
+            return {}
+        product_lines = {}
+        for product_line in model.objects \
+                .filter(product_id__in={detail.product_id for detail in details},
+                        validity_to__isnull=True,
+                        **{f"{elt_field}__in": {getattr(detail, elt_field) for detail in details}}) \
+                .order_by("pk"):
+            product_lines.setdefault((product_line.product_id, getattr(product_line, elt_field)), product_line)
+        return product_lines
+
+    @cached_property
+    def packages(self):
+        """
+        Components of the package ('P') services of the claim: for the package service_id, its defined services
+        and items, and for the claim service id, its claimed services and items, as lists of (id, quantity)
+        """
+        packages = {key: defaultdict(list) for key in
+                    ("defined_services", "defined_items", "claimed_services", "claimed_items")}
+        package_services = [detail for detail in self.services if detail.service.packagetype == 'P']
+        if not package_services:
+            return packages
+        service_ids = {detail.service_id for detail in package_services}
+        detail_ids = [detail.id for detail in package_services]
+        for key, queryset in (
+                ("defined_services", ServiceService.objects.filter(servicelinkedService_id__in=service_ids)
+                 .values_list("servicelinkedService_id", "service_id", "qty_provided")),
+                ("defined_items", ServiceItem.objects.filter(servicelinkedItem_id__in=service_ids)
+                 .values_list("servicelinkedItem_id", "item_id", "qty_provided")),
+                ("claimed_services", ClaimServiceService.objects.filter(claim_service_id__in=detail_ids)
+                 .values_list("claim_service_id", "service_id", "qty_displayed")),
+                ("claimed_items", ClaimServiceItem.objects.filter(claim_service_id__in=detail_ids)
+                 .values_list("claim_service_id", "item_id", "qty_displayed"))):
+            for owner_id, component_id, qty in queryset:
+                packages[key][owner_id].append((component_id, qty))
+        return packages
+
+    def package_matches(self, claim_service):
+        """
+        Whether the services and items claimed for a package service are consistent with its definition
+        """
+        packages = self.packages
+        return package_components_match(packages["defined_services"][claim_service.service_id],
+                                        packages["claimed_services"][claim_service.id]) \
+            and package_components_match(packages["defined_items"][claim_service.service_id],
+                                         packages["claimed_items"][claim_service.id])
+
+    def get_product(self, product_id):
+        product = self.products.get(product_id)
+        if product is None:
+            raise Product.DoesNotExist(f"Product {product_id} not found at {self.target_date}")
+        return product
+
+    def get_policy(self, policy_id):
+        policy = self.policies.get(policy_id)
+        if policy is None:
+            raise Policy.DoesNotExist(f"Policy {policy_id} not found")
+        return policy
+
+    def get_pricelist_detail(self, claim_detail):
+        if isinstance(claim_detail, ClaimItem):
+            return self.items_pricelist_details.get(claim_detail.item_id)
+        return self.services_pricelist_details.get(claim_detail.service_id)
+
+    def get_product_itemsvc(self, claim_detail):
+        if isinstance(claim_detail, ClaimItem):
+            product_itemsvc = self.product_items.get((claim_detail.product_id, claim_detail.item_id))
+            if product_itemsvc is None:
+                raise ValueError("Product Item not found")
+        else:
+            product_itemsvc = self.product_services.get((claim_detail.product_id, claim_detail.service_id))
+            if product_itemsvc is None:
+                raise ValueError("Product Service not found")
+        return product_itemsvc
+
+
+class ValuationBatch:
+    """
+    Valuation plans of several claims, preloaded together: the details, (policy, product) pairs, products, policies,
+    member counts, price lists and product lines of the whole batch take a few queries per target date and price
+    list instead of a few per claim. The plans hold the same records as the per-claim ones, in the same order (items
+    then services, by id), so process_dedrem valuates the claims identically with either.
+    """
+
+    def __init__(self, claims):
+        self.claims = list(claims)
+
+    def plans(self):
+        """
+        :return: dict of claim id -> preloaded ValuationPlan
+        """
+        plans = {claim.id: ValuationPlan(claim, claim.date_to if claim.date_to else claim.date_from)
+                 for claim in self.claims}
+        by_date = defaultdict(list)
+        for plan in plans.values():
+            by_date[plan.target_date].append(plan)
+        for target_date, date_plans in by_date.items():
+            self._load_date(target_date, date_plans)
+
+        # the product lines only depend on the details, one query per model for the whole batch
+        all_plans = list(plans.values())
+        product_items = ValuationPlan._product_lines(
+            ProductItem, "item_id", [detail for plan in all_plans for detail in plan.items])
+        product_services = ValuationPlan._product_lines(
+            ProductService, "service_id", [detail for plan in all_plans for detail in plan.services])
+        for plan in all_plans:
+            plan.product_items = product_items
+            plan.product_services = product_services
+        return plans
+
+    @staticmethod
+    def _load_date(target_date, plans):
+        claim_ids = [plan.claim.id for plan in plans]
+        details = defaultdict(list)
+        policy_products = defaultdict(list)
+        for detail_model, elt_field in ((ClaimItem, "item"), (ClaimService, "service")):
+            for claim_detail in detail_model.objects \
+                    .filter(claim_id__in=claim_ids, validity_to__isnull=True, status=detail_model.STATUS_PASSED) \
+                    .select_related(elt_field) \
+                    .order_by("id"):
+                details[claim_detail.claim_id].append(claim_detail)
+            for policy_product in detail_model.objects \
+                    .filter(*filter_validity(validity=target_date, prefix=f'{elt_field}__'),
+                            *filter_validity(),
+                            *filter_validity(prefix='product__'),
+                            claim_id__in=claim_ids,
+                            rejection_reason=0) \
+                    .order_by("id") \
+                    .values("claim_id", "policy_id", "product_id"):
+                policy_products[policy_product.pop("claim_id")].append(policy_product)
+
+        for plan in plans:
+            plan.details = details[plan.claim.id]
+            plan.policy_products = policy_products[plan.claim.id]
+
+        all_policy_products = [policy_product for plan in plans for policy_product in plan.policy_products]
+        products = ValuationPlan._load_products(
+            {policy_product["product_id"] for policy_product in all_policy_products}, target_date)
+        policies = Policy.objects.in_bulk({policy_product["policy_id"] for policy_product in all_policy_products
+                                           if policy_product["policy_id"] is not None})
+        policy_members = ValuationPlan._load_policy_members(list(policies), target_date)
+
+        pricelist_details = {}
+        for model, elt_field, pricelist_field, details_attr in (
+                (ItemsPricelistDetail, "item_id", "items_pricelist", "items"),
+                (ServicesPricelistDetail, "service_id", "services_pricelist", "services")):
+            by_pricelist = defaultdict(list)
+            for plan in plans:
+                by_pricelist[getattr(plan.health_facility, f"{pricelist_field}_id")] += getattr(plan, details_attr)
+            pricelist_details[pricelist_field] = {
+                pricelist_id: ValuationPlan._load_pricelist_details(
+                    model, elt_field, pricelist_field, pricelist_id, pricelist_claim_details, target_date)
+                for pricelist_id, pricelist_claim_details in by_pricelist.items()}
+
+        for plan in plans:
+            plan.products = products
+            plan.policies = policies
+            plan.policy_members = policy_members
+            plan.items_pricelist_details = \
+                pricelist_details["items_pricelist"][plan.health_facility.items_pricelist_id]
+            plan.services_pricelist_details = \
+                pricelist_details["services_pricelist"][plan.health_facility.services_pricelist_id]